@@ -38,6 +38,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
 
     'django_filters',
     'rest_framework',
@@ -102,6 +103,37 @@ DATABASES = {
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/4.1/topics/cache/
+
+# The shared tier of the galaxies response cache, which also carries the
+# version bumps of the writes of the worker pools and the management commands
+# to the web workers, so it must be shared by all their processes (see the
+# galaxies.E001 check). The file based backend is shared by the processes of
+# a single host. Production, with several hosts, should point this at Redis
+# or Memcached, e.g.
+#
+#     'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+#     'LOCATION': 'redis://127.0.0.1:6379',
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os_path.join(BASE_DIR, 'cache'),
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    }
+}
+
+GALAXIES_RESPONSE_CACHE = {
+    'CACHE_ALIAS': 'default',
+    # Seconds a response stays cached if none of its models is written to.
+    'TIMEOUT': 300,
+    # Size of the in-process LRU tier in front of the shared cache.
+    'LOCAL_MAX_ENTRIES': 1024,
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
 
@@ -177,6 +209,17 @@ SIMPLE_JWT = {
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os_path.join(BASE_DIR)
 
+# Uploads are stored by content hash in sharded directories and deduplicated.
+DEFAULT_FILE_STORAGE = 'galaxies.storage.ContentAddressedStorage'
+
+GALAXIES_MEDIA_STORAGE = {
+    # The upload directories whose files are content addressed.
+    'UPLOAD_DIRS': ('images',),
+    # images/ab/cd/abcd...ef.png
+    'SHARD_DEPTH': 2,
+    'SHARD_WIDTH': 2,
+}
+
 
 VERSATILEIMAGEFIELD_RENDITION_KEY_SETS = {
     'image_headshot': [
@@ -186,3 +229,91 @@ VERSATILEIMAGEFIELD_RENDITION_KEY_SETS = {
         ('small_square_crop', 'crop__50x50'),
     ]
 }
+
+GALAXIES_RENDITIONS = {
+    # Generate the renditions of uploads in a pool of worker processes,
+    # instead of synchronously when the upload commits, in the request.
+    # Needs a shared cache (see CACHES).
+    'ASYNC': True,
+    'WORKERS': 2,
+    # Modern formats the renditions are also encoded to, with their encoder
+    # options, served to clients that list them in Accept. Formats the
+    # Pillow build can't encode (e.g. AVIF without a plugin) are skipped.
+    'FORMATS': {
+        'avif': {'quality': 60},
+        'webp': {'quality': 80, 'method': 4},
+    },
+}
+
+GALAXIES_MEDIA_SERVING = {
+    # Hand the file bodies off to the web server in front, once the checks
+    # are made: 'x-accel-redirect' for nginx, with an internal location
+    # aliasing MEDIA_ROOT at ACCEL_REDIRECT_PREFIX, or 'x-sendfile'.
+    'OFFLOAD': None,
+    'ACCEL_REDIRECT_PREFIX': '/protected-media/',
+    # Files named by their content hash never change and are cached for a
+    # year, the others are revalidated after an hour.
+    'MAX_AGE': 60 * 60,
+    'IMMUTABLE_MAX_AGE': 365 * 24 * 60 * 60,
+    # Seconds a file found to belong to an image row is served without
+    # looking it up again.
+    'VISIBLE_TIMEOUT': 5 * 60,
+}
+
+GALAXIES_PURGE = {
+    # Purge the data of deleted users in the worker process pool, instead of
+    # synchronously in the request, in transactions of BATCH_SIZE rows.
+    # Needs a shared cache (see CACHES).
+    'ASYNC': True,
+    'BATCH_SIZE': 500,
+}
+
+GALAXIES_SKY = {
+    # The height in degrees of the declination zones of the sky index. Run
+    # rebuild_sky_index after changing it.
+    'ZONE_HEIGHT': 0.5,
+    'MAX_CONE_RADIUS': 10,
+    # Cross-matches pair positions with the nearest galaxy within 5 arcsec
+    # by default.
+    'CROSS_MATCH_RADIUS': 5 / 3600,
+    'MAX_CROSS_MATCH_RADIUS': 0.1,
+    'MAX_CROSS_MATCH_ROWS': 200000,
+    # Sky map tiles: 9 levels, from 2 cells of 180 degrees to 256 x 512 cells,
+    # served in tiles of 16 x 16 cells and cached by clients for a day. Only
+    # the levels from TILE_DETAIL up are stored, which the tiles are made of.
+    # Run rebuild_sky_tiles after changing them.
+    'TILE_LEVELS': 9,
+    'TILE_DETAIL': 4,
+    'TILE_MAX_AGE': 24 * 60 * 60,
+}
+
+GALAXIES_STATS = {
+    # The percentiles of the /galaxies/stats/ distributions, and the bins of
+    # their histograms.
+    'PERCENTILES': (0.05, 0.25, 0.5, 0.75, 0.95),
+    'BINS': 10,
+    'MAX_BINS': 100,
+}
+
+GALAXIES_SIMILARITY = {
+    # The weights of the features in the difference between galaxies, see
+    # galaxies.similarity.
+    'WEIGHTS': {
+        'distance': 1.0,
+        'apparent_magnitude': 1.0,
+        'size': 1.0,
+        'galaxy_type': 1.0,
+        'constellation': 0.5,
+    },
+    'MAX_JOURNAL_ENTRIES': 1000,
+    'JOURNAL_TIMEOUT': 24 * 60 * 60,
+    'JOURNAL_GRACE': 5,
+}
+
+GALAXIES_UPLOADS = {
+    # Limits of the resumable chunked uploads, in bytes.
+    'MAX_SIZE': 100 * 1024 * 1024,
+    'MAX_CHUNK_SIZE': 8 * 1024 * 1024,
+    # Seconds an upload session stays open after its last chunk.
+    'EXPIRES': 24 * 60 * 60,
+}
@@ -1,15 +1,14 @@
-# for django dev server to serve media
 from django.conf import settings
-from django.conf.urls.static import static
-
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, re_path, include
 from drf_spectacular.views import SpectacularAPIView, SpectacularSwaggerView
 
 from rest_framework.routers import DefaultRouter
 
 from galaxies.views import ConstellationViewSet, ConstellationImageViewSet,\
-    GalaxyViewSet, PostViewSet, GalaxyImageViewSet, PostImageViewSet, CommentViewSet
+    GalaxyViewSet, PostViewSet, GalaxyImageViewSet, PostImageViewSet, CommentViewSet,\
+    ResponseCacheStatsView, SkyTileView, UploadSessionViewSet
+from galaxies.serving import serve_media
 
 router = DefaultRouter()
 router.register(r'constellations', ConstellationViewSet, basename='Constellations')
@@ -20,17 +19,22 @@ router.register(r'constellation_images',
                 ConstellationImageViewSet, basename='Constellation Images')
 router.register(r'galaxy_images', GalaxyImageViewSet, basename='Galaxy Images')
 router.register(r'post_images', PostImageViewSet, basename='Post Images')
+router.register(r'uploads', UploadSessionViewSet, basename='Uploads')
 
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('auth/', include('my_auth.urls')),
     path('', include(router.urls)),
+    path('sky_tiles/<int:zoom>/<int:x>/<int:y>/', SkyTileView.as_view(), name='sky_tiles'),
+    path('cache_stats/', ResponseCacheStatsView.as_view(), name='cache_stats'),
     path('api/schema/', SpectacularAPIView.as_view(), name='schema'),
     path('api/schema/swagger-ui/',
          SpectacularSwaggerView.as_view(url_name='schema'), name='swagger-ui'),
 ]
 
-# for django dev server to serve media
-if settings.DEBUG:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+# Media is served by the application, in production too, so that only the
+# images the API exposes can be read (see galaxies.serving).
+urlpatterns += [
+    re_path(r'^%s(?P<path>.+)$' % settings.MEDIA_URL.lstrip('/'), serve_media, name='media'),
+]
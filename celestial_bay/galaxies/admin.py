@@ -1,5 +1,6 @@
 from django.contrib import admin
-from .models import Constellation, ConstellationImage, Galaxy, GalaxyImage, Post, PostImage, Comment
+from .models import Constellation, ConstellationImage, Galaxy, GalaxyImage, GalaxyType, Post,\
+    PostImage, Comment, SkyTile, UploadSession
 
 admin.site.site_header = 'Celestial Bay Admin'
 
@@ -10,9 +11,17 @@ class GalaxyAdmin(admin.ModelAdmin):
     list_filter = ('galaxy_type', 'constellation')
 
 
+@admin.register(GalaxyType)
+class GalaxyTypeAdmin(admin.ModelAdmin):
+    list_display = ('pk', 'name', 'parent')
+    list_filter = ('parent',)
+
+
 admin.site.register(Constellation)
 admin.site.register(ConstellationImage)
 admin.site.register(GalaxyImage)
 admin.site.register(Post)
 admin.site.register(PostImage)
 admin.site.register(Comment)
+admin.site.register(UploadSession)
+admin.site.register(SkyTile)
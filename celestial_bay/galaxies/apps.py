@@ -1,6 +1,144 @@
 from django.apps import AppConfig
+from django.core.checks import Tags, register
+from django.db.models.signals import post_delete, post_migrate, post_save, pre_migrate,\
+    pre_save
 
 
 class GalaxiesConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'galaxies'
+
+    def ready(self):
+        from .cache import invalidate_on_write
+        from .checks import check_shared_cache
+        from .classification import create_hubble_classes
+        from .counters import COUNTERS, remember_counted_relations,\
+            update_counters_on_save, update_counters_on_delete
+        from .media import release_files_on_delete, release_replaced_files
+        from .metadata import extract_metadata_on_upload
+        from .renditions import IMAGE_MODELS, reset_renditions_on_change,\
+            enqueue_renditions_on_save
+        from .search import SEARCH_DOCUMENTS, update_search_vector_on_save,\
+            create_search_extensions
+        from .similarity import SIMILARITY_OBJECTS, record_change_on_write
+        from .sky import SKY_OBJECTS, update_sky_zone_on_save
+        from .tiles import remember_tile_contribution, update_tiles_on_save,\
+            update_tiles_on_delete
+        from .uploads import delete_upload_file
+
+        register(check_shared_cache, Tags.caches)
+
+        pre_migrate.connect(
+            create_search_extensions,
+            sender=self,
+            dispatch_uid='create_search_extensions'
+        )
+        post_migrate.connect(
+            create_hubble_classes,
+            sender=self,
+            dispatch_uid='create_hubble_classes'
+        )
+
+        for model in SEARCH_DOCUMENTS:
+            post_save.connect(
+                update_search_vector_on_save,
+                sender=model,
+                dispatch_uid=f'update_search_vector_{model._meta.label_lower}'
+            )
+
+        for model in self.get_models():
+            post_save.connect(
+                invalidate_on_write,
+                sender=model,
+                dispatch_uid=f'invalidate_cache_{model._meta.label_lower}'
+            )
+            post_delete.connect(
+                invalidate_on_write,
+                sender=model,
+                dispatch_uid=f'invalidate_cache_on_delete_{model._meta.label_lower}'
+            )
+
+        for label in {label for label, _, _ in COUNTERS}:
+            model = self.apps.get_model(label)
+            pre_save.connect(
+                remember_counted_relations,
+                sender=model,
+                dispatch_uid=f'remember_counted_relations_{label}'
+            )
+            post_save.connect(
+                update_counters_on_save,
+                sender=model,
+                dispatch_uid=f'update_counters_{label}'
+            )
+            post_delete.connect(
+                update_counters_on_delete,
+                sender=model,
+                dispatch_uid=f'update_counters_on_delete_{label}'
+            )
+
+        for model in IMAGE_MODELS:
+            pre_save.connect(
+                extract_metadata_on_upload,
+                sender=model,
+                dispatch_uid=f'extract_metadata_{model._meta.label_lower}'
+            )
+            pre_save.connect(
+                reset_renditions_on_change,
+                sender=model,
+                dispatch_uid=f'reset_renditions_{model._meta.label_lower}'
+            )
+            post_save.connect(
+                enqueue_renditions_on_save,
+                sender=model,
+                dispatch_uid=f'enqueue_renditions_{model._meta.label_lower}'
+            )
+            post_save.connect(
+                release_replaced_files,
+                sender=model,
+                dispatch_uid=f'release_replaced_files_{model._meta.label_lower}'
+            )
+            post_delete.connect(
+                release_files_on_delete,
+                sender=model,
+                dispatch_uid=f'release_files_on_delete_{model._meta.label_lower}'
+            )
+
+        for model in SKY_OBJECTS:
+            pre_save.connect(
+                update_sky_zone_on_save,
+                sender=model,
+                dispatch_uid=f'update_sky_zone_{model._meta.label_lower}'
+            )
+            pre_save.connect(
+                remember_tile_contribution,
+                sender=model,
+                dispatch_uid=f'remember_tile_contribution_{model._meta.label_lower}'
+            )
+            post_save.connect(
+                update_tiles_on_save,
+                sender=model,
+                dispatch_uid=f'update_tiles_{model._meta.label_lower}'
+            )
+            post_delete.connect(
+                update_tiles_on_delete,
+                sender=model,
+                dispatch_uid=f'update_tiles_on_delete_{model._meta.label_lower}'
+            )
+
+        for model in SIMILARITY_OBJECTS:
+            post_save.connect(
+                record_change_on_write,
+                sender=model,
+                dispatch_uid=f'record_similarity_change_{model._meta.label_lower}'
+            )
+            post_delete.connect(
+                record_change_on_write,
+                sender=model,
+                dispatch_uid=f'record_similarity_change_on_delete_{model._meta.label_lower}'
+            )
+
+        post_delete.connect(
+            delete_upload_file,
+            sender=self.get_model('UploadSession'),
+            dispatch_uid='delete_upload_file'
+        )
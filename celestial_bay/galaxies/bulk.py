@@ -0,0 +1,315 @@
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from rest_framework import status
+from rest_framework.decorators import action
+from rest_framework.exceptions import PermissionDenied, ValidationError
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+
+from .cache import invalidate_in_bulk
+from .counters import aggregated_counter_updates, update_counters_in_bulk
+from .search import SEARCH_DOCUMENTS, update_search_vector
+from .similarity import SIMILARITY_OBJECTS, record_changes
+from .sky import SKY_OBJECTS, update_sky_zone
+from .tiles import update_tiles_in_bulk
+
+
+def _non_field_error(message):
+    return ValidationError({api_settings.NON_FIELD_ERRORS_KEY: [message]})
+
+
+class BulkModelMixin:
+    """
+    Bulk create, update and delete of up to bulk_max_size objects per request:
+
+        - POST an array of objects to create them;
+
+            e.g.  POST https://api.example.org/galaxies/bulk/
+
+        - PATCH an array of partial objects, each with its 'pk', to update them;
+        - DELETE an array of primary keys to delete them.
+
+    The whole array is validated first, the unique fields of the items
+    against each other too. If any item is invalid, nothing is written and
+    the response is a 400 with a list of errors, one per item and empty for
+    the valid ones. Otherwise all items are written in a single
+    transaction, with bulk_create/bulk_update, and the response lists the
+    objects in the order of the items.
+
+    As with perform_create, the owner is always the requesting user, and the
+    objects to update or delete must all be owned by them, which is checked on
+    the rows loaded with a single query.
+    """
+
+    bulk_max_size = 500
+
+    def get_bulk_items(self, request, objects=True):
+        items = request.data
+
+        if not isinstance(items, list):
+            raise _non_field_error('Expected a list of items.')
+
+        if objects and not all(isinstance(item, dict) for item in items):
+            raise _non_field_error('Expected a list of objects.')
+
+        if not items:
+            raise _non_field_error('This list may not be empty.')
+
+        if len(items) > self.bulk_max_size:
+            raise _non_field_error(
+                f'Ensure this list has no more than {self.bulk_max_size} items.'
+            )
+
+        return items
+
+    def get_bulk_pks(self, values):
+        """
+        Converts the primary keys of the items, answering 400 with the errors
+        of the invalid or repeated ones.
+        """
+
+        pk_field = self.get_queryset().model._meta.pk
+        pks, errors, seen = [], [], set()
+
+        for value in values:
+            try:
+                pk = pk_field.to_python(value)
+            except DjangoValidationError as error:
+                pks.append(None)
+                errors.append({'pk': error.messages})
+                continue
+
+            if pk is None:
+                errors.append({'pk': ['This field is required.']})
+            elif pk in seen:
+                errors.append({'pk': ['Duplicate primary key.']})
+            else:
+                errors.append({})
+
+            seen.add(pk)
+            pks.append(pk)
+
+        if any(errors):
+            raise ValidationError(errors)
+
+        return pks
+
+    def get_bulk_objects(self, request, pks):
+        """
+        Loads and locks the objects, answering 400 if any of them doesn't
+        exist and 403 if any of them isn't owned by the requesting user.
+        """
+
+        objects = self.get_queryset().select_for_update().in_bulk(pks)
+
+        if len(objects) != len(pks):
+            raise ValidationError([
+                {} if pk in objects else {'pk': ['Not found.']} for pk in pks
+            ])
+
+        if any(obj.owner_id != request.user.pk for obj in objects.values()):
+            raise PermissionDenied()
+
+        return [objects[pk] for pk in pks]
+
+    def validate_bulk(self, serializers):
+        errors = [
+            {} if serializer.is_valid() else serializer.errors
+            for serializer in serializers
+        ]
+
+        if any(errors):
+            raise ValidationError(errors)
+
+    def validate_unique_in_bulk(self, instances):
+        """
+        Checks the unique fields and constraints of the objects to write
+        against each other and, with a single query per constraint, against
+        the other rows, answering 400 with the errors of the conflicting
+        items instead of failing the whole write.
+        """
+
+        model = self.get_queryset().model
+        manager = model._default_manager
+        pks = [instance.pk for instance in instances if instance.pk is not None]
+        checks = [
+            (field.name,) for field in model._meta.concrete_fields
+            if field.unique and not field.primary_key
+        ]
+        checks += [tuple(fields) for fields in model._meta.unique_together]
+        checks += [constraint.fields for constraint in model._meta.total_unique_constraints]
+        errors = [{} for _ in instances]
+
+        for check in checks:
+            attnames = [model._meta.get_field(name).attname for name in check]
+            values = [
+                tuple(getattr(instance, attname) for attname in attnames)
+                for instance in instances
+            ]
+            # NULLs never conflict.
+            candidates = {value for value in values if None not in value}
+
+            if not candidates:
+                continue
+
+            if len(attnames) == 1:
+                lookup = Q(**{f'{attnames[0]}__in': [value for value, in candidates]})
+            else:
+                lookup = Q()
+                for value in candidates:
+                    lookup |= Q(**dict(zip(attnames, value)))
+
+            existing = set(
+                manager.filter(lookup).exclude(pk__in=pks).values_list(*attnames)
+            )
+            key = check[0] if len(check) == 1 else api_settings.NON_FIELD_ERRORS_KEY
+            seen = set()
+
+            for instance, value, item_errors in zip(instances, values, errors):
+                if None in value:
+                    continue
+
+                if value in existing or value in seen:
+                    item_errors.setdefault(key, []).extend(
+                        instance.unique_error_message(model, check).messages
+                    )
+
+                seen.add(value)
+
+        if any(errors):
+            raise ValidationError(errors)
+
+    def get_bulk_results(self, instances):
+        """
+        The written objects as the queryset of the view loads them, e.g. with
+        its annotations, in the order of the items.
+        """
+
+        objects = self.get_queryset().in_bulk([instance.pk for instance in instances])
+
+        return [objects[instance.pk] for instance in instances]
+
+    def bulk_write(self, write, instances):
+        try:
+            with transaction.atomic():
+                write(instances)
+        except IntegrityError:
+            raise _non_field_error(
+                'The items conflict with each other or with existing objects.'
+            )
+
+    @action(detail=False, methods=['post'], url_path='bulk',
+            pagination_class=None, filter_backends=())
+    def bulk_create(self, request, *args, **kwargs):
+        items = self.get_bulk_items(request)
+        serializers = [
+            self.get_serializer(data={**item, 'owner': request.user.pk})
+            for item in items
+        ]
+        self.validate_bulk(serializers)
+
+        model = self.get_queryset().model
+        instances = [model(**serializer.validated_data) for serializer in serializers]
+        self.validate_unique_in_bulk(instances)
+
+        if model in SKY_OBJECTS:
+            for instance in instances:
+                update_sky_zone(instance)
+
+        def write(instances):
+            model._default_manager.bulk_create(instances)
+
+            # Bulk writes don't send signals, so their side effects are
+            # applied here, set-based.
+            pks = [instance.pk for instance in instances]
+            update_counters_in_bulk(model, instances)
+            if model in SKY_OBJECTS:
+                update_tiles_in_bulk(instances)
+            if model in SIMILARITY_OBJECTS:
+                record_changes(pks)
+            if model in SEARCH_DOCUMENTS:
+                update_search_vector(model._default_manager.filter(pk__in=pks))
+            invalidate_in_bulk(model, pks)
+
+        self.bulk_write(write, instances)
+
+        serializer = self.get_serializer(self.get_bulk_results(instances), many=True)
+
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+    @bulk_create.mapping.patch
+    def bulk_update(self, request, *args, **kwargs):
+        items = self.get_bulk_items(request)
+        pks = self.get_bulk_pks([item.get('pk') for item in items])
+        model = self.get_queryset().model
+
+        def write(instances):
+            # The field values before the update, for the counters and tiles.
+            previous = {
+                instance.pk: {
+                    field.attname: getattr(instance, field.attname)
+                    for field in model._meta.concrete_fields
+                    if field.attname not in instance.get_deferred_fields()
+                }
+                for instance in instances
+            }
+            serializers = [
+                self.get_serializer(
+                    instance, data={**item, 'owner': request.user.pk}, partial=True
+                )
+                for instance, item in zip(instances, items)
+            ]
+            self.validate_bulk(serializers)
+
+            fields = set()
+            for instance, serializer in zip(instances, serializers):
+                for attr, value in serializer.validated_data.items():
+                    setattr(instance, attr, value)
+                fields.update(serializer.validated_data)
+
+            self.validate_unique_in_bulk(instances)
+
+            if model in SKY_OBJECTS and fields.intersection(('ra', 'dec')):
+                for instance in instances:
+                    update_sky_zone(instance)
+                fields.update(('ra', 'sky_zone'))
+
+            # bulk_update doesn't fill in auto_now fields.
+            for field in model._meta.concrete_fields:
+                if getattr(field, 'auto_now', False):
+                    for instance in instances:
+                        field.pre_save(instance, add=False)
+                    fields.add(field.name)
+
+            model._default_manager.bulk_update(instances, sorted(fields))
+
+            update_counters_in_bulk(model, instances, previous)
+            if model in SKY_OBJECTS:
+                update_tiles_in_bulk(instances, previous)
+            if model in SIMILARITY_OBJECTS:
+                record_changes(pks)
+            if model in SEARCH_DOCUMENTS and fields.intersection(
+                    field for field, _ in SEARCH_DOCUMENTS[model]):
+                update_search_vector(model._default_manager.filter(pk__in=pks))
+            invalidate_in_bulk(model, pks)
+
+        with transaction.atomic():
+            instances = self.get_bulk_objects(request, pks)
+            self.bulk_write(write, instances)
+
+        serializer = self.get_serializer(self.get_bulk_results(instances), many=True)
+
+        return Response(serializer.data)
+
+    @bulk_create.mapping.delete
+    def bulk_destroy(self, request, *args, **kwargs):
+        pks = self.get_bulk_pks(self.get_bulk_items(request, objects=False))
+
+        with transaction.atomic(), aggregated_counter_updates():
+            self.get_bulk_objects(request, pks)
+            # Unlike bulk writes, deletes send the signals that update the
+            # counters and invalidate the cache.
+            self.get_queryset().model._default_manager.filter(pk__in=pks).delete()
+
+        return Response(status=status.HTTP_204_NO_CONTENT)
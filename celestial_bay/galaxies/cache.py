@@ -0,0 +1,484 @@
+import time
+from collections import Counter, OrderedDict
+from hashlib import sha256
+from threading import Lock
+
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist
+from django.core.cache import caches
+from django.db import transaction
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date
+from rest_framework.response import Response
+
+from rest_flex_fields import EXPAND_PARAM, FIELDS_PARAM, OMIT_PARAM, WILDCARD_VALUES,\
+    split_levels
+
+from .formats import get_accepted_image_format
+from .prefetch import get_expandable_fields, get_serializer_class
+
+
+CACHE_SETTINGS = {
+    'CACHE_ALIAS': 'default',
+    'TIMEOUT': 300,
+    'LOCAL_MAX_ENTRIES': 1024,
+    **getattr(settings, 'GALAXIES_RESPONSE_CACHE', {}),
+}
+
+VERSION_KEY_PREFIX = 'galaxies:version:'
+RESPONSE_KEY_PREFIX = 'galaxies:response:'
+
+
+class LocalLRUCache:
+    """
+    A bounded, thread safe, in-process LRU tier in front of the shared cache.
+
+    Entries are keyed by the same versioned keys as the shared tier, so they
+    become unreachable as soon as a version they were built with is bumped,
+    and are evicted in least recently used order.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                return None
+
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout):
+        with self._lock:
+            self._data[key] = (time.monotonic() + timeout, value)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+local_cache = LocalLRUCache(CACHE_SETTINGS['LOCAL_MAX_ENTRIES'])
+
+# Hit and miss counters of this process: 'local_hits', 'shared_hits' and
+# 'misses'.
+stats = Counter()
+_stats_lock = Lock()
+
+
+def get_shared_cache():
+    return caches[CACHE_SETTINGS['CACHE_ALIAS']]
+
+
+def _count(name):
+    with _stats_lock:
+        stats[name] += 1
+
+
+def get_stats():
+    with _stats_lock:
+        counters = dict(stats)
+
+    lookups = sum(counters.values())
+    hits = counters.get('local_hits', 0) + counters.get('shared_hits', 0)
+    counters['hit_ratio'] = hits / lookups if lookups else None
+
+    return counters
+
+
+def clear():
+    local_cache.clear()
+
+    with _stats_lock:
+        stats.clear()
+
+
+def get_version_key(model, pk=None):
+    """
+    The key of the version counter of a model, i.e. of the whole collection,
+    or of a single row of it when pk is given.
+    """
+
+    key = f'{VERSION_KEY_PREFIX}{model._meta.label_lower}'
+
+    if pk is not None:
+        key = f'{key}:{pk}'
+
+    return key
+
+
+def get_versions(keys):
+    """
+    Returns the current versions for the version keys with a single round
+    trip to the shared cache, initializing the missing ones.
+
+    Versions are the time of the last write in nanoseconds, so they never
+    restart from a value an older response was built with, even when evicted,
+    and the greatest of them doubles as the last modification time.
+    """
+
+    shared_cache = get_shared_cache()
+    versions = shared_cache.get_many(keys)
+
+    for key in keys:
+        if key not in versions:
+            shared_cache.add(key, time.time_ns(), timeout=None)
+            versions[key] = shared_cache.get(key)
+
+    return versions
+
+
+def bump_versions(keys):
+    """
+    Moves the versions forward to the current time, with atomic increments,
+    so that concurrent bumps of a version can't overwrite one another and
+    each of them changes it.
+    """
+
+    shared_cache = get_shared_cache()
+    current = shared_cache.get_many(keys)
+    now = time.time_ns()
+
+    for key in keys:
+        if key not in current and shared_cache.add(key, now, timeout=None):
+            continue
+
+        try:
+            shared_cache.incr(key, max(now - current.get(key, now), 1))
+        except ValueError:
+            # Evicted in the meantime.
+            shared_cache.add(key, now, timeout=None)
+
+
+def invalidate_on_write(sender, instance, **kwargs):
+    """
+    post_save/post_delete receiver that bumps the versions of the written
+    row and of its model, invalidating every cached response and ETag built
+    from them.
+
+    The versions are bumped right away and again when the transaction
+    commits, so a response cached by a concurrent request from the data
+    before the commit can't be served afterwards.
+    """
+
+    if kwargs.get('raw', False):
+        return
+
+    invalidate_in_bulk(sender, [instance.pk])
+
+
+def invalidate_in_bulk(model, pks):
+    """
+    Bumps the versions of the rows of a model and of the model itself, the
+    same way invalidate_on_write does, for writes that send no signals, such
+    as bulk_create and bulk_update.
+    """
+
+    keys = [get_version_key(model)] + [get_version_key(model, pk) for pk in pks]
+
+    bump_versions(keys)
+    transaction.on_commit(lambda: bump_versions(keys))
+
+
+def get_dependencies(model, serializer_class, expand):
+    """
+    Returns the models a response is built from: the model of the view and
+    the related models of every expanded relation, at any depth.
+    """
+
+    dependencies = {model}
+    expand_fields, next_expand_fields = split_levels(expand)
+    expandable_fields = get_expandable_fields(serializer_class)
+
+    if WILDCARD_VALUES and set(expand_fields) & set(WILDCARD_VALUES):
+        expand_fields = expandable_fields.keys()
+
+    for name in expand_fields:
+        if name not in expandable_fields:
+            continue
+
+        options = expandable_fields[name]
+
+        if isinstance(options, tuple):
+            child_serializer_class = options[0]
+            source = (options[1] if len(options) > 1 else {}).get('source', name)
+        else:
+            child_serializer_class, source = options, name
+
+        try:
+            field = model._meta.get_field(source)
+        except FieldDoesNotExist:
+            continue
+
+        if not field.is_relation:
+            continue
+
+        dependencies |= get_dependencies(
+            field.related_model,
+            get_serializer_class(child_serializer_class),
+            next_expand_fields.get(name, [])
+        )
+
+    return dependencies
+
+
+def normalize_query(query_params):
+    """
+    Returns a canonical form of the query string, with the parameters sorted
+    and the values of fields/omit/expand sorted, so that equivalent requests
+    share a cache entry.
+    """
+
+    normalized = []
+
+    for param in sorted(query_params):
+        values = query_params.getlist(param)
+
+        if param.rstrip('[]') in (FIELDS_PARAM, OMIT_PARAM, EXPAND_PARAM):
+            values = [','.join(sorted(
+                value.strip() for value in ','.join(values).split(',') if value.strip()
+            ))]
+
+        normalized.extend(f'{param}={value}' for value in sorted(values))
+
+    return '&'.join(normalized)
+
+
+class ResponseVersionMixin:
+    """
+    Computes the version of a list or retrieve response from the version
+    counters of what it is built from, without touching the database:
+
+        - a list depends on the versions of the view's model and of the
+          models of every expanded relation;
+        - a retrieve depends on the version of the row itself and of the
+          models of every expanded relation.
+
+    Together with the path, the normalized query string, the renderer, the
+    image format negotiated from the Accept header and the visibility of the
+    data for the user, they are hashed into a digest that is used both as
+    the response cache key and as the ETag. Responses vary on Accept.
+
+    Needs the get_expands() method of ExpandPrefetchMixin.
+    """
+
+    def get_cache_visibility(self, request):
+        """
+        The part of the key that depends on the user. Everything the API
+        reads is public, so all users share the same entries.
+        """
+
+        return 'public'
+
+    def get_version_keys(self, request, **kwargs):
+        model = self.get_queryset().model
+        dependencies = get_dependencies(
+            model, self.get_serializer_class(), self.get_expands()
+        )
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+
+        if lookup_url_kwarg in kwargs:
+            dependencies.discard(model)
+            keys = [get_version_key(model, kwargs[lookup_url_kwarg])]
+        else:
+            keys = []
+
+        return keys + [get_version_key(dependency) for dependency in dependencies]
+
+    _response_version = None
+
+    def get_response_version(self, request, **kwargs):
+        """
+        Returns the (digest, last modified timestamp) pair of the response,
+        computed once per request.
+        """
+
+        if self._response_version is None:
+            self._response_version = self.compute_response_version(request, **kwargs)
+
+        return self._response_version
+
+    def compute_response_version(self, request, **kwargs):
+        versions = get_versions(self.get_version_keys(request, **kwargs))
+
+        raw_key = '|'.join((
+            request.get_host(),
+            request.path,
+            normalize_query(request.query_params),
+            request.accepted_renderer.format,
+            get_accepted_image_format(request) or '',
+            self.get_cache_visibility(request),
+            ','.join(f'{key}={versions[key]}' for key in sorted(versions)),
+        ))
+        digest = sha256(raw_key.encode('utf-8')).hexdigest()
+        last_modified = max(versions.values()) // 10 ** 9
+
+        return digest, last_modified
+
+
+class CachedResponseMixin(ResponseVersionMixin):
+    """
+    A versioned read-through cache of the list and retrieve responses, keyed
+    by the response version (see ResponseVersionMixin). Writes bump the
+    versions (see invalidate_on_write), so stale entries are never read
+    again and age out of the caches.
+
+    The serialized data is looked up in a bounded in-process LRU tier first
+    and then in the shared Django cache. The 'X-Cache' response header tells
+    if the response was a HIT or a MISS.
+    """
+
+    cache_timeout = CACHE_SETTINGS['TIMEOUT']
+
+    def get_cache_key(self, request, **kwargs):
+        digest, _ = self.get_response_version(request, **kwargs)
+
+        return RESPONSE_KEY_PREFIX + digest
+
+    def cached_response(self, handler, request, *args, **kwargs):
+        if request.method != 'GET':
+            return handler(request, *args, **kwargs)
+
+        key = self.get_cache_key(request, **kwargs)
+        data = local_cache.get(key)
+
+        if data is not None:
+            _count('local_hits')
+        else:
+            data = get_shared_cache().get(key)
+
+            if data is not None:
+                _count('shared_hits')
+                local_cache.set(key, data, self.cache_timeout)
+
+        if data is not None:
+            response = Response(data, headers={'X-Cache': 'HIT'})
+            patch_vary_headers(response, ('Accept',))
+
+            return response
+
+        _count('misses')
+        response = handler(request, *args, **kwargs)
+        patch_vary_headers(response, ('Accept',))
+
+        if response.status_code == 200:
+            data = response.data
+            get_shared_cache().set(key, data, self.cache_timeout)
+            local_cache.set(key, data, self.cache_timeout)
+
+        response['X-Cache'] = 'MISS'
+
+        return response
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(super().retrieve, request, *args, **kwargs)
+
+
+class ConditionalRequestMixin(ResponseVersionMixin):
+    """
+    Conditional requests backed by the response versions:
+
+        - list and retrieve responses carry a strong ETag and Last-Modified,
+          and If-None-Match/If-Modified-Since are answered with 304 Not
+          Modified before any query or serialization is made;
+        - as Last-Modified has a resolution of a second, it is only sent, and
+          If-Modified-Since only honoured, once the second of the last write
+          is over, since a later write in the same second wouldn't make the
+          response newer than it;
+        - PUT and PATCH honour If-Match/If-Unmodified-Since against the
+          ETag of the object (as returned by a plain GET of it), answering
+          412 Precondition Failed when the object has been changed since.
+    """
+
+    def get_validators(self, request, **kwargs):
+        digest, last_modified = self.get_response_version(request, **kwargs)
+
+        return f'"{digest}"', last_modified
+
+    def get_read_validators(self, request, **kwargs):
+        """
+        The validators of a read, without the last modification time while
+        its second isn't over.
+        """
+
+        etag, last_modified = self.get_validators(request, **kwargs)
+
+        if last_modified >= int(time.time()):
+            last_modified = None
+
+        return etag, last_modified
+
+    def set_validators(self, response, etag, last_modified):
+        if response.status_code == 200:
+            response['ETag'] = etag
+            if last_modified is not None:
+                response['Last-Modified'] = http_date(last_modified)
+            patch_vary_headers(response, ('Accept',))
+
+        return response
+
+    def conditional_response(self, handler, request, *args, **kwargs):
+        etag, last_modified = self.get_read_validators(request, **kwargs)
+        response = get_conditional_response(
+            request._request, etag=etag, last_modified=last_modified
+        )
+
+        if response is not None:
+            return response
+
+        return self.set_validators(
+            handler(request, *args, **kwargs), etag, last_modified
+        )
+
+    def list(self, request, *args, **kwargs):
+        return self.conditional_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.conditional_response(super().retrieve, request, *args, **kwargs)
+
+    def update(self, request, *args, **kwargs):
+        if not {'HTTP_IF_MATCH', 'HTTP_IF_UNMODIFIED_SINCE'} & set(request.META):
+            return super().update(request, *args, **kwargs)
+
+        with transaction.atomic():
+            # Concurrent writers of the row wait here until this one commits,
+            # and then see the versions it has bumped.
+            lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+            list(
+                self.get_queryset().model._default_manager
+                .select_for_update()
+                .filter(**{self.lookup_field: kwargs[lookup_url_kwarg]})
+                .values_list('pk', flat=True)
+            )
+
+            etag, last_modified = self.get_validators(request, **kwargs)
+            response = get_conditional_response(
+                request._request, etag=etag, last_modified=last_modified
+            )
+
+            if response is not None:
+                return response
+
+            response = super().update(request, *args, **kwargs)
+
+        # The object has a new version now.
+        self._response_version = None
+
+        return self.set_validators(
+            response, *self.get_read_validators(request, **kwargs)
+        )
@@ -0,0 +1,58 @@
+from django.conf import settings
+from django.core.checks import Error, Warning
+
+
+# Cache backends that keep their entries in the memory of each process, or
+# don't keep them at all, which can't carry the version bumps of the
+# galaxies response cache between processes.
+PER_PROCESS_CACHE_BACKENDS = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+def check_shared_cache(app_configs, **kwargs):
+    """
+    The versions of galaxies.cache are bumped by every process that writes:
+    the worker pools, the management commands and the web workers. They
+    only invalidate the responses, ETags and in-memory tables of the other
+    processes through a cache shared by all of them.
+    """
+
+    from .cache import CACHE_SETTINGS
+    from .purge import get_purge_settings
+    from .renditions import get_renditions_settings
+
+    alias = CACHE_SETTINGS['CACHE_ALIAS']
+    backend = settings.CACHES.get(alias, {}).get('BACKEND')
+
+    if backend not in PER_PROCESS_CACHE_BACKENDS:
+        return []
+
+    pools = [
+        name for name, pool_settings in (
+            ('GALAXIES_RENDITIONS', get_renditions_settings()),
+            ('GALAXIES_PURGE', get_purge_settings()),
+        )
+        if pool_settings['ASYNC']
+    ]
+
+    if pools:
+        return [Error(
+            f'The {alias!r} cache uses {backend}, which is per process, but the '
+            f'worker process pool of {" and ".join(pools)} is enabled, whose '
+            'writes would never invalidate the cached responses.',
+            hint="Point the cache at Redis or Memcached, or set 'ASYNC' to False.",
+            id='galaxies.E001',
+        )]
+
+    if not settings.DEBUG:
+        return [Warning(
+            f'The {alias!r} cache uses {backend}, which is per process, so the '
+            'writes of management commands and of the other web workers never '
+            'invalidate the cached responses of a process.',
+            hint='Point the cache at Redis or Memcached.',
+            id='galaxies.W001',
+        )]
+
+    return []
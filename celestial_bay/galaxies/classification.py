@@ -0,0 +1,223 @@
+from threading import Lock
+
+from django.apps import apps as global_apps
+from django.db import IntegrityError, transaction
+from django.db.models.functions import Lower
+
+from .cache import get_version_key, get_versions, invalidate_in_bulk
+from .models import Galaxy, GalaxyType
+from .similarity import record_changes
+
+
+# The classes of the Hubble classification the galaxy types start with, as
+# (name, parent name), the parents first.
+HUBBLE_CLASSES = (
+    ('elliptical', None),
+    *((f'E{index}', 'elliptical') for index in range(8)),
+    ('lenticular', None),
+    ('S0', 'lenticular'),
+    ('SB0', 'lenticular'),
+    ('spiral', None),
+    *((f'S{stage}', 'spiral') for stage in 'abcd'),
+    ('barred spiral', 'spiral'),
+    *((f'SB{stage}', 'barred spiral') for stage in 'abcd'),
+    ('irregular', None),
+    ('Irr', 'irregular'),
+)
+
+# The batch size of the classification in migrations.
+CLASSIFY_BATCH_SIZE = 1000
+
+_types = None
+_types_lock = Lock()
+
+
+def normalize_type_name(name):
+    """
+    The name of a galaxy type without the surrounding and repeated spaces,
+    which, compared case-insensitively, identifies the type.
+    """
+
+    return ' '.join(str(name).split())
+
+
+def find_galaxy_type(name, model=GalaxyType, using=None):
+    return model._default_manager.db_manager(using).alias(
+        lower_name=Lower('name')
+    ).filter(lower_name=normalize_type_name(name).lower()).first()
+
+
+def resolve_galaxy_type(name, model=GalaxyType, using=None):
+    """
+    Returns the galaxy type of a name, as given by clients or in the legacy
+    free-text column, creating an unclassified one when there is none.
+
+    The model is the historical GalaxyType in migrations.
+    """
+
+    galaxy_type = find_galaxy_type(name, model, using)
+
+    if galaxy_type is not None:
+        return galaxy_type
+
+    try:
+        with transaction.atomic(using):
+            return model._default_manager.db_manager(using).create(
+                name=normalize_type_name(name)
+            )
+    except IntegrityError:
+        # Created concurrently.
+        return find_galaxy_type(name, model, using)
+
+
+def create_hubble_classes(apps=global_apps, using='default', **kwargs):
+    """
+    post_migrate receiver that creates the missing HUBBLE_CLASSES.
+    """
+
+    try:
+        model = apps.get_model('galaxies', 'GalaxyType')
+    except LookupError:
+        # Not migrated yet.
+        return
+
+    manager = model._default_manager.db_manager(using)
+    existing = {
+        name.lower(): pk for pk, name in manager.values_list('pk', 'name')
+    }
+
+    for name, parent in HUBBLE_CLASSES:
+        if name.lower() not in existing:
+            existing[name.lower()] = manager.create(
+                name=name, parent_id=existing[parent.lower()] if parent else None
+            ).pk
+
+
+def get_types():
+    """
+    The (pk, name, parent pk) of all the galaxy types, kept in memory until
+    a galaxy type is written to (see galaxies.cache).
+    """
+
+    global _types
+
+    key = get_version_key(GalaxyType)
+    version = get_versions([key])[key]
+
+    with _types_lock:
+        if _types is None or _types[0] != version:
+            _types = (version, list(GalaxyType.objects.values_list('pk', 'name', 'parent')))
+
+        return _types[1]
+
+
+def get_type_names():
+    return {pk: name for pk, name, _ in get_types()}
+
+
+def get_type_ids(value, family=False):
+    """
+    The pks of the galaxy type given by pk or name, and with family of all
+    the types under it, or an empty list if there is no such type.
+    """
+
+    types = get_types()
+
+    if str(value).isdigit():
+        matches = [pk for pk, _, _ in types if pk == int(value)]
+    else:
+        name = normalize_type_name(value).lower()
+        matches = [pk for pk, type_name, _ in types if type_name.lower() == name]
+
+    if not family:
+        return matches
+
+    children = {}
+    for pk, _, parent in types:
+        children.setdefault(parent, []).append(pk)
+
+    ids, seen = list(matches), set(matches)
+
+    for pk in ids:
+        for child in children.get(pk, ()):
+            if child not in seen:
+                seen.add(child)
+                ids.append(child)
+
+    return ids
+
+
+def _classify(galaxy_model, type_model, batch_size, using=None, on_batch=None):
+    """
+    Sets the galaxy type of the galaxies without one from their legacy
+    free-text type, in batches of a transaction each, calling on_batch with
+    the pks of each batch in its transaction, and returns the number of
+    galaxies classified.
+    """
+
+    queryset = galaxy_model._default_manager.db_manager(using).filter(
+        galaxy_type__isnull=True
+    ).exclude(legacy_galaxy_type='').order_by('pk')
+    resolved, classified, last_pk = {}, 0, None
+
+    while True:
+        batch = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        rows = list(batch.values_list('pk', 'legacy_galaxy_type')[:batch_size])
+
+        if not rows:
+            return classified
+
+        by_type = {}
+
+        for pk, name in rows:
+            key = normalize_type_name(name).lower()
+
+            if key not in resolved:
+                resolved[key] = resolve_galaxy_type(name, type_model, using).pk
+
+            by_type.setdefault(resolved[key], []).append(pk)
+
+        pks = [pk for pk, _ in rows]
+
+        # A single UPDATE per type.
+        with transaction.atomic(using):
+            for type_id, type_pks in by_type.items():
+                queryset.filter(pk__in=type_pks).update(galaxy_type=type_id)
+
+            if on_batch is not None:
+                on_batch(pks)
+
+        classified += len(pks)
+        last_pk = pks[-1]
+
+
+def classify_galaxies(batch_size=1000):
+    """
+    Sets the galaxy type of the galaxies without one from their legacy
+    free-text type, in batches, and returns the number of galaxies
+    classified. Can be interrupted and run again.
+    """
+
+    def on_batch(pks):
+        invalidate_in_bulk(Galaxy, pks)
+        record_changes(pks)
+
+    return _classify(Galaxy, GalaxyType, batch_size, on_batch=on_batch)
+
+
+def classify_legacy_galaxies(apps, schema_editor):
+    """
+    RunPython code of the migration of existing databases to GalaxyType (see
+    galaxies.migration_operations), which classifies the galaxies with the
+    historical models, under the HUBBLE_CLASSES.
+    """
+
+    using = schema_editor.connection.alias
+
+    create_hubble_classes(apps, using)
+    _classify(
+        apps.get_model('galaxies', 'Galaxy'),
+        apps.get_model('galaxies', 'GalaxyType'),
+        CLASSIFY_BATCH_SIZE,
+        using
+    )
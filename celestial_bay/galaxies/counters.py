@@ -0,0 +1,270 @@
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from threading import local
+
+from django.apps import apps
+from django.db.models import Count, F, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
+
+from .cache import bump_versions, get_version_key, invalidate_in_bulk
+
+
+# The denormalized counters: (counted model, its foreign key, counter field of
+# the related model).
+COUNTERS = (
+    ('galaxies.Comment', 'post', 'comment_count'),
+    ('galaxies.PostImage', 'post', 'image_count'),
+    ('galaxies.Galaxy', 'constellation', 'galaxy_count'),
+    ('galaxies.Galaxy', 'owner', 'galaxy_count'),
+    ('galaxies.Post', 'owner', 'post_count'),
+)
+
+# The counter updates buffered by aggregated_counter_updates(), per thread.
+_buffer = local()
+
+
+class CounterFieldsMixin:
+    """
+    For models with denormalized counter fields.
+
+    The counters are only ever changed with F() updates in the database, so
+    saving an already existing instance leaves them out of the UPDATE. This
+    way a stale in-memory value can't overwrite a concurrent increment.
+    """
+
+    counter_fields = ()
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding and not kwargs.get('force_insert') \
+                and kwargs.get('update_fields') is None:
+            deferred_fields = self.get_deferred_fields()
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key
+                and field.name not in self.counter_fields
+                and field.attname not in deferred_fields
+            ]
+
+        super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        # The counted rows the delete cascades to update the counters of this
+        # row, and of the others, once.
+        with aggregated_counter_updates():
+            _remember_deleted(self)
+            return super().delete(*args, **kwargs)
+
+
+def get_counters(model=None):
+    """
+    Yields the (counted model, foreign key field, counter field) triples,
+    optionally only those of a counted model.
+    """
+
+    for label, fk_name, counter_field in COUNTERS:
+        counted_model = apps.get_model(label)
+
+        if model is None or counted_model is model:
+            yield counted_model, counted_model._meta.get_field(fk_name), counter_field
+
+
+@contextmanager
+def aggregated_counter_updates():
+    """
+    Buffers the counter updates of the writes of the block, e.g. of the rows
+    a delete cascades to, and applies them at its end with one UPDATE per
+    counter and delta, instead of one per counted row. The related rows that
+    are deleted in the block are left out.
+    """
+
+    if getattr(_buffer, 'deltas', None) is not None:
+        # Applied by the outer block.
+        yield
+        return
+
+    _buffer.deltas, _buffer.deleted = Counter(), set()
+
+    try:
+        yield
+        deltas, deleted = _buffer.deltas, _buffer.deleted
+    finally:
+        _buffer.deltas = _buffer.deleted = None
+
+    by_counter = defaultdict(dict)
+
+    for (related_model, counter_field, pk), delta in deltas.items():
+        if (related_model, pk) not in deleted:
+            by_counter[related_model, counter_field][pk] = delta
+
+    for (related_model, counter_field), related_deltas in by_counter.items():
+        _apply(related_model, counter_field, related_deltas)
+
+
+def _remember_deleted(instance):
+    if getattr(_buffer, 'deleted', None) is not None:
+        _buffer.deleted.add((type(instance), instance.pk))
+
+
+def _apply(related_model, counter_field, deltas):
+    """
+    Adds the deltas to the counter of the related rows, given by pk, with one
+    UPDATE per distinct delta.
+    """
+
+    by_delta = defaultdict(list)
+
+    for pk, delta in deltas.items():
+        if delta:
+            by_delta[delta].append(pk)
+
+    if not by_delta:
+        return
+
+    for delta, pks in by_delta.items():
+        queryset = related_model._default_manager.filter(pk__in=pks)
+
+        if delta < 0:
+            queryset = queryset.filter(**{f'{counter_field}__gte': -delta})
+
+        queryset.update(**{counter_field: F(counter_field) + delta})
+
+    # Queryset updates don't send signals, so the cached responses of the
+    # related rows are invalidated here, again when the transaction commits.
+    invalidate_in_bulk(related_model, [pk for pks in by_delta.values() for pk in pks])
+
+
+def _add(fk, pk, counter_field, delta):
+    if getattr(_buffer, 'deltas', None) is not None:
+        _buffer.deltas[fk.related_model, counter_field, pk] += delta
+    else:
+        _apply(fk.related_model, counter_field, {pk: delta})
+
+
+def remember_counted_relations(sender, instance, raw=False, update_fields=None, **kwargs):
+    """
+    pre_save receiver that remembers the current foreign keys of a counted
+    row before an update, in case it is moved to another related row.
+    """
+
+    if raw or instance._state.adding:
+        instance._counted_relations = None
+        return
+
+    attnames = [
+        fk.attname for _, fk, _ in get_counters(sender)
+        if update_fields is None or fk.name in update_fields or fk.attname in update_fields
+    ]
+
+    if not attnames:
+        instance._counted_relations = None
+        return
+
+    instance._counted_relations = sender._default_manager.filter(
+        pk=instance.pk
+    ).values(*attnames).first()
+
+
+def update_counters_on_save(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+
+    previous = getattr(instance, '_counted_relations', None)
+
+    for _, fk, counter_field in get_counters(sender):
+        current_pk = getattr(instance, fk.attname)
+
+        if created:
+            if current_pk is not None:
+                _add(fk, current_pk, counter_field, 1)
+            continue
+
+        if previous is None or fk.attname not in previous:
+            continue
+
+        previous_pk = previous[fk.attname]
+
+        if previous_pk != current_pk:
+            if previous_pk is not None:
+                _add(fk, previous_pk, counter_field, -1)
+            if current_pk is not None:
+                _add(fk, current_pk, counter_field, 1)
+
+
+def update_counters_on_delete(sender, instance, **kwargs):
+    # A counted row can have counters too, e.g. the comments of a post.
+    _remember_deleted(instance)
+
+    for _, fk, counter_field in get_counters(sender):
+        related_pk = getattr(instance, fk.attname)
+
+        if related_pk is not None:
+            _add(fk, related_pk, counter_field, -1)
+
+
+def update_counters_in_bulk(model, instances, previous=None):
+    """
+    Updates the counters after a bulk_create, or after a bulk_update given
+    the previous field values of the instances by pk, as bulk writes send no
+    signals. Makes one UPDATE per counter and distinct delta.
+    """
+
+    for _, fk, counter_field in get_counters(model):
+        deltas = Counter()
+
+        for instance in instances:
+            current_pk = getattr(instance, fk.attname)
+            previous_pk = None if previous is None else previous[instance.pk][fk.attname]
+
+            if previous_pk == current_pk:
+                continue
+            if previous_pk is not None:
+                deltas[previous_pk] -= 1
+            if current_pk is not None:
+                deltas[current_pk] += 1
+
+        _apply(fk.related_model, counter_field, deltas)
+
+
+def reconcile(counted_model, fk, counter_field, batch_size):
+    """
+    Recounts a counter for all related rows, in batches of primary keys, and
+    fixes the rows that have drifted. Returns the number of fixed rows.
+    """
+
+    related_model = fk.related_model
+    count = Subquery(
+        counted_model._default_manager
+        .filter(**{fk.name: OuterRef('pk')})
+        .order_by()
+        .values(fk.name)
+        .annotate(count=Count('pk'))
+        .values('count')
+    )
+    queryset = related_model._default_manager.order_by('pk')
+    fixed, last_pk = 0, None
+
+    while True:
+        batch = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        pks = list(batch.values_list('pk', flat=True)[:batch_size])
+
+        if not pks:
+            return fixed
+
+        drifted = list(
+            related_model._default_manager
+            .filter(pk__in=pks)
+            .annotate(actual_count=Coalesce(count, 0))
+            .filter(~Q(**{counter_field: F('actual_count')}))
+            .values_list('pk', flat=True)
+        )
+
+        if drifted:
+            fixed += related_model._default_manager.filter(pk__in=drifted).update(
+                **{counter_field: Coalesce(count, 0)}
+            )
+            bump_versions(
+                [get_version_key(related_model)]
+                + [get_version_key(related_model, pk) for pk in drifted]
+            )
+
+        last_pk = pks[-1]
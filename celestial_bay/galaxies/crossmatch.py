@@ -0,0 +1,280 @@
+import csv
+import io
+import json
+from threading import Lock
+
+import numpy as np
+from django.db import connections, router
+from rest_framework.parsers import BaseParser
+
+from .cache import get_version_key, get_versions
+from .models import Galaxy
+from .sky import angular_separation
+
+
+# The declination zone height, in degrees, of the in-memory catalog index,
+# and the right ascension span a zone takes in the sort key.
+CATALOG_ZONE_HEIGHT = 1 / 60
+ZONE_SPAN = 1000
+
+# The number of input positions matched at a time, which bounds the memory
+# the candidate pairs take.
+MATCH_CHUNK_SIZE = 10000
+
+_catalog = None
+_catalog_lock = Lock()
+
+
+def get_ra_half_widths(dec, radius):
+    """
+    galaxies.sky.get_ra_half_width() for an array of declinations.
+    """
+
+    dec, radius = np.radians(dec), np.radians(radius)
+
+    with np.errstate(divide='ignore'):
+        half_widths = np.degrees(np.arctan(
+            np.sin(radius) / np.sqrt(np.abs(np.cos(dec - radius) * np.cos(dec + radius)))
+        ))
+
+    return np.where(np.abs(dec) + radius > np.radians(89.9), 180, half_widths)
+
+
+class CatalogIndex:
+    """
+    The positions of all the galaxies in memory, sorted by declination zone
+    and then by right ascension, in a single float key, so that the galaxies
+    in a zone and right ascension range are a slice found by binary search.
+    """
+
+    def __init__(self, pks, ra, dec):
+        zones = np.floor((dec + 90) / CATALOG_ZONE_HEIGHT)
+        keys = zones * ZONE_SPAN + ra
+        order = np.argsort(keys, kind='stable')
+
+        self.keys, self.pks, self.ra, self.dec = keys[order], pks[order], ra[order], dec[order]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def get_windows(self, ra, dec, radius):
+        """
+        Returns the (start, stop) slices of the galaxies in the boxes around
+        the cones, one row per cone and a column per zone and right ascension
+        range, as a range crossing 0h is split in two.
+        """
+
+        half_widths = get_ra_half_widths(dec, radius)
+        reach = int(np.ceil(radius / CATALOG_ZONE_HEIGHT))
+        zones = np.floor((dec + 90) / CATALOG_ZONE_HEIGHT)
+        low, high = ra - half_widths, ra + half_widths
+        ranges = [
+            (np.maximum(low, 0), np.minimum(high, 360)),
+            # The parts that wrap around, empty unless the range crosses 0h.
+            (np.where(low < 0, low + 360, 360), np.full_like(ra, 360)),
+            (np.zeros_like(ra), np.where(high > 360, high - 360, 0)),
+        ]
+        starts, stops = [], []
+
+        for offset in range(-reach, reach + 1):
+            base = (zones + offset) * ZONE_SPAN
+
+            for range_low, range_high in ranges:
+                starts.append(np.searchsorted(self.keys, base + range_low, side='left'))
+                stops.append(np.searchsorted(self.keys, base + range_high, side='right'))
+
+        starts, stops = np.stack(starts, axis=1), np.stack(stops, axis=1)
+
+        return starts, np.maximum(stops, starts)
+
+    def match(self, ra, dec, radius):
+        """
+        Returns the index of the nearest galaxy within radius degrees of each
+        position, or -1, and the separations in degrees, or NaN.
+        """
+
+        nearest = np.full(len(ra), -1, dtype=np.int64)
+        separations = np.full(len(ra), np.nan)
+
+        if not len(self) or not len(ra):
+            return nearest, separations
+
+        starts, stops = self.get_windows(ra, dec, radius)
+        counts = (stops - starts).ravel()
+        inputs = np.repeat(np.repeat(np.arange(len(ra)), starts.shape[1]), counts)
+        # The galaxies of every window, one after another.
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        candidates = np.repeat(starts.ravel(), counts) + offsets
+
+        candidate_separations = angular_separation(
+            ra[inputs], dec[inputs], self.ra[candidates], self.dec[candidates]
+        )
+        inside = candidate_separations <= radius
+        inputs, candidates = inputs[inside], candidates[inside]
+        candidate_separations = candidate_separations[inside]
+
+        # The nearest candidate of each input comes first.
+        order = np.lexsort((candidate_separations, inputs))
+        matched, first = np.unique(inputs[order], return_index=True)
+        nearest[matched] = candidates[order][first]
+        separations[matched] = candidate_separations[order][first]
+
+        return nearest, separations
+
+
+def load_catalog():
+    """
+    Reads the positions of all the galaxies with a single query.
+    """
+
+    table = Galaxy._meta.db_table
+    connection = connections[router.db_for_read(Galaxy)]
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'SELECT id, ra, dec FROM {connection.ops.quote_name(table)} '
+            f'WHERE ra IS NOT NULL AND dec IS NOT NULL'
+        )
+        rows = np.array(cursor.fetchall(), dtype=np.float64).reshape(-1, 3)
+
+    return CatalogIndex(rows[:, 0].astype(np.int64), rows[:, 1], rows[:, 2])
+
+
+def get_catalog():
+    """
+    The catalog index of the galaxies, kept in memory and rebuilt after the
+    galaxies have been written to (see galaxies.cache).
+    """
+
+    global _catalog
+
+    key = get_version_key(Galaxy)
+    version = get_versions([key])[key]
+
+    with _catalog_lock:
+        if _catalog is None or _catalog[0] != version:
+            _catalog = (version, load_catalog())
+
+        return _catalog[1]
+
+
+def cross_match(ra, dec, radius):
+    """
+    Matches positions, as arrays of degrees, to the nearest galaxy within
+    radius degrees. Returns the primary keys of the galaxies, or -1, and the
+    separations in degrees, or NaN.
+    """
+
+    catalog = get_catalog()
+    pks = np.full(len(ra), -1, dtype=np.int64)
+    separations = np.full(len(ra), np.nan)
+
+    for start in range(0, len(ra), MATCH_CHUNK_SIZE):
+        chunk = slice(start, start + MATCH_CHUNK_SIZE)
+        nearest, separations[chunk] = catalog.match(ra[chunk], dec[chunk], radius)
+        pks[chunk] = np.where(nearest >= 0, catalog.pks[nearest], -1)
+
+    return pks, separations
+
+
+class CSVTextParser(BaseParser):
+    """
+    Passes text/csv request bodies on as text.
+    """
+
+    media_type = 'text/csv'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        return stream.read().decode('utf-8-sig')
+
+
+def parse_positions(rows):
+    """
+    Converts [ra, dec] pairs, or objects with 'ra' and 'dec', to arrays of
+    degrees. Raises ValueError for invalid positions.
+    """
+
+    positions = np.array([
+        (row['ra'], row['dec']) if isinstance(row, dict) else tuple(row)
+        for row in rows
+    ], dtype=np.float64).reshape(-1, 2)
+    ra, dec = positions[:, 0], positions[:, 1]
+
+    invalid = ~((ra >= 0) & (ra <= 360) & (dec >= -90) & (dec <= 90))
+
+    if invalid.any():
+        raise ValueError(f'Invalid position in row {int(np.argmax(invalid))}.')
+
+    return ra % 360, dec
+
+
+def read_csv_positions(text):
+    """
+    Reads the ra and dec columns of a CSV text, with a header row naming
+    them, or the first two columns when there is no header.
+    """
+
+    reader = csv.reader(io.StringIO(text))
+    rows = [row for row in reader if row]
+
+    if rows and not _is_number(rows[0][0]):
+        header = [name.strip().lower() for name in rows[0]]
+        columns = header.index('ra'), header.index('dec')
+        rows = rows[1:]
+    else:
+        columns = 0, 1
+
+    return [[row[column] for column in columns] for row in rows]
+
+
+def _is_number(value):
+    try:
+        float(value)
+    except ValueError:
+        return False
+
+    return True
+
+
+def iter_csv_results(ra, dec, pks, separations, chunk_size=MATCH_CHUNK_SIZE):
+    """
+    Yields the cross-match results as CSV text, a chunk of rows at a time.
+    """
+
+    yield 'row,ra,dec,galaxy,separation\r\n'
+
+    for start in range(0, len(ra), chunk_size):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+
+        for row in range(start, min(start + chunk_size, len(ra))):
+            matched = pks[row] >= 0
+            writer.writerow([
+                row, repr(float(ra[row])), repr(float(dec[row])),
+                int(pks[row]) if matched else '',
+                repr(float(separations[row])) if matched else '',
+            ])
+
+        yield buffer.getvalue()
+
+
+def iter_json_results(ra, dec, pks, separations, chunk_size=MATCH_CHUNK_SIZE):
+    """
+    Yields the cross-match results as a JSON array, a chunk of rows at a time.
+    """
+
+    yield '['
+
+    for start in range(0, len(ra), chunk_size):
+        yield (',' if start else '') + ','.join(
+            json.dumps({
+                'row': row,
+                'ra': float(ra[row]),
+                'dec': float(dec[row]),
+                'galaxy': int(pks[row]) if pks[row] >= 0 else None,
+                'separation': float(separations[row]) if pks[row] >= 0 else None,
+            })
+            for row in range(start, min(start + chunk_size, len(ra)))
+        )
+
+    yield ']'
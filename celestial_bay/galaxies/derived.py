@@ -0,0 +1,64 @@
+from math import pi
+
+from django.db.models import Case, F, FloatField, Func, Value, When
+
+
+# Parsecs in a thousand light-years, the unit of Galaxy.distance, and
+# radians in an arcminute, the unit of Galaxy.size.
+PARSECS_PER_KLY = 306.601
+RADIANS_PER_ARCMINUTE = pi / (180 * 60)
+
+
+class Log10(Func):
+    """
+    The base 10 logarithm, as the single argument log() of PostgreSQL.
+    """
+
+    function = 'LOG'
+    arity = 1
+    output_field = FloatField()
+
+
+def get_absolute_magnitude_expression():
+    """
+    The absolute magnitude of a galaxy, from its apparent magnitude and its
+    distance with the distance modulus, M = m - 5 log10(d / 10 pc), or NULL
+    without a distance.
+    """
+
+    return Case(
+        When(
+            distance__gt=0,
+            then=F('apparent_magnitude')
+            - Value(5.0) * Log10(F('distance') * Value(PARSECS_PER_KLY / 10)),
+        ),
+        output_field=FloatField(),
+    )
+
+
+def get_physical_size_expression():
+    """
+    The physical size of a galaxy in thousands of light-years, from its
+    angular size and its distance, with the small angle approximation.
+    """
+
+    return F('distance') * F('size') * Value(RADIANS_PER_ARCMINUTE)
+
+
+# The fields derived from the stored ones, by name. The expressions are
+# the same in the indexes and in the queries, so that the indexes are used.
+DERIVED_FIELDS = {
+    'absolute_magnitude': get_absolute_magnitude_expression,
+    'physical_size': get_physical_size_expression,
+}
+
+
+def annotate_derived_fields(queryset):
+    """
+    Annotates the galaxies of a queryset with the DERIVED_FIELDS, computed by
+    the database.
+    """
+
+    return queryset.annotate(**{
+        name: get_expression() for name, get_expression in DERIVED_FIELDS.items()
+    })
@@ -0,0 +1,188 @@
+from django.contrib.postgres.search import SearchHeadline, SearchQuery, SearchRank
+from django.db.models import F, FloatField
+from django.db.models.functions import Cast
+from django_filters import rest_framework as filters
+from rest_framework.filters import BaseFilterBackend, OrderingFilter
+
+from .classification import get_type_ids
+from .models import Galaxy, Post, Comment
+from .search import SEARCH_CONFIG
+
+
+class GalaxyFilter(filters.FilterSet):
+    """
+    Exact filters on type, constellation and owner, and range filters on
+    distance, apparent magnitude and the derived absolute magnitude and
+    physical size (see galaxies.derived).
+
+        e.g.  https://api.example.org/galaxies/?galaxy_type=SBb&distance__lte=3000
+
+    Types are given by name, in any case, or by code, and can be filtered
+    on with all the types under them in the Hubble classification too.
+
+        e.g.  https://api.example.org/galaxies/?galaxy_type_family=spiral
+    """
+
+    galaxy_type = filters.CharFilter(method='filter_galaxy_type')
+    galaxy_type_family = filters.CharFilter(method='filter_galaxy_type')
+
+    absolute_magnitude__gte = filters.NumberFilter(
+        field_name='absolute_magnitude', lookup_expr='gte'
+    )
+    absolute_magnitude__lte = filters.NumberFilter(
+        field_name='absolute_magnitude', lookup_expr='lte'
+    )
+    physical_size__gte = filters.NumberFilter(field_name='physical_size', lookup_expr='gte')
+    physical_size__lte = filters.NumberFilter(field_name='physical_size', lookup_expr='lte')
+
+    def filter_galaxy_type(self, queryset, name, value):
+        # The few types are looked up first, so that the galaxies are
+        # filtered on the indexed type codes.
+        return queryset.filter(
+            galaxy_type__in=get_type_ids(value, family=name == 'galaxy_type_family')
+        )
+
+    class Meta:
+        model = Galaxy
+        fields = {
+            'constellation': ['exact'],
+            'owner': ['exact'],
+            'distance': ['gte', 'lte'],
+            'apparent_magnitude': ['gte', 'lte'],
+        }
+
+
+class PostFilter(filters.FilterSet):
+    """
+    Exact filter on owner and date range filters on created and updated.
+
+        e.g.  https://api.example.org/posts/?owner=<uuid>&created__gte=2023-01-01
+    """
+
+    class Meta:
+        model = Post
+        fields = {
+            'owner': ['exact'],
+            'created': ['exact', 'gte', 'lte'],
+            'updated': ['gte', 'lte'],
+        }
+
+
+class CommentFilter(filters.FilterSet):
+    """
+    Exact filters on post and owner and a date range filter on created.
+
+        e.g.  https://api.example.org/comments/?post=1&created__gte=2023-01-01
+    """
+
+    class Meta:
+        model = Comment
+        fields = {
+            'post': ['exact'],
+            'owner': ['exact'],
+            'created': ['exact', 'gte', 'lte'],
+        }
+
+
+class StableOrderingFilter(OrderingFilter):
+    """
+    An OrderingFilter that breaks the ties of the requested ordering by
+    primary key, so that offset pages don't shift or repeat rows with the
+    same sort key between requests.
+
+    The primary key follows the direction of the last key, so that the
+    (key, id) indexes can be scanned either way.
+
+        e.g.  ?ordering=-distance orders by (-distance, -pk)
+    """
+
+    def get_ordering(self, request, queryset, view):
+        ordering = super().get_ordering(request, queryset, view)
+
+        if ordering and not any(field.lstrip('-') in ('pk', 'id') for field in ordering):
+            ordering = [*ordering, '-pk' if ordering[-1].startswith('-') else 'pk']
+
+        return ordering
+
+
+class FullTextSearchFilter(BaseFilterBackend):
+    """
+    Full-text search on the stored, GIN indexed search_vector column.
+
+    The search term uses the web search syntax ("quoted phrases", -exclusion,
+    or). Matching rows are ordered by rank unless the request asks for an
+    explicit ordering. The rank is only an alias, and the search query is
+    kept on the view, so that the rows of the returned page alone get their
+    search_rank and search_headline (see annotate_search_results()) rather
+    than every match, as in the pagination count.
+
+        e.g.  https://api.example.org/posts/?search=andromeda collision
+    """
+
+    search_param = 'search'
+    search_description = 'A full-text search term.'
+    ordering_param = 'ordering'
+
+    def get_search_term(self, request):
+        return request.query_params.get(self.search_param, '').strip()
+
+    def filter_queryset(self, request, queryset, view):
+        search_term = self.get_search_term(request)
+
+        if not search_term:
+            return queryset
+
+        query = SearchQuery(search_term, search_type='websearch', config=SEARCH_CONFIG)
+        view.search_query = query
+
+        # As a double, which the cursors of the keyset pagination carry
+        # without losing precision, unlike the real of ts_rank().
+        queryset = queryset.filter(search_vector=query).alias(
+            search_rank=Cast(SearchRank(F('search_vector'), query), FloatField()),
+        )
+
+        if self.ordering_param not in request.query_params:
+            queryset = queryset.order_by('-search_rank', '-pk')
+
+        return queryset
+
+    def get_schema_operation_parameters(self, view):
+        return [
+            {
+                'name': self.search_param,
+                'required': False,
+                'in': 'query',
+                'description': self.search_description,
+                'schema': {'type': 'string'},
+            },
+        ]
+
+
+def annotate_search_results(rows, query, headline_field):
+    """
+    Sets the search_rank and a search_headline snippet of headline_field,
+    with the matched words highlighted, on the rows of a page of search
+    results, with a single query by pk.
+    """
+
+    if not rows:
+        return
+
+    model = type(rows[0])
+    annotations = {
+        pk: (rank, headline) for pk, rank, headline in
+        model._default_manager.filter(pk__in=[row.pk for row in rows]).annotate(
+            search_rank=Cast(SearchRank(F('search_vector'), query), FloatField()),
+            search_headline=SearchHeadline(
+                headline_field,
+                query,
+                config=SEARCH_CONFIG,
+                start_sel='<mark>',
+                stop_sel='</mark>',
+                max_fragments=2,
+            ),
+        ).values_list('pk', 'search_rank', 'search_headline')
+    }
+
+    for row in rows:
+        row.search_rank, row.search_headline = annotations.get(row.pk, (None, None))
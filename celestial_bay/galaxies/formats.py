@@ -0,0 +1,114 @@
+from io import BytesIO
+
+from django.conf import settings
+from PIL import Image
+
+
+# The modern formats renditions are also encoded to, from the most to the
+# least preferred: (name, Pillow format, media type).
+IMAGE_FORMATS = (
+    ('avif', 'AVIF', 'image/avif'),
+    ('webp', 'WEBP', 'image/webp'),
+)
+
+# The encoder options of each format, overridable with
+# GALAXIES_RENDITIONS['FORMATS']. Formats missing from it are not generated.
+DEFAULT_FORMAT_OPTIONS = {
+    'avif': {'quality': 60},
+    'webp': {'quality': 80, 'method': 4},
+}
+
+
+def get_supported_formats():
+    """
+    Returns the encoder options of the enabled formats the Pillow build can
+    encode, by name, from the most to the least preferred.
+    """
+
+    options = getattr(settings, 'GALAXIES_RENDITIONS', {}).get(
+        'FORMATS', DEFAULT_FORMAT_OPTIONS
+    )
+    Image.init()
+
+    return {
+        name: options[name]
+        for name, pillow_format, _ in IMAGE_FORMATS
+        if name in options and pillow_format in Image.SAVE
+    }
+
+
+def encode_image(image, name):
+    """
+    Encodes a Pillow image to one of the supported formats and returns the
+    bytes.
+    """
+
+    pillow_format = next(
+        pillow_format for format_name, pillow_format, _ in IMAGE_FORMATS
+        if format_name == name
+    )
+
+    if image.mode not in ('RGB', 'RGBA'):
+        has_alpha = image.mode in ('LA', 'PA') or 'transparency' in image.info
+        image = image.convert('RGBA' if has_alpha else 'RGB')
+
+    buffer = BytesIO()
+    image.save(buffer, format=pillow_format, **get_supported_formats()[name])
+
+    return buffer.getvalue()
+
+
+def parse_accept(header):
+    """
+    Returns the quality value of each media type of an Accept header.
+    """
+
+    accepted = {}
+
+    for part in header.split(','):
+        media_type, *params = [item.strip() for item in part.split(';')]
+        quality = 1.0
+
+        for param in params:
+            key, _, value = param.partition('=')
+
+            if key.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+
+        if media_type:
+            accepted[media_type.lower()] = quality
+
+    return accepted
+
+
+def get_accepted_image_format(request):
+    """
+    Returns the name of the best supported image format that the request's
+    Accept header lists explicitly, or None for the original formats.
+
+    API clients ask for modern image URLs by adding the image media types to
+    the Accept header of the JSON request, e.g.
+
+        Accept: application/json, image/avif, image/webp
+
+    Wildcards such as image/* don't count, so clients that don't know about
+    it keep getting the original formats.
+    """
+
+    if request is None:
+        return None
+
+    if not hasattr(request, '_accepted_image_format'):
+        accepted = parse_accept(request.META.get('HTTP_ACCEPT', ''))
+        supported = get_supported_formats()
+        candidates = [
+            (accepted[media_type], -preference, name)
+            for preference, (name, _, media_type) in enumerate(IMAGE_FORMATS)
+            if name in supported and accepted.get(media_type, 0) > 0
+        ]
+        request._accepted_image_format = max(candidates)[2] if candidates else None
+
+    return request._accepted_image_format
@@ -0,0 +1,99 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from PIL import Image
+
+from galaxies.formats import encode_image, get_supported_formats
+from galaxies.renditions import IMAGE_MODELS
+
+
+class Command(BaseCommand):
+    help = (
+        'Encodes a sample set of images to the supported modern formats and '
+        'reports the bytes saved against the originals and the encode time '
+        'per image. The sample set is the given files and directories, or '
+        'the uploaded images.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='*')
+        parser.add_argument(
+            '--limit', type=int, default=100, help='The maximum number of images.'
+        )
+        parser.add_argument(
+            '--repeat', type=int, default=3, help='Encodes per image, the fastest counts.'
+        )
+
+    def get_sample(self, paths, limit):
+        if paths:
+            for path in paths:
+                if os.path.isdir(path):
+                    for root, _, names in os.walk(path):
+                        for name in sorted(names):
+                            yield os.path.join(root, name)
+                else:
+                    yield path
+            return
+
+        for model in IMAGE_MODELS:
+            for instance in model._default_manager.exclude(image='')[:limit]:
+                yield instance.image.path
+
+    def handle(self, *args, paths, limit, repeat, **options):
+        formats = list(get_supported_formats())
+
+        if not formats:
+            raise CommandError('Pillow can encode none of the enabled formats.')
+
+        totals = {name: [0, 0.0] for name in formats}
+        original_total, count = 0, 0
+
+        self.stdout.write(
+            f'{"image":<40} {"original":>10}'
+            + ''.join(f' {name:>10} {"saved":>7} {"ms":>7}' for name in formats)
+        )
+
+        for path in self.get_sample(paths, limit):
+            if count >= limit:
+                break
+
+            try:
+                image = Image.open(path)
+                image.load()
+            except (OSError, SyntaxError):
+                continue
+
+            original_size = os.path.getsize(path)
+            original_total += original_size
+            count += 1
+            row = f'{os.path.basename(path)[:40]:<40} {original_size:>10}'
+
+            for name in formats:
+                timings = []
+
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    content = encode_image(image, name)
+                    timings.append(time.perf_counter() - start)
+
+                size, elapsed = len(content), min(timings)
+                totals[name][0] += size
+                totals[name][1] += elapsed
+                row += f' {size:>10} {1 - size / original_size:>7.1%} {elapsed * 1000:>7.1f}'
+
+            self.stdout.write(row)
+
+        if not count:
+            raise CommandError('No images to benchmark.')
+
+        row = f'{f"total of {count}":<40} {original_total:>10}'
+        for name in formats:
+            size, elapsed = totals[name]
+            row += (
+                f' {size:>10} {1 - size / original_total:>7.1%}'
+                f' {elapsed * 1000 / count:>7.1f}'
+            )
+
+        self.stdout.write(row)
+        self.stdout.write('(the total ms is the mean encode time per image)')
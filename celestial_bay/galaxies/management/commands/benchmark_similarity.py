@@ -0,0 +1,73 @@
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from galaxies.similarity import FeatureMatrix
+
+
+class Command(BaseCommand):
+    help = (
+        'Reports the time to build the feature matrix of the similar galaxies '
+        'search, to refresh it with changed galaxies and to find the most '
+        'similar ones, for synthetic catalogs of the given sizes.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes', type=int, nargs='+', default=[10000, 100000, 1000000],
+            help='The numbers of galaxies of the catalogs.'
+        )
+        parser.add_argument(
+            '--queries', type=int, default=100, help='Searches per catalog, the median counts.'
+        )
+        parser.add_argument('--limit', type=int, default=10, help='Galaxies per search.')
+        parser.add_argument(
+            '--changes', type=int, default=100, help='Galaxies changed per refresh.'
+        )
+
+    def get_rows(self, generator, pks):
+        return list(zip(
+            pks.tolist(),
+            generator.lognormal(7, 2, len(pks)).tolist(),
+            generator.uniform(0, 20, len(pks)).tolist(),
+            generator.lognormal(3, 1, len(pks)).tolist(),
+            generator.integers(1, 26, len(pks)).tolist(),
+            generator.integers(1, 89, len(pks)).tolist(),
+        ))
+
+    def handle(self, *args, sizes, queries, limit, changes, **options):
+        generator = np.random.default_rng(0)
+
+        self.stdout.write(
+            f'{"galaxies":>10} {"build ms":>10} {"refresh ms":>11} {"search ms":>10}'
+        )
+
+        for size in sizes:
+            rows = self.get_rows(generator, np.arange(1, size + 1))
+
+            start = time.perf_counter()
+            matrix = FeatureMatrix.from_rows(rows)
+            build = time.perf_counter() - start
+
+            changed = generator.choice(matrix.pks, min(changes, size), replace=False)
+            start = time.perf_counter()
+            matrix = matrix.refreshed(changed, self.get_rows(generator, changed), None)
+            refresh = time.perf_counter() - start
+
+            timings = []
+
+            for index in generator.integers(0, size, queries):
+                start = time.perf_counter()
+                matrix.nearest(
+                    matrix.features[:, index] * matrix.scales, int(matrix.types[index]),
+                    int(matrix.constellations[index]), limit, exclude=int(matrix.pks[index])
+                )
+                timings.append(time.perf_counter() - start)
+
+            self.stdout.write(
+                f'{size:>10} {build * 1000:>10.1f} {refresh * 1000:>11.1f}'
+                f' {np.median(timings) * 1000:>10.2f}'
+            )
+
+        self.stdout.write('(building excludes reading the rows from the database)')
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from galaxies.uploads import delete_expired_sessions
+
+
+class Command(BaseCommand):
+    help = (
+        'Deletes the expired resumable upload sessions with their incomplete '
+        'files. Meant to be run periodically, e.g. hourly from cron.'
+    )
+
+    def handle(self, *args, **options):
+        self.stdout.write(f'{delete_expired_sessions()} expired upload sessions deleted')
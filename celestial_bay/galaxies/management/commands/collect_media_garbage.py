@@ -0,0 +1,45 @@
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+
+from galaxies.media import delete_orphaned_file, find_orphaned_files
+
+
+class Command(BaseCommand):
+    help = (
+        'Deletes the images and renditions in MEDIA_ROOT that no image row '
+        'refers to, scanning the directories with parallel threads. With '
+        '--dry-run, only reports them.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true')
+        parser.add_argument('--workers', type=int, default=8)
+        parser.add_argument(
+            '--min-age', type=int, default=60 * 60,
+            help='Seconds since their last change before files can be deleted.'
+        )
+
+    def handle(self, *args, dry_run, workers, min_age, **options):
+        orphaned = find_orphaned_files(workers=workers, min_age=min_age)
+        deleted, freed = 0, 0
+
+        for name, size in orphaned:
+            if dry_run:
+                self.stdout.write(f'{name} ({size} bytes)')
+                continue
+
+            try:
+                if not delete_orphaned_file(default_storage, name, min_age=min_age):
+                    continue
+            except OSError as error:
+                self.stderr.write(f'{name}: {error}')
+                continue
+
+            deleted += 1
+            freed += size
+
+        if dry_run:
+            total = sum(size for _, size in orphaned)
+            self.stdout.write(f'{len(orphaned)} orphaned files, {total} bytes would be freed')
+        else:
+            self.stdout.write(f'{deleted} orphaned files deleted, {freed} bytes freed')
@@ -0,0 +1,44 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from galaxies.crossmatch import cross_match, iter_csv_results, iter_json_results,\
+    parse_positions, read_csv_positions
+from galaxies.sky import get_sky_settings
+
+
+class Command(BaseCommand):
+    help = (
+        'Cross-matches a CSV (with ra and dec columns) or JSON file of positions, '
+        'in degrees, with the nearest galaxy within the radius, and writes the '
+        'results to the standard output.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument(
+            '--radius', type=float, default=None,
+            help='The match radius in degrees, 5 arcsec by default.'
+        )
+        parser.add_argument('--format', choices=('csv', 'json'), default='csv')
+
+    def handle(self, *args, path, radius, format, **options):
+        with open(path, encoding='utf-8-sig') as file:
+            text = file.read()
+
+        try:
+            rows = json.loads(text) if path.endswith('.json') else read_csv_positions(text)
+            ra, dec = parse_positions(rows)
+        except (ValueError, KeyError, TypeError, IndexError) as error:
+            raise CommandError(f'Invalid positions: {error}')
+
+        if radius is None:
+            radius = get_sky_settings()['CROSS_MATCH_RADIUS']
+
+        pks, separations = cross_match(ra, dec, radius)
+        results = iter_csv_results if format == 'csv' else iter_json_results
+
+        for chunk in results(ra, dec, pks, separations):
+            self.stdout.write(chunk, ending='')
+
+        self.stderr.write(f'{int((pks >= 0).sum())} of {len(pks)} positions matched')
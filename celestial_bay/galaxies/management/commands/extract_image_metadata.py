@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand
+
+from galaxies.metadata import extract_metadata
+from galaxies.renditions import IMAGE_MODELS
+
+
+class Command(BaseCommand):
+    help = (
+        'Reads the dimensions, byte size, content hash and blurhash of the '
+        'images uploaded before they were recorded at upload.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, batch_size, **options):
+        for model in IMAGE_MODELS:
+            queryset = model._default_manager.exclude(image='').filter(sha256='')
+            updated, failed, last_pk = 0, 0, None
+
+            while True:
+                batch = queryset.order_by('pk')
+
+                if last_pk is not None:
+                    batch = batch.filter(pk__gt=last_pk)
+
+                instances = list(batch.only('image')[:batch_size])
+
+                if not instances:
+                    break
+
+                for instance in instances:
+                    try:
+                        with instance.image.open('rb') as file:
+                            metadata = extract_metadata(file)
+                    except Exception as error:
+                        failed += 1
+                        self.stderr.write(f'{instance.image.name}: {error}')
+                        continue
+
+                    updated += model._default_manager.filter(pk=instance.pk).update(
+                        **metadata
+                    )
+
+                last_pk = instances[-1].pk
+
+            self.stdout.write(
+                f'{model._meta.verbose_name_plural}: {updated} updated, {failed} failed'
+            )
@@ -0,0 +1,88 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from galaxies.cache import invalidate_in_bulk
+from galaxies.media import release_files
+from galaxies.renditions import IMAGE_MODELS
+from galaxies.storage import get_content_digest
+
+
+def migrate_file(model, pk):
+    """
+    Stores the image of a row under its content addressed name, points the
+    row to it and releases the old file with its renditions. Returns whether
+    the row was moved.
+    """
+
+    try:
+        instance = model._default_manager.filter(pk=pk).first()
+
+        if instance is None or not instance.image:
+            return False
+
+        storage, old_name = instance.image.storage, instance.image.name
+        upload_dir = model._meta.get_field('image').upload_to.strip('/')
+
+        with storage.open(old_name) as file:
+            new_name = storage.save(f'{upload_dir}/{os.path.basename(old_name)}', file)
+
+        moved = model._default_manager.filter(pk=pk, image=old_name).update(
+            image=new_name,
+            sha256=get_content_digest(new_name),
+            # The renditions are named after the original, so they are
+            # generated again under the new name.
+            renditions={},
+            renditions_ready=False,
+        )
+
+        if moved:
+            invalidate_in_bulk(model, [pk])
+            release_files(storage, old_name, instance.renditions or {})
+
+        return bool(moved)
+    finally:
+        # Each thread has its own database connection.
+        connections.close_all()
+
+
+class Command(BaseCommand):
+    help = (
+        'Moves the images stored under their upload names into the content '
+        'addressed, sharded layout, with parallel threads, deduplicating them. '
+        'Can be interrupted and run again. Run warm_renditions afterwards.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=8)
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, workers, batch_size, **options):
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for model in IMAGE_MODELS:
+                queryset = model._default_manager.exclude(image='').exclude(
+                    image__regex=r'[0-9a-f]{64}\.\w+$'
+                ).order_by('pk')
+                total, done, moved, last_pk = queryset.count(), 0, 0, None
+
+                while True:
+                    batch = queryset
+
+                    if last_pk is not None:
+                        batch = batch.filter(pk__gt=last_pk)
+
+                    pks = list(batch.values_list('pk', flat=True)[:batch_size])
+
+                    if not pks:
+                        break
+
+                    for result in executor.map(lambda pk: migrate_file(model, pk), pks):
+                        done += 1
+                        moved += result
+
+                    self.stdout.write(f'{model._meta.verbose_name_plural}: {done}/{total}')
+                    last_pk = pks[-1]
+
+                self.stdout.write(f'{model._meta.verbose_name_plural}: {moved} moved')
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from galaxies.classification import classify_galaxies
+
+
+class Command(BaseCommand):
+    help = (
+        'Sets the galaxy type of the galaxies that only have a legacy free-text '
+        'type, in batches, matching the names case-insensitively and creating '
+        'unclassified types for the unknown ones.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, batch_size, **options):
+        classified = classify_galaxies(batch_size=batch_size)
+
+        self.stdout.write(f'galaxies: {classified} classified')
@@ -0,0 +1,26 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+
+from galaxies.purge import purge_user
+
+
+class Command(BaseCommand):
+    help = (
+        'Purges the users marked for deletion, with their galaxies and images, '
+        'in batches. Picks up the purges that were interrupted.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+
+    def handle(self, *args, batch_size, **options):
+        pks = get_user_model()._default_manager.filter(
+            deletion_requested__isnull=False
+        ).values_list('pk', flat=True)
+
+        for pk in list(pks):
+            purged = purge_user(pk, batch_size=batch_size)
+
+            self.stdout.write(f'{pk}: ' + ', '.join(
+                f'{label} {count}' for label, count in purged.items()
+            ))
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+
+from galaxies.cache import invalidate_in_bulk
+from galaxies.sky import SKY_OBJECTS, update_sky_index
+
+
+class Command(BaseCommand):
+    help = (
+        'Recomputes the sky index keys of the galaxies from their positions, '
+        'in batches, e.g. after changing the zone height.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10000)
+
+    def handle(self, *args, batch_size, **options):
+        for model in SKY_OBJECTS:
+            queryset = model._default_manager.order_by('pk')
+            updated, last_pk = 0, None
+
+            while True:
+                batch = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+                pks = list(batch.values_list('pk', flat=True)[:batch_size])
+
+                if not pks:
+                    break
+
+                updated += update_sky_index(model._default_manager.filter(pk__in=pks))
+                invalidate_in_bulk(model, pks)
+                last_pk = pks[-1]
+
+            self.stdout.write(f'{model._meta.verbose_name_plural}: {updated} updated')
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from galaxies.tiles import rebuild_tiles
+
+
+class Command(BaseCommand):
+    help = (
+        'Recomputes the sky map tiles of every level from the galaxies, e.g. '
+        'after changing the tile levels. Galaxies can\'t be written to while '
+        'it runs.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, batch_size, **options):
+        self.stdout.write(f'sky tiles: {rebuild_tiles(batch_size=batch_size)} rebuilt')
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from galaxies.counters import get_counters, reconcile
+
+
+class Command(BaseCommand):
+    help = (
+        'Recounts the denormalized counters, e.g. the comment count of posts, '
+        'in batches and fixes the rows that have drifted.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000)
+
+    def handle(self, *args, batch_size, **options):
+        for counted_model, fk, counter_field in get_counters():
+            fixed = reconcile(counted_model, fk, counter_field, batch_size)
+
+            self.stdout.write(
+                f'{fk.related_model._meta.verbose_name_plural}.{counter_field}: '
+                f'{fixed} fixed'
+            )
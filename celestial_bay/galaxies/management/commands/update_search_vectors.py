@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+
+from galaxies.search import SEARCH_DOCUMENTS, update_search_vector
+
+
+class Command(BaseCommand):
+    help = (
+        'Rebuilds the stored full-text search vectors of posts and comments in '
+        'batches, e.g. after a bulk import or a change of the search documents.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument(
+            '--missing-only',
+            action='store_true',
+            help='Only fill in rows that have no search vector yet.'
+        )
+
+    def handle(self, *args, batch_size, missing_only, **options):
+        for model in SEARCH_DOCUMENTS:
+            queryset = model._default_manager.order_by('pk')
+
+            if missing_only:
+                queryset = queryset.filter(search_vector__isnull=True)
+
+            updated, last_pk = 0, None
+
+            while True:
+                batch = queryset
+
+                if last_pk is not None:
+                    batch = batch.filter(pk__gt=last_pk)
+
+                pks = list(batch.values_list('pk', flat=True)[:batch_size])
+
+                if not pks:
+                    break
+
+                updated += update_search_vector(
+                    model._default_manager.filter(pk__in=pks)
+                )
+                last_pk = pks[-1]
+
+            self.stdout.write(f'{model._meta.verbose_name_plural}: {updated} updated')
@@ -0,0 +1,72 @@
+from concurrent.futures import as_completed
+
+from django.core.management.base import BaseCommand
+
+from galaxies.renditions import IMAGE_MODELS, create_executor
+from galaxies.workers import generate_renditions
+
+
+class Command(BaseCommand):
+    help = (
+        'Generates the renditions of the images that are not ready yet in '
+        'parallel, e.g. after an import. Images are marked as ready as they '
+        'are done, so an interrupted run resumes where it stopped.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=None)
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument(
+            '--all',
+            action='store_true',
+            dest='check_all',
+            help='Check all images, even ready ones, creating missing renditions.'
+        )
+
+    def handle(self, *args, workers, batch_size, check_all, **options):
+        with create_executor(workers) as executor:
+            for model in IMAGE_MODELS:
+                queryset = model._default_manager.exclude(image='').order_by('pk')
+
+                if not check_all:
+                    queryset = queryset.filter(renditions_ready=False)
+
+                total, done, failed, last_pk = queryset.count(), 0, 0, None
+
+                while True:
+                    batch = queryset
+
+                    if last_pk is not None:
+                        batch = batch.filter(pk__gt=last_pk)
+
+                    pks = list(batch.values_list('pk', flat=True)[:batch_size])
+
+                    if not pks:
+                        break
+
+                    futures = {
+                        executor.submit(generate_renditions, model._meta.label, pk): pk
+                        for pk in pks
+                    }
+
+                    for future in as_completed(futures):
+                        done += 1
+
+                        try:
+                            failed += not future.result()
+                        except Exception as error:
+                            # A bad image doesn't stop the others.
+                            failed += 1
+                            self.stderr.write(
+                                f'{model._meta.verbose_name} {futures[future]}: {error!r}'
+                            )
+
+                    self.stdout.write(
+                        f'{model._meta.verbose_name_plural}: {done}/{total}'
+                    )
+                    last_pk = pks[-1]
+
+                self.stdout.write(
+                    f'{model._meta.verbose_name_plural}: {done - failed} ready, '
+                    f'{failed} failed'
+                )
@@ -0,0 +1,273 @@
+import logging
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import reduce
+from operator import or_
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from versatileimagefield.settings import VERSATILEIMAGEFIELD_FILTERED_DIRNAME,\
+    VERSATILEIMAGEFIELD_SIZED_DIRNAME
+
+from .formats import IMAGE_FORMATS
+from .renditions import IMAGE_MODELS, get_rendition_sizes
+from .storage import get_content_digest, lock_content
+
+
+logger = logging.getLogger(__name__)
+
+# A content hash anywhere in a name, as in the content addressed originals
+# and in the renditions and variants named after them.
+FINGERPRINT_REGEX = re.compile(r'(?:^|/)(?P<digest>[0-9a-f]{64})(?:[-.][^/]*)?$')
+
+
+def count_references(name):
+    """
+    Returns the number of image rows that refer to a stored file.
+
+    The count is taken from the rows themselves, so it can't drift. Content
+    addressed names are looked up by the indexed content hash.
+    """
+
+    digest = get_content_digest(name)
+    lookup = {'sha256': digest, 'image': name} if digest else {'image': name}
+
+    return sum(model._default_manager.filter(**lookup).count() for model in IMAGE_MODELS)
+
+
+def get_rendition_keys():
+    """
+    The keys a stored file can have in a rendition index, e.g.
+    'thumbnail__100x100' or 'url@webp'.
+    """
+
+    sizes = get_rendition_sizes()
+
+    return sizes + [
+        f'{size_key}@{format_name}'
+        for size_key in ['url'] + sizes
+        for format_name, _, _ in IMAGE_FORMATS
+    ]
+
+
+def is_referenced(name):
+    """
+    Whether a stored file is the image, or is in the rendition index, of any
+    image row.
+
+    The renditions are looked up by containment in the rendition indexes.
+    Names that carry a content hash only look at the rows with that hash.
+    """
+
+    fingerprint = FINGERPRINT_REGEX.search(name)
+    lookup = reduce(or_, [
+        Q(image=name),
+        *(Q(renditions__contains={key: name}) for key in get_rendition_keys()),
+    ])
+
+    if fingerprint:
+        lookup &= Q(sha256=fingerprint.group('digest'))
+
+    return any(model._default_manager.filter(lookup).exists() for model in IMAGE_MODELS)
+
+
+def lock_fingerprint(name):
+    """
+    Takes the lock of the content a stored file is named after, if any (see
+    galaxies.storage.lock_content), for the rest of the transaction.
+    """
+
+    fingerprint = FINGERPRINT_REGEX.search(name)
+
+    if fingerprint:
+        lock_content(fingerprint.group('digest'))
+
+
+def release_files(storage, name, renditions):
+    """
+    Deletes a stored image, with the renditions and variants listed in its
+    rendition index, unless another row still refers to it. Returns whether
+    it was deleted.
+
+    The references are counted under the lock of the content, so that an
+    upload of the same content can't link the image to a new row between
+    the count and the delete.
+    """
+
+    if not name:
+        return False
+
+    with transaction.atomic():
+        lock_fingerprint(name)
+
+        if count_references(name):
+            return False
+
+        for file_name in {name, *renditions.values()}:
+            try:
+                storage.delete(file_name)
+            except OSError:
+                logger.exception('Failed to delete %s', file_name)
+
+    return True
+
+
+def _release_on_commit(storage, name, renditions):
+    transaction.on_commit(lambda: release_files(storage, name, renditions))
+
+
+def release_files_on_delete(sender, instance, **kwargs):
+    """
+    post_delete receiver that releases the files of a deleted image row once
+    the transaction commits.
+    """
+
+    _release_on_commit(instance.image.storage, instance.image.name, instance.renditions or {})
+
+
+def release_replaced_files(sender, instance, raw=False, **kwargs):
+    """
+    post_save receiver that releases the files of a replaced image once the
+    transaction commits (see galaxies.renditions.reset_renditions_on_change).
+    """
+
+    replaced_files = getattr(instance, '_replaced_files', None)
+
+    if raw or replaced_files is None:
+        return
+
+    _release_on_commit(instance.image.storage, *replaced_files)
+
+
+def get_media_directories():
+    """
+    The directories of MEDIA_ROOT that hold images and their renditions, the
+    only ones the garbage collector looks at.
+    """
+
+    upload_dirs = {
+        model._meta.get_field('image').upload_to.strip('/') for model in IMAGE_MODELS
+    }
+
+    return sorted(upload_dirs | {
+        VERSATILEIMAGEFIELD_SIZED_DIRNAME, VERSATILEIMAGEFIELD_FILTERED_DIRNAME
+    })
+
+
+def get_referenced_names():
+    """
+    The names of all the images and renditions the image rows refer to.
+    """
+
+    names = set()
+
+    for model in IMAGE_MODELS:
+        rows = model._default_manager.values_list('image', 'renditions')
+
+        for name, renditions in rows.iterator(chunk_size=2000):
+            names.add(name)
+            names.update((renditions or {}).values())
+
+    return names
+
+
+def list_directory(root, directory):
+    """
+    Returns the subdirectories of a directory of MEDIA_ROOT, and the (name,
+    size, modification time) of its files, skipping the hidden ones.
+    """
+
+    directories, files = [], []
+
+    try:
+        entries = list(os.scandir(os.path.join(root, directory)))
+    except FileNotFoundError:
+        return directories, files
+
+    for entry in entries:
+        if entry.name.startswith('.'):
+            continue
+
+        name = f'{directory}/{entry.name}'
+
+        if entry.is_dir(follow_symlinks=False):
+            directories.append(name)
+        elif entry.is_file(follow_symlinks=False):
+            stat = entry.stat(follow_symlinks=False)
+            files.append((name, stat.st_size, stat.st_mtime))
+
+    return directories, files
+
+
+def scan_directory(root, directory):
+    """
+    Lists the files below a directory of MEDIA_ROOT, as list_directory does.
+    """
+
+    files, pending = [], [directory]
+
+    while pending:
+        directories, directory_files = list_directory(root, pending.pop())
+        pending.extend(directories)
+        files.extend(directory_files)
+
+    return files
+
+
+def find_orphaned_files(workers=8, min_age=60 * 60):
+    """
+    Returns the (name, size) of the images and renditions in MEDIA_ROOT that
+    no image row refers to any more.
+
+    The directory trees are scanned by parallel threads, one shard at a time,
+    and compared with the names of all rows at once. Files younger than
+    min_age seconds are left alone, since their rows may not be committed
+    yet, and the candidates are checked against the database again one by
+    one, in case a row has started to refer to one in the meantime.
+    """
+
+    root = settings.MEDIA_ROOT
+    started = time.time()
+    referenced = get_referenced_names()
+    shards, files = [], []
+
+    for directory in get_media_directories():
+        directories, directory_files = list_directory(root, directory)
+        shards.extend(directories)
+        files.extend(directory_files)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for shard_files in executor.map(lambda shard: scan_directory(root, shard), shards):
+            files.extend(shard_files)
+
+    return sorted(
+        (name, size) for name, size, modified in files
+        if name not in referenced and modified < started - min_age
+        and not is_referenced(name)
+    )
+
+
+def delete_orphaned_file(storage, name, min_age=60 * 60):
+    """
+    Deletes a file found by find_orphaned_files(), unless it has been stored
+    or referred to since, checked under the lock of its content. Returns
+    whether it was deleted.
+    """
+
+    with transaction.atomic():
+        lock_fingerprint(name)
+
+        try:
+            modified = os.stat(storage.path(name)).st_mtime
+        except FileNotFoundError:
+            return False
+
+        if modified >= time.time() - min_age or is_referenced(name):
+            return False
+
+        storage.delete(name)
+
+    return True
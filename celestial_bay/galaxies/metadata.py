@@ -0,0 +1,156 @@
+import logging
+from hashlib import sha256
+from math import cos, pi
+
+from PIL import Image
+
+
+logger = logging.getLogger(__name__)
+
+BASE83_CHARACTERS = (
+    '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz#$%*+,-.:;=?@[]^_{|}~'
+)
+
+# The number of horizontal and vertical components of the blurhashes, and
+# the size of the thumbnail they are computed from.
+BLURHASH_COMPONENTS = (4, 3)
+BLURHASH_SAMPLE_SIZE = (32, 32)
+
+
+def _base83(value, length):
+    return ''.join(
+        BASE83_CHARACTERS[value // 83 ** (length - i) % 83]
+        for i in range(1, length + 1)
+    )
+
+
+def _srgb_to_linear(value):
+    value = value / 255
+
+    return value / 12.92 if value <= 0.04045 else ((value + 0.055) / 1.055) ** 2.4
+
+
+def _linear_to_srgb(value):
+    value = min(max(value, 0.0), 1.0)
+
+    if value <= 0.0031308:
+        return int(value * 12.92 * 255 + 0.5)
+
+    return int((1.055 * value ** (1 / 2.4) - 0.055) * 255 + 0.5)
+
+
+def _sign_pow(value, exponent):
+    return abs(value) ** exponent * (1 if value >= 0 else -1)
+
+
+def encode_blurhash(image, components=BLURHASH_COMPONENTS):
+    """
+    Returns the blurhash (https://blurha.sh) of a small RGB Pillow image, a
+    string of about 30 characters clients can decode into a blurred
+    placeholder while the image loads.
+    """
+
+    components_x, components_y = components
+    width, height = image.size
+    pixels = [
+        tuple(_srgb_to_linear(channel) for channel in pixel)
+        for pixel in image.getdata()
+    ]
+    factors = []
+
+    for j in range(components_y):
+        basis_y = [cos(pi * j * y / height) for y in range(height)]
+
+        for i in range(components_x):
+            basis_x = [cos(pi * i * x / width) for x in range(width)]
+            factor = [0.0, 0.0, 0.0]
+
+            for index, pixel in enumerate(pixels):
+                basis = basis_y[index // width] * basis_x[index % width]
+                factor[0] += basis * pixel[0]
+                factor[1] += basis * pixel[1]
+                factor[2] += basis * pixel[2]
+
+            scale = (1 if i == j == 0 else 2) / (width * height)
+            factors.append([channel * scale for channel in factor])
+
+    dc, ac = factors[0], factors[1:]
+    blurhash = _base83((components_x - 1) + (components_y - 1) * 9, 1)
+
+    if ac:
+        actual_maximum = max(abs(channel) for factor in ac for channel in factor)
+        quantised_maximum = max(0, min(82, int(actual_maximum * 166 - 0.5)))
+        maximum = (quantised_maximum + 1) / 166
+        blurhash += _base83(quantised_maximum, 1)
+    else:
+        maximum = 1
+        blurhash += _base83(0, 1)
+
+    blurhash += _base83(
+        (_linear_to_srgb(dc[0]) << 16) + (_linear_to_srgb(dc[1]) << 8)
+        + _linear_to_srgb(dc[2]),
+        4
+    )
+
+    for factor in ac:
+        quantised = [
+            max(0, min(18, int(_sign_pow(channel / maximum, 0.5) * 9 + 9.5)))
+            for channel in factor
+        ]
+        blurhash += _base83(quantised[0] * 19 * 19 + quantised[1] * 19 + quantised[2], 2)
+
+    return blurhash
+
+
+def extract_metadata(file):
+    """
+    Reads the width, height, byte size, SHA-256 content hash and blurhash of
+    an image file, in a single pass over its bytes and a downsampled decode.
+    """
+
+    digest, byte_size = sha256(), 0
+
+    file.seek(0)
+    for chunk in file.chunks():
+        digest.update(chunk)
+        byte_size += len(chunk)
+
+    file.seek(0)
+    with Image.open(file) as image:
+        width, height = image.size
+        # Lets JPEGs be decoded at a fraction of their size.
+        image.draft('RGB', BLURHASH_SAMPLE_SIZE)
+        sample = image.convert('RGB')
+        sample.thumbnail(BLURHASH_SAMPLE_SIZE)
+    file.seek(0)
+
+    return {
+        'width': width,
+        'height': height,
+        'byte_size': byte_size,
+        'sha256': digest.hexdigest(),
+        'blurhash': encode_blurhash(sample),
+    }
+
+
+def extract_metadata_on_upload(sender, instance, raw=False, **kwargs):
+    """
+    pre_save receiver that records the metadata of a newly uploaded image,
+    while its file is still at hand, before it is written to the storage.
+    """
+
+    image = instance.image
+
+    if raw or not image or image._committed:
+        return
+
+    try:
+        metadata = extract_metadata(image)
+    except Exception:
+        logger.exception('Failed to read the metadata of %s', image.name)
+        metadata = {
+            'width': None, 'height': None, 'byte_size': None, 'sha256': '', 'blurhash': '',
+        }
+
+    for name, value in metadata.items():
+        setattr(instance, name, value)
@@ -0,0 +1,111 @@
+"""
+The migration of existing databases from the free-text Galaxy.galaxy_type
+to GalaxyType.
+
+The migrations aren't kept in the repository, and the one makemigrations
+generates for the change fails on an existing galaxy table: it adds the
+galaxy_type column legacy_galaxy_type is stored in, which exists, and casts
+its text to the key of the type. Databases migrated before GalaxyType are
+migrated by two migrations of their own instead, before the other changes:
+
+    python manage.py makemigrations galaxies --empty -n galaxy_types
+    python manage.py makemigrations galaxies --empty -n classify_galaxy_types
+
+with, as the operations of the first one:
+
+    from galaxies.migration_operations import GALAXY_TYPES_OPERATIONS
+
+    operations = GALAXY_TYPES_OPERATIONS
+
+and of the second one, which classifies the galaxies in batches of a
+transaction each:
+
+    from galaxies.migration_operations import CLASSIFY_GALAXY_TYPES_OPERATIONS
+
+    atomic = False
+    operations = CLASSIFY_GALAXY_TYPES_OPERATIONS
+
+then by makemigrations and migrate as usual. The galaxies written by
+processes still running the previous code in the meantime are classified
+by the normalize_galaxy_types command.
+
+The operations start from any state with the free-text CharField
+galaxy_type and no GalaxyType, with or without the galaxy_type_distance_idx
+index of the ordering keys, which was added after the first migrations.
+"""
+
+from django.db import migrations, models
+from django.db.models.functions import Lower
+
+from .classification import classify_legacy_galaxies
+
+
+GALAXY_TYPES_OPERATIONS = [
+    migrations.CreateModel(
+        name='GalaxyType',
+        fields=[
+            ('id', models.SmallAutoField(primary_key=True, serialize=False)),
+            ('name', models.CharField(max_length=32)),
+            ('parent', models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=models.PROTECT,
+                related_name='children',
+                to='galaxies.galaxytype'
+            )),
+        ],
+    ),
+    migrations.AddConstraint(
+        model_name='galaxytype',
+        constraint=models.UniqueConstraint(Lower('name'), name='galaxy_type_name_unique'),
+    ),
+    # On the free-text column if it exists, recreated below on the key of
+    # the type.
+    migrations.SeparateDatabaseAndState(
+        database_operations=[
+            migrations.RunSQL(
+                'DROP INDEX IF EXISTS galaxy_type_distance_idx',
+                migrations.RunSQL.noop,
+            ),
+        ],
+        state_operations=[
+            migrations.RemoveIndex(model_name='galaxy', name='galaxy_type_distance_idx'),
+        ],
+    ),
+    # The free-text column is kept as is, as legacy_galaxy_type.
+    migrations.SeparateDatabaseAndState(
+        state_operations=[
+            migrations.RenameField(
+                model_name='galaxy',
+                old_name='galaxy_type',
+                new_name='legacy_galaxy_type',
+            ),
+            migrations.AlterField(
+                model_name='galaxy',
+                name='legacy_galaxy_type',
+                field=models.CharField(
+                    blank=True, db_column='galaxy_type', editable=False, max_length=32
+                ),
+            ),
+        ],
+    ),
+    # Nullable, until the galaxies are classified.
+    migrations.AddField(
+        model_name='galaxy',
+        name='galaxy_type',
+        field=models.ForeignKey(
+            null=True,
+            on_delete=models.PROTECT,
+            related_name='galaxies',
+            to='galaxies.galaxytype'
+        ),
+    ),
+    migrations.AddIndex(
+        model_name='galaxy',
+        index=models.Index(fields=['galaxy_type', 'distance'], name='galaxy_type_distance_idx'),
+    ),
+]
+
+CLASSIFY_GALAXY_TYPES_OPERATIONS = [
+    migrations.RunPython(classify_legacy_galaxies, migrations.RunPython.noop),
+]
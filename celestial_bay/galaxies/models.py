@@ -1,19 +1,41 @@
+from uuid import uuid4
+
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
+from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
+from django.db.models.functions import Lower
 from versatileimagefield.fields import VersatileImageField, PPOIField
 
 from my_auth.models import User
+from .counters import CounterFieldsMixin
+from .derived import get_absolute_magnitude_expression, get_physical_size_expression
+from .storage import ContentAddressedModelMixin
 
 
-class Constellation(models.Model):
+class Constellation(CounterFieldsMixin, models.Model):
     name = models.CharField(max_length=32, unique=True)
     abbreviation = models.CharField(max_length=3)
     area_in_sq_deg = models.FloatField()
+    # Denormalized counter, maintained by galaxies.counters.
+    galaxy_count = models.PositiveIntegerField(default=0, editable=False)
+
+    counter_fields = ('galaxy_count',)
+
+    class Meta:
+        # Trigram indexes of the fuzzy name lookup.
+        indexes = [
+            GinIndex(fields=['name'], opclasses=['gin_trgm_ops'],
+                     name='constellation_name_trgm_idx'),
+            GinIndex(fields=['abbreviation'], opclasses=['gin_trgm_ops'],
+                     name='constellation_abbr_trgm_idx'),
+        ]
 
     def __str__(self):
         return f'{self.pk} - {self.name} ({self.abbreviation})'
 
 
-class ConstellationImage(models.Model):
+class ConstellationImage(ContentAddressedModelMixin, models.Model):
     constellation = models.ForeignKey(
         Constellation,
         on_delete=models.CASCADE,
@@ -25,17 +47,75 @@ class ConstellationImage(models.Model):
         ppoi_field='image_ppoi'
     )
     image_ppoi = PPOIField()
+    # The storage names of the existing renditions by size key, and whether
+    # all of them exist, maintained by galaxies.renditions.
+    renditions = models.JSONField(default=dict, editable=False)
+    renditions_ready = models.BooleanField(default=False, editable=False)
+    # Read once at upload, see galaxies.metadata.
+    width = models.PositiveIntegerField(null=True, editable=False)
+    height = models.PositiveIntegerField(null=True, editable=False)
+    byte_size = models.PositiveBigIntegerField(null=True, editable=False)
+    sha256 = models.CharField(max_length=64, blank=True, db_index=True, editable=False)
+    blurhash = models.CharField(max_length=64, blank=True, editable=False)
+
+    class Meta:
+        # The lookups of the stored files by name, of the media serving and
+        # of the garbage collection (see galaxies.media.is_referenced).
+        indexes = [
+            models.Index(fields=['image'], name='const_image_image_idx'),
+            GinIndex(fields=['renditions'], opclasses=['jsonb_path_ops'],
+                     name='const_image_renditions_idx'),
+        ]
 
     def __str__(self):
         return f'{self.pk} pic of constellation - {self.constellation.name}'
 
 
+class GalaxyType(models.Model):
+    """
+    A class of the Hubble classification, e.g. 'SBb', under its parent class,
+    e.g. 'barred spiral' under 'spiral'. The classes without a parent are the
+    type families (see galaxies.classification).
+    """
+
+    id = models.SmallAutoField(primary_key=True)
+    name = models.CharField(max_length=32)
+    parent = models.ForeignKey(
+        'self',
+        null=True,
+        blank=True,
+        on_delete=models.PROTECT,
+        related_name='children'
+    )
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(Lower('name'), name='galaxy_type_name_unique'),
+        ]
+
+    def __str__(self):
+        return self.name
+
+
 class Galaxy(models.Model):
     name = models.CharField(max_length=64, unique=True)
     name_origin = models.TextField()
-    galaxy_type = models.CharField(max_length=32)
+    # Only null for the galaxies normalize_galaxy_types hasn't classified yet.
+    galaxy_type = models.ForeignKey(
+        GalaxyType,
+        null=True,
+        on_delete=models.PROTECT,
+        related_name='galaxies'
+    )
+    # The free-text type of the galaxies from before GalaxyType, that
+    # normalize_galaxy_types classifies. To be dropped once it has run.
+    legacy_galaxy_type = models.CharField(
+        max_length=32, blank=True, db_column='galaxy_type', editable=False
+    )
+    # In thousands of light-years.
     distance = models.FloatField()
     apparent_magnitude = models.FloatField(blank=True)
+    # The angular size, in arcminutes.
     size = models.FloatField(blank=True)
     notes = models.TextField(blank=True)
     owner = models.ForeignKey(
@@ -48,12 +128,53 @@ class Galaxy(models.Model):
         on_delete=models.PROTECT,
         related_name='galaxies'
     )
+    # Equatorial coordinates (J2000), in degrees.
+    ra = models.FloatField(
+        null=True, blank=True,
+        validators=[MinValueValidator(0), MaxValueValidator(360)]
+    )
+    dec = models.FloatField(
+        null=True, blank=True,
+        validators=[MinValueValidator(-90), MaxValueValidator(90)]
+    )
+    # The declination zone of the position, the sky index key, maintained by
+    # galaxies.sky.
+    sky_zone = models.PositiveSmallIntegerField(null=True, editable=False)
+
+    class Meta:
+        constraints = [
+            models.CheckConstraint(
+                check=models.Q(ra__isnull=True, dec__isnull=True)
+                | models.Q(ra__isnull=False, dec__isnull=False),
+                name='galaxy_ra_dec_together'
+            ),
+        ]
+        # Backing indexes of GalaxyFilter and the allowed ordering keys.
+        indexes = [
+            models.Index(fields=['galaxy_type', 'distance'],
+                         name='galaxy_type_distance_idx'),
+            models.Index(fields=['constellation', 'distance'],
+                         name='galaxy_constellation_dist_idx'),
+            models.Index(fields=['distance', 'id'], name='galaxy_distance_idx'),
+            models.Index(fields=['apparent_magnitude', 'id'],
+                         name='galaxy_app_magnitude_idx'),
+            # Expression indexes of the derived fields (see galaxies.derived).
+            models.Index(get_absolute_magnitude_expression(), models.F('id'),
+                         name='galaxy_abs_magnitude_idx'),
+            models.Index(get_physical_size_expression(), models.F('id'),
+                         name='galaxy_physical_size_idx'),
+            # Trigram index of the fuzzy name lookup.
+            GinIndex(fields=['name'], opclasses=['gin_trgm_ops'],
+                     name='galaxy_name_trgm_idx'),
+            # The sky index of the cone search.
+            models.Index(fields=['sky_zone', 'ra'], name='galaxy_sky_zone_ra_idx'),
+        ]
 
     def __str__(self):
         return f'{self.pk} - {self.name}'
 
 
-class GalaxyImage(models.Model):
+class GalaxyImage(ContentAddressedModelMixin, models.Model):
     galaxy = models.ForeignKey(
         Galaxy,
         on_delete=models.CASCADE,
@@ -65,12 +186,31 @@ class GalaxyImage(models.Model):
         ppoi_field='image_ppoi'
     )
     image_ppoi = PPOIField()
+    # The storage names of the existing renditions by size key, and whether
+    # all of them exist, maintained by galaxies.renditions.
+    renditions = models.JSONField(default=dict, editable=False)
+    renditions_ready = models.BooleanField(default=False, editable=False)
+    # Read once at upload, see galaxies.metadata.
+    width = models.PositiveIntegerField(null=True, editable=False)
+    height = models.PositiveIntegerField(null=True, editable=False)
+    byte_size = models.PositiveBigIntegerField(null=True, editable=False)
+    sha256 = models.CharField(max_length=64, blank=True, db_index=True, editable=False)
+    blurhash = models.CharField(max_length=64, blank=True, editable=False)
+
+    class Meta:
+        # The lookups of the stored files by name, of the media serving and
+        # of the garbage collection (see galaxies.media.is_referenced).
+        indexes = [
+            models.Index(fields=['image'], name='galaxy_image_image_idx'),
+            GinIndex(fields=['renditions'], opclasses=['jsonb_path_ops'],
+                     name='galaxy_image_renditions_idx'),
+        ]
 
     def __str__(self):
         return f'{self.pk} pic of galaxy - {self.galaxy.name}'
 
 
-class Post(models.Model):
+class Post(CounterFieldsMixin, models.Model):
     title = models.CharField(max_length=256)
     content = models.TextField()
     created = models.DateField(auto_now_add=True)
@@ -81,12 +221,29 @@ class Post(models.Model):
         on_delete=models.SET_NULL,
         related_name='posts'
     )
+    # Full-text search document of title and content, kept up to date on
+    # save by galaxies.search.
+    search_vector = SearchVectorField(null=True, editable=False)
+    # Denormalized counters, maintained by galaxies.counters.
+    comment_count = models.PositiveIntegerField(default=0, editable=False)
+    image_count = models.PositiveIntegerField(default=0, editable=False)
+
+    counter_fields = ('comment_count', 'image_count')
+
+    class Meta:
+        # Backing indexes of PostFilter and the allowed ordering keys.
+        indexes = [
+            models.Index(fields=['owner', 'created'], name='post_owner_created_idx'),
+            models.Index(fields=['created', 'id'], name='post_created_idx'),
+            models.Index(fields=['updated', 'id'], name='post_updated_idx'),
+            GinIndex(fields=['search_vector'], name='post_search_vector_idx'),
+        ]
 
     def __str__(self):
         return f'{self.pk} - {self.title} - by - {self.owner.get_full_name()}'
 
 
-class PostImage(models.Model):
+class PostImage(ContentAddressedModelMixin, models.Model):
     post = models.ForeignKey(
         Post,
         on_delete=models.CASCADE,
@@ -98,6 +255,25 @@ class PostImage(models.Model):
         ppoi_field='image_ppoi'
     )
     image_ppoi = PPOIField()
+    # The storage names of the existing renditions by size key, and whether
+    # all of them exist, maintained by galaxies.renditions.
+    renditions = models.JSONField(default=dict, editable=False)
+    renditions_ready = models.BooleanField(default=False, editable=False)
+    # Read once at upload, see galaxies.metadata.
+    width = models.PositiveIntegerField(null=True, editable=False)
+    height = models.PositiveIntegerField(null=True, editable=False)
+    byte_size = models.PositiveBigIntegerField(null=True, editable=False)
+    sha256 = models.CharField(max_length=64, blank=True, db_index=True, editable=False)
+    blurhash = models.CharField(max_length=64, blank=True, editable=False)
+
+    class Meta:
+        # The lookups of the stored files by name, of the media serving and
+        # of the garbage collection (see galaxies.media.is_referenced).
+        indexes = [
+            models.Index(fields=['image'], name='post_image_image_idx'),
+            GinIndex(fields=['renditions'], opclasses=['jsonb_path_ops'],
+                     name='post_image_renditions_idx'),
+        ]
 
     def __str__(self):
         return f'{self.pk} pic of post - {self.post.title}'
@@ -118,6 +294,84 @@ class Comment(models.Model):
         on_delete=models.SET_NULL,
         related_name='comments'
     )
+    # Full-text search document of content, kept up to date on save by
+    # galaxies.search.
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    class Meta:
+        # Backing indexes of CommentFilter and the allowed ordering keys.
+        indexes = [
+            models.Index(fields=['post', 'created'], name='comment_post_created_idx'),
+            models.Index(fields=['owner', 'created'], name='comment_owner_created_idx'),
+            models.Index(fields=['created', 'id'], name='comment_created_idx'),
+            GinIndex(fields=['search_vector'], name='comment_search_vector_idx'),
+        ]
 
     def __str__(self):
         return f'{self.pk} comment in - {self.post.title}'
+
+
+class UploadSession(models.Model):
+    """
+    A resumable chunked upload of an image of a galaxy or a post, see
+    galaxies.uploads.
+    """
+
+    id = models.UUIDField(primary_key=True, default=uuid4, editable=False)
+    owner = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='upload_sessions'
+    )
+    galaxy = models.ForeignKey(
+        Galaxy,
+        null=True,
+        blank=True,
+        on_delete=models.CASCADE,
+        related_name='upload_sessions'
+    )
+    post = models.ForeignKey(
+        Post,
+        null=True,
+        blank=True,
+        on_delete=models.CASCADE,
+        related_name='upload_sessions'
+    )
+    filename = models.CharField(max_length=100)
+    size = models.PositiveBigIntegerField()
+    # The number of bytes received from the start of the file.
+    received = models.PositiveBigIntegerField(default=0, editable=False)
+    created = models.DateTimeField(auto_now_add=True)
+    expires = models.DateTimeField(db_index=True, editable=False)
+
+    class Meta:
+        constraints = [
+            models.CheckConstraint(
+                check=models.Q(galaxy__isnull=True) ^ models.Q(post__isnull=True),
+                name='upload_session_single_target',
+            ),
+        ]
+
+    def __str__(self):
+        return f'{self.pk} upload of {self.filename} ({self.received}/{self.size})'
+
+
+class SkyTile(models.Model):
+    """
+    The number of galaxies and the sum of their apparent magnitudes in a cell
+    of the sky, at one of the resolutions of the sky map, maintained by
+    galaxies.tiles.
+    """
+
+    level = models.PositiveSmallIntegerField()
+    cell = models.PositiveIntegerField()
+    count = models.PositiveIntegerField(default=0)
+    magnitude_sum = models.FloatField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['level', 'cell'], name='sky_tile_level_cell_unique'),
+        ]
+
+    def __str__(self):
+        return f'{self.level}/{self.cell} - {self.count}'
@@ -0,0 +1,349 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as BinasciiError
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import F, Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, LimitOffsetPagination,\
+    _positive_int
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    """
+    Keyset (a.k.a. seek) pagination over a stable (sort_key, pk) ordering.
+
+    Instead of an offset, the client passes back an opaque cursor that encodes
+    the sort key values of the last row it has seen. The next page is fetched
+    with a WHERE clause on those values, so the cost of a page does not depend
+    on how deep into the collection it is, and no COUNT(*) is needed.
+
+    The ordering is taken from the queryset (e.g. the view's default ordering)
+    and the primary key is always appended to it as a tie breaker. Plain model
+    fields and annotations can be used as sort keys. The NULLs of nullable
+    ones, such as derived values, come last in either direction.
+
+        e.g.  https://api.example.org/galaxies/?cursor=&limit=20
+
+    and then follow the "next"/"previous" links of the response.
+    """
+
+    cursor_query_param = 'cursor'
+    cursor_query_description = 'The pagination cursor value.'
+    limit_query_param = 'limit'
+    limit_query_description = 'Number of results to return per page.'
+    default_limit = 10
+    max_limit = 50
+
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.limit = self.get_limit(request)
+
+        self.ordering = self.get_ordering(queryset)
+        self.nullable = self.get_nullable(queryset)
+        position, reverse = self.decode_cursor(request)
+
+        # Sort keys the filters only aliased are selected too, for the cursor.
+        aliases = [
+            field.lstrip('-') for field in self.ordering
+            if field.lstrip('-') in set(queryset.query.annotations) -
+            set(queryset.query.annotation_select)
+        ]
+
+        if aliases:
+            queryset = queryset.annotate(**{name: F(name) for name in aliases})
+
+        queryset = queryset.order_by(*[
+            self.get_order_by(field, reverse) for field in self.ordering
+        ])
+
+        if position is not None:
+            queryset = queryset.filter(self.get_seek_filter(position, reverse))
+
+        # Fetch one extra row to find out if there is another page.
+        results = list(queryset[:self.limit + 1])
+        has_more = len(results) > self.limit
+        results = results[:self.limit]
+
+        if reverse:
+            results.reverse()
+            self.has_next = position is not None
+            self.has_previous = has_more
+        else:
+            self.has_next = has_more
+            self.has_previous = position is not None
+
+        self.first_position = self.get_position(results[0]) if results else None
+        self.last_position = self.get_position(results[-1]) if results else None
+
+        # A reverse page that ran off the end of the collection has nothing
+        # to go back to, but the client can still move forward from it.
+        if reverse and not results:
+            self.last_position = position
+            self.has_next = True
+
+        return results
+
+    def get_limit(self, request):
+        try:
+            return _positive_int(
+                request.query_params[self.limit_query_param],
+                strict=True,
+                cutoff=self.max_limit
+            )
+        except (KeyError, ValueError):
+            return self.default_limit
+
+    def get_ordering(self, queryset):
+        """
+        Returns the attnames of the fields the queryset is ordered by, with
+        the primary key appended as a tie breaker.
+        """
+
+        opts = queryset.model._meta
+        ordering = []
+
+        for field in queryset.query.order_by or ('pk',):
+            if not isinstance(field, str):
+                raise NotFound('Keyset pagination needs a plain field ordering.')
+
+            descending = field.startswith('-')
+            name = field.lstrip('-')
+
+            if name == 'pk':
+                name = opts.pk.attname
+            elif name in queryset.query.annotations:
+                pass
+            else:
+                try:
+                    name = opts.get_field(name).attname
+                except FieldDoesNotExist:
+                    raise NotFound('Keyset pagination needs a plain field ordering.')
+
+            ordering.append(f'-{name}' if descending else name)
+
+            if name == opts.pk.attname:
+                break
+        else:
+            ordering.append(opts.pk.attname)
+
+        return tuple(ordering)
+
+    def get_nullable(self, queryset):
+        """
+        The sort keys that can be NULL: the nullable model fields, and the
+        annotations, which can't be told apart.
+        """
+
+        opts = queryset.model._meta
+        nullable = set()
+
+        for field in self.ordering:
+            name = field.lstrip('-')
+
+            if name in queryset.query.annotations:
+                nullable.add(name)
+            elif name != opts.pk.attname and opts.get_field(name).null:
+                nullable.add(name)
+
+        return nullable
+
+    def get_order_by(self, field, reverse):
+        """
+        The ordering of a sort key, NULLs last, or first on reverse pages,
+        which go through the ordering backwards.
+        """
+
+        name = field.lstrip('-')
+        descending = field.startswith('-') != reverse
+
+        if name not in self.nullable:
+            return f'-{name}' if descending else name
+
+        if descending:
+            return F(name).desc(nulls_first=reverse, nulls_last=not reverse)
+
+        return F(name).asc(nulls_first=reverse, nulls_last=not reverse)
+
+    def get_seek_filter(self, position, reverse):
+        """
+        Builds the row value comparison "(a, b, pk) > (x, y, z)" for mixed
+        sort directions as an OR of prefix equalities, with the NULLs of the
+        nullable sort keys after all the values, or before them on reverse
+        pages.
+
+        The leading column is also repeated as a plain range condition, so the
+        planner can use it as an index condition, unless it can be NULL.
+        """
+
+        seek = Q()
+        equal = Q()
+
+        for field, value in zip(self.ordering, position):
+            name = field.lstrip('-')
+            lookup = 'lt' if field.startswith('-') != reverse else 'gt'
+
+            if value is None:
+                # Only values come after NULLs, on reverse pages.
+                after = Q(**{f'{name}__isnull': False}) if reverse else None
+                same = Q(**{f'{name}__isnull': True})
+            else:
+                after = Q(**{f'{name}__{lookup}': value})
+                same = Q(**{name: value})
+
+                if name in self.nullable and not reverse:
+                    after |= Q(**{f'{name}__isnull': True})
+
+            if after is not None:
+                seek |= equal & after
+
+            equal &= same
+
+        first = self.ordering[0].lstrip('-')
+
+        if first in self.nullable:
+            return seek
+
+        lookup = 'lte' if self.ordering[0].startswith('-') != reverse else 'gte'
+
+        return Q(**{f'{first}__{lookup}': position[0]}) & seek
+
+    def get_position(self, instance):
+        return [getattr(instance, field.lstrip('-')) for field in self.ordering]
+
+    def encode_cursor(self, position, reverse):
+        payload = {'o': self.ordering, 'p': position}
+
+        if reverse:
+            payload['r'] = 1
+
+        data = json.dumps(payload, cls=DjangoJSONEncoder, separators=(',', ':'))
+        cursor = urlsafe_b64encode(data.encode('utf-8')).decode('ascii')
+
+        return replace_query_param(
+            self.base_url, self.cursor_query_param, cursor.rstrip('=')
+        )
+
+    def decode_cursor(self, request):
+        """
+        Returns the (position, reverse) pair encoded in the cursor. An empty
+        cursor stands for the first page.
+        """
+
+        encoded = request.query_params.get(self.cursor_query_param, '')
+
+        if not encoded:
+            return None, False
+
+        try:
+            padding = '=' * (-len(encoded) % 4)
+            payload = json.loads(urlsafe_b64decode(encoded + padding))
+            ordering = tuple(payload['o'])
+            position = list(payload['p'])
+            reverse = bool(payload.get('r', False))
+        except (TypeError, ValueError, KeyError, BinasciiError):
+            raise NotFound(self.invalid_cursor_message)
+
+        # A cursor is only valid for the ordering it was produced with.
+        if ordering != self.ordering or len(position) != len(ordering):
+            raise NotFound(self.invalid_cursor_message)
+
+        return position, reverse
+
+    def get_next_link(self):
+        if not self.has_next or self.last_position is None:
+            return None
+        return self.encode_cursor(self.last_position, reverse=False)
+
+    def get_previous_link(self):
+        if not self.has_previous:
+            return None
+        if self.first_position is None:
+            return replace_query_param(self.base_url, self.cursor_query_param, '')
+        return self.encode_cursor(self.first_position, reverse=True)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'next': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'previous': {'type': 'string', 'nullable': True, 'format': 'uri'},
+                'results': schema,
+            },
+        }
+
+    def get_schema_operation_parameters(self, view):
+        return [
+            {
+                'name': self.cursor_query_param,
+                'required': False,
+                'in': 'query',
+                'description': self.cursor_query_description,
+                'schema': {'type': 'string'},
+            },
+            {
+                'name': self.limit_query_param,
+                'required': False,
+                'in': 'query',
+                'description': self.limit_query_description,
+                'schema': {'type': 'integer'},
+            },
+        ]
+
+
+class CustomLimitOffsetPagination(LimitOffsetPagination):
+    """
+    Sets the default page size to 10 and the maximum to 50.
+
+    Switches to keyset pagination when the request has a "cursor" query
+    parameter (an empty one requests the first page).
+    """
+
+    # A numeric value indicating the limit to use if one is not provided by the
+    # client in a query parameter.
+    default_limit = 10
+
+    # A value indicating the maximum allowable limit that may be requested by
+    # the client.
+    max_limit = 50
+
+    keyset_class = KeysetPagination
+
+    keyset = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if self.keyset_class.cursor_query_param in request.query_params:
+            self.keyset = self.keyset_class()
+            self.keyset.default_limit = self.default_limit
+            self.keyset.max_limit = self.max_limit
+            return self.keyset.paginate_queryset(queryset, request, view)
+
+        self.keyset = None
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.keyset is not None:
+            return self.keyset.get_paginated_response(data)
+        return super().get_paginated_response(data)
+
+    def get_schema_operation_parameters(self, view):
+        parameters = super().get_schema_operation_parameters(view)
+        cursor = self.keyset_class().get_schema_operation_parameters(view)[0]
+        cursor['description'] = (
+            'The keyset pagination cursor. Pass an empty value for the first '
+            'page; offset is ignored when it is present.'
+        )
+        return parameters + [cursor]
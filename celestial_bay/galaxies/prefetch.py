@@ -0,0 +1,285 @@
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Prefetch
+from django.utils.module_loading import import_string
+from rest_framework.permissions import SAFE_METHODS
+
+from rest_flex_fields import EXPAND_PARAM, FIELDS_PARAM, OMIT_PARAM, WILDCARD_VALUES,\
+    split_levels
+
+
+def get_serializer_class(serializer_class):
+    """
+    Resolves the lazy 'app.SerializerName' strings used in expandable_fields
+    the same way DRF-FlexFields does, i.e. by trying the module path as given
+    and then its 'serializers' submodule.
+    """
+
+    if not isinstance(serializer_class, str):
+        return serializer_class
+
+    try:
+        return import_string(serializer_class)
+    except ImportError:
+        module_path, class_name = serializer_class.rsplit('.', 1)
+        return import_string(f'{module_path}.serializers.{class_name}')
+
+
+def get_expandable_fields(serializer_class):
+    meta = getattr(serializer_class, 'Meta', None)
+
+    if hasattr(meta, 'expandable_fields'):
+        return meta.expandable_fields
+
+    return getattr(serializer_class, 'expandable_fields', {})
+
+
+def get_query_param_values(request, param):
+    """
+    Reads a FlexFields query parameter the same way the root serializer does.
+    """
+
+    values = request.query_params.getlist(param)
+
+    if not values:
+        values = request.query_params.getlist(f'{param}[]')
+
+    if len(values) == 1:
+        values = values[0].split(',')
+
+    return [value.strip() for value in values if value.strip()]
+
+
+def get_requested_expands(request, permitted_expands=None):
+    """
+    Returns the expand paths of the request after applying the permitted list
+    expands, mirroring what the root FlexFields serializer is going to expand.
+    """
+
+    expand = get_query_param_values(request, EXPAND_PARAM)
+
+    if permitted_expands is not None:
+        if _contains_wildcard(expand):
+            return list(permitted_expands)
+        return list(set(expand) & set(permitted_expands))
+
+    return expand
+
+
+def _contains_wildcard(values):
+    return bool(WILDCARD_VALUES and set(values) & set(WILDCARD_VALUES))
+
+
+def _should_field_exist(name, sparse_fields, omit_fields, next_omit_fields):
+    """
+    The same rules FlexFieldsSerializerMixin uses to decide if a field stays in
+    the output for the given 'fields' and 'omit' values.
+    """
+
+    if name in omit_fields and name not in next_omit_fields:
+        return False
+    if _contains_wildcard(sparse_fields):
+        return True
+    if sparse_fields and name not in sparse_fields:
+        return False
+    return True
+
+
+def get_only_fields(model, serializer_class, expand, fields, omit):
+    """
+    Returns the model fields a serializer reads for the 'fields' and 'omit'
+    values, to be passed to QuerySet.only(), or None when every column is
+    needed or the fields can't be traced back to plain model fields.
+    """
+
+    sparse_fields, _ = split_levels(fields)
+    omit_fields, next_omit_fields = split_levels(omit)
+
+    if (not sparse_fields and not omit_fields) or _contains_wildcard(sparse_fields):
+        return None
+
+    meta = getattr(serializer_class, 'Meta', None)
+    names = getattr(meta, 'fields', None)
+
+    if not isinstance(names, (list, tuple)):
+        return None
+
+    expand_fields, _ = split_levels(expand)
+    declared_fields = getattr(serializer_class, '_declared_fields', {})
+    only = {model._meta.pk.name}
+
+    for name in list(names) + [name for name in expand_fields if name not in names]:
+        if not _should_field_exist(name, sparse_fields, omit_fields, next_omit_fields):
+            continue
+
+        declared = declared_fields.get(name)
+        source = getattr(declared, 'source', None) or name
+
+        if source == '*':
+            return None
+
+        source = source.split('.', 1)[0]
+
+        if source == 'pk':
+            continue
+
+        try:
+            field = model._meta.get_field(source)
+        except FieldDoesNotExist:
+            # Read-only fields of queryset annotations (e.g. the search rank)
+            # don't need any column, but a property or method of the model
+            # may read any of them.
+            if getattr(declared, 'read_only', False) and not hasattr(model, source):
+                continue
+            return None
+
+        if not field.concrete or field.many_to_many:
+            continue
+
+        only.add(field.name)
+
+        # VersatileImageField reads its primary point of interest from
+        # another column.
+        ppoi_field = getattr(field, 'ppoi_field', None)
+        if ppoi_field:
+            only.add(ppoi_field)
+
+        # Serializer fields that read other columns of the row declare them.
+        only.update(getattr(declared, 'required_columns', ()))
+
+    return only
+
+
+def plan_prefetch(model, serializer_class, expand, fields=(), omit=(), prefix=''):
+    """
+    Walks the expandable_fields tree of the serializer for the requested
+    expand paths and returns the (select_related, prefetch_related) lookups
+    that load every expanded relation up front.
+
+    Single-valued relations are joined with select_related, multi-valued ones
+    become a Prefetch whose queryset is planned recursively for the next
+    level, so the number of queries depends on the depth of the expansion and
+    not on the number of rows.
+    """
+
+    select, prefetch = [], []
+    expand_fields, next_expand_fields = split_levels(expand)
+    sparse_fields, next_sparse_fields = split_levels(fields)
+    omit_fields, next_omit_fields = split_levels(omit)
+    expandable_fields = get_expandable_fields(serializer_class)
+
+    if _contains_wildcard(expand_fields):
+        expand_fields = expandable_fields.keys()
+
+    for name in expand_fields:
+        if name not in expandable_fields:
+            continue
+
+        if not _should_field_exist(name, sparse_fields, omit_fields, next_omit_fields):
+            continue
+
+        options = expandable_fields[name]
+
+        if isinstance(options, tuple):
+            child_serializer_class = options[0]
+            settings = options[1] if len(options) > 1 else {}
+        else:
+            child_serializer_class, settings = options, {}
+
+        source = settings.get('source', name)
+
+        try:
+            field = model._meta.get_field(source)
+        except FieldDoesNotExist:
+            continue
+
+        if not field.is_relation:
+            continue
+
+        child_serializer_class = get_serializer_class(child_serializer_class)
+        child_expand = next_expand_fields.get(name, [])
+        child_fields = next_sparse_fields.get(name, [])
+        child_omit = next_omit_fields.get(name, [])
+        lookup = f'{prefix}{source}'
+
+        if field.many_to_one or field.one_to_one:
+            select.append(lookup)
+            child_select, child_prefetch = plan_prefetch(
+                field.related_model, child_serializer_class, child_expand,
+                child_fields, child_omit, prefix=f'{lookup}__'
+            )
+            select.extend(child_select)
+            prefetch.extend(child_prefetch)
+        else:
+            child_queryset = prefetch_expanded(
+                field.related_model._default_manager.all(),
+                child_serializer_class,
+                child_expand,
+                child_fields,
+                child_omit,
+                # The prefetch is matched to its parents by the foreign key.
+                required_fields=[field.field.name] if field.one_to_many else None
+            )
+            prefetch.append(Prefetch(lookup, queryset=child_queryset))
+
+    return select, prefetch
+
+
+def prefetch_expanded(queryset, serializer_class, expand, fields=(), omit=(),
+                      required_fields=None):
+    """
+    Applies the select_related/prefetch_related plan for the expand paths to
+    the queryset, and narrows the selected columns down to the ones the
+    'fields'/'omit' sparse fieldset needs.
+    """
+
+    model = queryset.model
+    select, prefetch = plan_prefetch(model, serializer_class, expand, fields, omit)
+
+    if select:
+        queryset = queryset.select_related(*select)
+
+    if prefetch:
+        queryset = queryset.prefetch_related(*prefetch)
+
+    if fields or omit:
+        only = get_only_fields(model, serializer_class, expand, fields, omit)
+
+        if only is not None:
+            queryset = queryset.only(*only, *(required_fields or ()))
+
+    return queryset
+
+
+class ExpandPrefetchMixin:
+    """
+    Plans the queryset of the view from the FlexFields query parameters of
+    the request and the expandable_fields of its serializer:
+
+        - expanded relations at any depth are loaded with select_related and
+          nested Prefetch objects, so they don't cause N+1 queries;
+        - on read requests, the 'fields'/'omit' sparse fieldset is pushed
+          down to QuerySet.only(), so large text columns that are not going to
+          be returned are not loaded from the database either.
+    """
+
+    def get_expands(self):
+        permitted_expands = None
+
+        if getattr(self, 'action', None) == 'list':
+            permitted_expands = getattr(self, 'permit_list_expands', None)
+
+        return get_requested_expands(self.request, permitted_expands)
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        fields, omit = (), ()
+
+        # Writes go through model validation and save(), which need the
+        # whole row.
+        if self.request.method in SAFE_METHODS:
+            fields = get_query_param_values(self.request, FIELDS_PARAM)
+            omit = get_query_param_values(self.request, OMIT_PARAM)
+
+        return prefetch_expanded(
+            queryset, self.get_serializer_class(), self.get_expands(), fields, omit
+        )
@@ -0,0 +1,107 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.utils import timezone
+
+from .cache import invalidate_in_bulk
+from .counters import aggregated_counter_updates
+from .models import Comment, Galaxy, GalaxyImage, Post, UploadSession
+from .renditions import get_executor
+from .workers import purge_user as purge_user_in_worker
+
+
+# What the deletion of a user cascades to, in the order it is purged, the
+# children before their parents: (model, lookup of the user, action).
+# Posts and comments outlive their owner, as with on_delete=SET_NULL.
+PURGE_STEPS = (
+    (UploadSession, 'owner', 'delete'),
+    (GalaxyImage, 'galaxy__owner', 'delete'),
+    (Galaxy, 'owner', 'delete'),
+    (Comment, 'owner', 'detach'),
+    (Post, 'owner', 'detach'),
+)
+
+
+def get_purge_settings():
+    return {
+        # Purge in the worker process pool of galaxies.renditions, or
+        # synchronously when the transaction of the request commits when
+        # False.
+        'ASYNC': True,
+        # The number of rows deleted per transaction.
+        'BATCH_SIZE': 500,
+        **getattr(settings, 'GALAXIES_PURGE', {}),
+    }
+
+
+def mark_for_deletion(user):
+    """
+    Deactivates a user, so that they can't sign in any more, and enqueues the
+    purge of their data once the transaction commits, instead of cascading
+    through all of it in the request.
+    """
+
+    user.is_active = False
+    user.deletion_requested = timezone.now()
+    user.save(update_fields=['is_active', 'deletion_requested'])
+
+    pk = user.pk
+    transaction.on_commit(lambda: enqueue_purge(pk))
+
+
+def enqueue_purge(pk):
+    if not get_purge_settings()['ASYNC']:
+        purge_user(pk)
+        return
+
+    get_executor().submit(purge_user_in_worker, pk)
+
+
+def _purge_batches(queryset, action, batch_size):
+    purged = 0
+
+    while True:
+        # Each batch is a short transaction that locks few rows.
+        with transaction.atomic():
+            pks = list(queryset.values_list('pk', flat=True)[:batch_size])
+
+            if not pks:
+                return purged
+
+            batch = queryset.model._default_manager.filter(pk__in=pks)
+
+            if action == 'delete':
+                # Deleted through the collector, so that the signals release
+                # their files and update the counters and caches.
+                with aggregated_counter_updates():
+                    batch.delete()
+            else:
+                batch.update(owner=None)
+                invalidate_in_bulk(queryset.model, pks)
+
+        purged += len(pks)
+
+
+def purge_user(pk, batch_size=None):
+    """
+    Deletes a user marked for deletion, with everything that cascades from
+    it, in bounded batches, and returns the number of rows purged by model.
+    Can be interrupted and run again.
+    """
+
+    batch_size = batch_size or get_purge_settings()['BATCH_SIZE']
+    user_model = get_user_model()
+
+    if not user_model._default_manager.filter(pk=pk, deletion_requested__isnull=False).exists():
+        return {}
+
+    purged = {}
+
+    for model, lookup, action in PURGE_STEPS:
+        queryset = model._default_manager.filter(**{lookup: pk}).order_by('pk')
+        purged[model._meta.label] = _purge_batches(queryset, action, batch_size)
+
+    _, deleted = user_model._default_manager.filter(pk=pk).delete()
+    purged[user_model._meta.label] = deleted.get(user_model._meta.label, 0)
+
+    return purged
@@ -0,0 +1,274 @@
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from threading import Lock
+
+from django.apps import apps
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.db import transaction
+from PIL import Image
+from versatileimagefield.utils import get_rendition_key_set
+
+from .cache import invalidate_in_bulk
+from .formats import encode_image, get_accepted_image_format, get_supported_formats
+from .models import ConstellationImage, GalaxyImage, PostImage
+from .workers import init_worker, generate_renditions as generate_renditions_in_worker
+
+
+logger = logging.getLogger(__name__)
+
+# The models whose renditions are generated at upload, and the rendition key
+# set their serializers use.
+IMAGE_MODELS = (ConstellationImage, GalaxyImage, PostImage)
+RENDITION_KEY_SET = 'image_headshot'
+
+_executor = None
+_executor_lock = Lock()
+
+
+def get_renditions_settings():
+    return {
+        # Generate in a pool of worker processes, or synchronously when the
+        # transaction of the upload commits when False.
+        'ASYNC': True,
+        'WORKERS': os.cpu_count() or 1,
+        # Served in place of the renditions that don't exist yet, the
+        # original image when None.
+        'PLACEHOLDER_URL': None,
+        # Seconds before a missing rendition can be requested again.
+        'PENDING_TIMEOUT': 300,
+        **getattr(settings, 'GALAXIES_RENDITIONS', {}),
+    }
+
+
+def create_executor(workers):
+    """
+    A pool of worker processes that can generate renditions. They are spawned
+    rather than forked, so they don't share the database connections and
+    threads of the web worker, and set Django up on start.
+    """
+
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=init_worker,
+        initargs=(settings.SETTINGS_MODULE,),
+    )
+
+
+def get_executor():
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = create_executor(get_renditions_settings()['WORKERS'])
+
+        return _executor
+
+
+def get_rendition_sizes():
+    """
+    The size keys of the renditions that are generated, e.g.
+    'thumbnail__100x100', i.e. all but the original image.
+    """
+
+    return [
+        size_key for _, size_key in get_rendition_key_set(RENDITION_KEY_SET)
+        if size_key != 'url'
+    ]
+
+
+def create_variant(storage, name, format_name):
+    """
+    Encodes the stored image to a modern format next to it, unless it
+    exists already, and returns the storage name of the variant. Returns
+    the name of the image itself when the variant wouldn't be smaller, as
+    happens with small or flat PNGs.
+    """
+
+    variant_name = f'{name}.{format_name}'
+
+    if storage.exists(variant_name):
+        return variant_name
+
+    with storage.open(name) as file, Image.open(file) as image:
+        content = encode_image(image, format_name)
+
+    if len(content) >= storage.size(name):
+        return name
+
+    return storage.save(variant_name, ContentFile(content))
+
+
+def generate_renditions(label, pk):
+    """
+    Creates the renditions of an image row, and the variants of them and of
+    the original in the supported modern formats, and records the storage
+    names of those that exist in its rendition index, marking the row as
+    ready when all of them do. Returns whether all of them could be created.
+    """
+
+    model = apps.get_model(label)
+    instance = model._default_manager.filter(pk=pk).first()
+
+    if instance is None or not instance.image:
+        return False
+
+    image = instance.image
+    image.create_on_demand = True
+    index = {}
+
+    for size_key in get_rendition_sizes():
+        sizer, size = size_key.split('__')
+
+        try:
+            index[size_key] = getattr(image, sizer)[size].name
+        except Exception:
+            logger.exception('Failed to create the %s rendition of %s %s',
+                             size_key, label, pk)
+
+    # The modern format variants of the original and of every rendition.
+    formats = get_supported_formats()
+
+    for size_key, name in [('url', image.name)] + list(index.items()):
+        for format_name in formats:
+            try:
+                index[f'{size_key}@{format_name}'] = create_variant(
+                    image.storage, name, format_name
+                )
+            except Exception:
+                logger.exception('Failed to create the %s %s variant of %s %s',
+                                 size_key, format_name, label, pk)
+
+    # Every rendition and every variant of them and of the original.
+    sizes = get_rendition_sizes()
+    ready = len(index) == len(sizes) + (len(sizes) + 1) * len(formats)
+
+    # Unless the image has been replaced in the meantime.
+    model._default_manager.filter(
+        pk=pk, image=image.name, image_ppoi=instance.image_ppoi
+    ).update(renditions=index, renditions_ready=ready)
+    invalidate_in_bulk(model, [pk])
+
+    return ready
+
+
+def enqueue_renditions(label, pk):
+    if not get_renditions_settings()['ASYNC']:
+        generate_renditions(label, pk)
+        return
+
+    future = get_executor().submit(generate_renditions_in_worker, label, pk)
+    future.add_done_callback(_log_failure)
+
+
+def _log_failure(future):
+    if future.exception() is not None:
+        logger.error('Rendition generation failed', exc_info=future.exception())
+
+
+def request_renditions(instance):
+    """
+    Marks the missing renditions of an image row as pending and, with the
+    worker pool, enqueues their generation, at most once per PENDING_TIMEOUT
+    seconds across all processes.
+
+    Without the worker pool, they would be generated in the read request that
+    needs them, so they are left to the upload and to warm_renditions.
+    """
+
+    label, pk = instance._meta.label, instance.pk
+    renditions_settings = get_renditions_settings()
+    timeout = renditions_settings['PENDING_TIMEOUT']
+
+    if not cache.add(f'galaxies:renditions:pending:{label}:{pk}', True, timeout=timeout):
+        return
+
+    if renditions_settings['ASYNC']:
+        transaction.on_commit(lambda: enqueue_renditions(label, pk))
+
+
+def build_rendition_urls(image, sizes, request=None):
+    """
+    Returns the URLs of the renditions of an image by their keys, built from
+    the rendition index of its row only, without asking the storage if they
+    exist or resizing anything.
+
+    The variants in the best modern format the request accepts are preferred
+    (see galaxies.formats.get_accepted_image_format). Missing renditions get
+    the PLACEHOLDER_URL, or the URL of the original image if there is none,
+    and are generated in the background (see request_renditions).
+    """
+
+    if not image:
+        return {}
+
+    index = image.instance.renditions or {}
+    placeholder_url = get_renditions_settings()['PLACEHOLDER_URL']
+    format_name = get_accepted_image_format(request)
+    urls, missing = {}, False
+
+    for key, size_key in sizes:
+        if format_name and f'{size_key}@{format_name}' in index:
+            url = image.storage.url(index[f'{size_key}@{format_name}'])
+        elif size_key == 'url':
+            url = image.storage.url(image.name)
+        elif size_key in index:
+            url = image.storage.url(index[size_key])
+        else:
+            url, missing = placeholder_url or image.storage.url(image.name), True
+
+        urls[key] = request.build_absolute_uri(url) if request is not None else url
+
+    if missing:
+        request_renditions(image.instance)
+
+    return urls
+
+
+def reset_renditions_on_change(sender, instance, raw=False, **kwargs):
+    """
+    pre_save receiver that clears the rendition index of a replaced image, or
+    of an image with a new primary point of interest, which the crops depend
+    on.
+
+    The files of a replaced image are remembered, to be released after the
+    save (see galaxies.media).
+    """
+
+    instance._replaced_files = None
+
+    if raw or instance._state.adding:
+        return
+
+    current = sender._default_manager.filter(pk=instance.pk).values_list(
+        'image', 'image_ppoi', 'renditions'
+    ).first()
+
+    if current is None:
+        return
+
+    name, ppoi, renditions = current
+
+    if name != instance.image.name:
+        instance._replaced_files = (name, renditions)
+
+    if (name, ppoi) != (instance.image.name, instance.image_ppoi):
+        instance.renditions, instance.renditions_ready = {}, False
+
+
+def enqueue_renditions_on_save(sender, instance, raw=False, **kwargs):
+    """
+    post_save receiver that enqueues the generation of the renditions of a
+    new or replaced image, once the transaction commits, so that the first
+    request that serializes it doesn't have to resize it.
+    """
+
+    if raw or instance.renditions_ready or not instance.image:
+        return
+
+    label, pk = sender._meta.label, instance.pk
+    transaction.on_commit(lambda: enqueue_renditions(label, pk))
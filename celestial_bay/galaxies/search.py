@@ -0,0 +1,102 @@
+from django.contrib.postgres.search import SearchVector, TrigramSimilarity
+from django.db import connections, transaction
+from django.db.models import Q
+from django.db.models.functions import Greatest
+
+from .models import Post, Comment
+
+
+# The text search configuration used for both the stored documents and the
+# queries, so that they are stemmed the same way.
+SEARCH_CONFIG = 'english'
+
+# The columns each searchable model's search_vector is built from, with the
+# weight they contribute to the rank.
+SEARCH_DOCUMENTS = {
+    Post: (('title', 'A'), ('content', 'B')),
+    Comment: (('content', 'B'),),
+}
+
+
+def get_search_vector(model):
+    vectors = [
+        SearchVector(field, weight=weight, config=SEARCH_CONFIG)
+        for field, weight in SEARCH_DOCUMENTS[model]
+    ]
+
+    search_vector = vectors[0]
+    for vector in vectors[1:]:
+        search_vector = search_vector + vector
+
+    return search_vector
+
+
+def update_search_vector(queryset):
+    """
+    Recomputes the stored search_vector of the rows in the queryset in the
+    database, with a single UPDATE.
+    """
+
+    return queryset.update(search_vector=get_search_vector(queryset.model))
+
+
+def update_search_vector_on_save(sender, instance, created, update_fields=None,
+                                 raw=False, **kwargs):
+    """
+    post_save receiver that refreshes the search_vector of the saved row,
+    unless the save didn't touch any of the columns it is built from.
+    """
+
+    if raw:
+        return
+
+    if update_fields is not None:
+        document_fields = {field for field, _ in SEARCH_DOCUMENTS[sender]}
+
+        if not document_fields.intersection(update_fields):
+            return
+
+    update_search_vector(sender._default_manager.filter(pk=instance.pk))
+
+
+def create_search_extensions(using='default', **kwargs):
+    """
+    pre_migrate receiver that installs the pg_trgm extension the trigram
+    indexes are built with, before the migrations that create them run.
+    """
+
+    with connections[using].cursor() as cursor:
+        cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+
+
+def trigram_lookup(queryset, fields, term, threshold, limit):
+    """
+    Returns up to limit rows of the queryset whose fields are similar to the
+    term, ordered by their best trigram similarity (annotated as
+    'similarity').
+
+    Rows are matched with the % operator, which can use the gin_trgm_ops
+    indexes, after setting pg_trgm.similarity_threshold for the current
+    transaction only.
+    """
+
+    similarities = [TrigramSimilarity(field, term) for field in fields]
+    similarity = Greatest(*similarities) if len(similarities) > 1 else similarities[0]
+
+    match = Q()
+    for field in fields:
+        match |= Q(**{f'{field}__trigram_similar': term})
+
+    with transaction.atomic(using=queryset.db):
+        with connections[queryset.db].cursor() as cursor:
+            cursor.execute(
+                "SELECT set_config('pg_trgm.similarity_threshold', %s, true)",
+                [str(threshold)]
+            )
+
+        return list(
+            queryset
+            .filter(match)
+            .annotate(similarity=similarity)
+            .order_by('-similarity', 'pk')[:limit]
+        )
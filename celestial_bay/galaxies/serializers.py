@@ -1,14 +1,125 @@
+import os
+
+from rest_framework import serializers
+from rest_framework.exceptions import PermissionDenied
 from rest_flex_fields import FlexFieldsModelSerializer
 from versatileimagefield.serializers import VersatileImageFieldSerializer
 
-from .models import Constellation, ConstellationImage, Galaxy, GalaxyImage,\
-    Post, PostImage, Comment
+from .models import Constellation, ConstellationImage, Galaxy, GalaxyImage, GalaxyType,\
+    Post, PostImage, Comment, UploadSession
+from .classification import find_galaxy_type, get_types, normalize_type_name
+from .renditions import build_rendition_urls
+from .sky import get_sky_settings
+from .stats import GROUP_BY_FIELDS, get_stats_settings
+from .uploads import get_uploads_settings
+
+
+class IndexedRenditionsField(VersatileImageFieldSerializer):
+    """
+    Builds the rendition URLs from the rendition index of the row (see
+    galaxies.renditions), so serializing a page of images makes no storage
+    existence checks and never resizes an image in the request.
+    """
+
+    required_columns = ('renditions',)
+
+    def to_representation(self, value):
+        return build_rendition_urls(value, self.sizes, self.context.get('request'))
+
+
+class GalaxyTypeField(serializers.Field):
+    """
+    The galaxy type by name, as it was before it became a GalaxyType. Any
+    spelling of the name of a type resolves to it, and unknown names are
+    rejected with the list of the valid ones: only the classification of
+    the legacy free-text types creates types (see galaxies.classification).
+
+    The types are read from memory (see get_types()) once per serializer,
+    instead of joining or fetching the type of each row, and from the
+    database for those created since by another process.
+    """
+
+    default_error_messages = {
+        'invalid': 'Not a valid galaxy type.',
+        'unknown': 'Unknown galaxy type "{name}". Valid types: {names}.',
+        'max_length': 'Ensure this field has no more than {max_length} characters.',
+    }
+
+    def __init__(self, **kwargs):
+        kwargs.setdefault('source', 'galaxy_type_id')
+        super().__init__(**kwargs)
+
+    def get_types(self):
+        """
+        The names of the galaxy types by pk and their pks by lowercase name,
+        kept in the context, which the serializers of a response share.
+        """
+
+        types = self.context.get('galaxy_types')
+
+        if types is None:
+            rows = get_types()
+            types = self.context['galaxy_types'] = (
+                {pk: name for pk, name, _ in rows},
+                {name.lower(): pk for pk, name, _ in rows},
+            )
+
+        return types
+
+    def to_representation(self, value):
+        if value is None:
+            return None
+
+        names, _ = self.get_types()
+
+        if value not in names:
+            names[value] = GalaxyType.objects.filter(pk=value).values_list(
+                'name', flat=True
+            ).first()
+
+        return names[value]
+
+    def to_internal_value(self, data):
+        if not isinstance(data, str) or not normalize_type_name(data):
+            self.fail('invalid')
+
+        name = normalize_type_name(data)
+        max_length = GalaxyType._meta.get_field('name').max_length
+
+        if len(name) > max_length:
+            self.fail('max_length', max_length=max_length)
+
+        names, ids = self.get_types()
+
+        if name.lower() not in ids:
+            galaxy_type = find_galaxy_type(name)
+
+            if galaxy_type is None:
+                self.fail('unknown', name=name, names=', '.join(sorted(names.values())))
+
+            ids[name.lower()] = galaxy_type.pk
+
+        return ids[name.lower()]
+
+
+class TrigramLookupQuerySerializer(serializers.Serializer):
+    """
+    Validates the query parameters of the fuzzy name lookups.
+    """
+
+    q = serializers.CharField(max_length=64)
+    threshold = serializers.FloatField(min_value=0, max_value=1, default=0.3)
+    limit = serializers.IntegerField(min_value=1, max_value=50, default=10)
 
 
 class ConstellationSerializer(FlexFieldsModelSerializer):
+    # Only present in fuzzy lookup results.
+    similarity = serializers.FloatField(read_only=True)
+
     class Meta:
         model = Constellation
-        fields = ['pk', 'name', 'abbreviation', 'area_in_sq_deg']
+        fields = ['pk', 'name', 'abbreviation', 'area_in_sq_deg', 'galaxy_count',
+                  'similarity']
         expandable_fields = {
             'images': ('galaxies.ConstellationImageSerializer', {'many': True}),
             'galaxies': ('galaxies.GalaxySerializer', {'many': True}),
@@ -16,35 +127,129 @@ class ConstellationSerializer(FlexFieldsModelSerializer):
 
 
 class ConstellationImageSerializer(FlexFieldsModelSerializer):
-    image = VersatileImageFieldSerializer(sizes='image_headshot')
+    image = IndexedRenditionsField(sizes='image_headshot')
 
     class Meta:
         model = ConstellationImage
-        fields = ['pk', 'constellation', 'image']
+        fields = ['pk', 'constellation', 'image', 'renditions_ready', 'width', 'height',
+                  'byte_size', 'sha256', 'blurhash']
+
+
+class ConeSearchQuerySerializer(serializers.Serializer):
+    """
+    Validates the query parameters of the cone searches, in degrees.
+    """
+
+    ra = serializers.FloatField(min_value=0, max_value=360)
+    dec = serializers.FloatField(min_value=-90, max_value=90)
+    radius = serializers.FloatField(min_value=0)
+    limit = serializers.IntegerField(min_value=1, max_value=1000, default=100)
+
+    def validate_radius(self, value):
+        max_radius = get_sky_settings()['MAX_CONE_RADIUS']
+
+        if value > max_radius:
+            raise serializers.ValidationError(
+                f'Ensure this value is less than or equal to {max_radius}.'
+            )
+
+        return value
+
+
+class CrossMatchQuerySerializer(serializers.Serializer):
+    """
+    Validates the query parameters of the cross-matches, in degrees.
+    """
+
+    radius = serializers.FloatField(min_value=0, required=False)
+
+    def validate_radius(self, value):
+        max_radius = get_sky_settings()['MAX_CROSS_MATCH_RADIUS']
+
+        if value > max_radius:
+            raise serializers.ValidationError(
+                f'Ensure this value is less than or equal to {max_radius}.'
+            )
+
+        return value
+
+
+class GalaxyStatsQuerySerializer(serializers.Serializer):
+    """
+    Validates the query parameters of the galaxy statistics, besides the
+    filters.
+    """
+
+    group_by = serializers.ChoiceField(choices=GROUP_BY_FIELDS, required=False)
+    bins = serializers.IntegerField(min_value=1, required=False)
+
+    def validate_bins(self, value):
+        max_bins = get_stats_settings()['MAX_BINS']
+
+        if value > max_bins:
+            raise serializers.ValidationError(
+                f'Ensure this value is less than or equal to {max_bins}.'
+            )
+
+        return value
+
+
+class SimilarGalaxiesQuerySerializer(serializers.Serializer):
+    """
+    Validates the query parameters of the similar galaxies.
+    """
+
+    limit = serializers.IntegerField(min_value=1, max_value=100, default=10)
 
 
 class GalaxySerializer(FlexFieldsModelSerializer):
+    galaxy_type = GalaxyTypeField()
+    # Only present in fuzzy lookup and similar galaxies results.
+    similarity = serializers.FloatField(read_only=True)
+    # Only present in cone search results, in degrees.
+    separation = serializers.FloatField(read_only=True)
+    # Computed by the database, when the queryset is annotated with them
+    # (see galaxies.derived).
+    absolute_magnitude = serializers.FloatField(read_only=True)
+    physical_size = serializers.FloatField(read_only=True)
+
     class Meta:
         model = Galaxy
         fields = ['pk', 'name', 'name_origin', 'notes', 'galaxy_type', 'distance',
-                  'apparent_magnitude', 'size', 'owner', 'constellation']
+                  'apparent_magnitude', 'size', 'absolute_magnitude', 'physical_size',
+                  'ra', 'dec', 'owner', 'constellation', 'similarity', 'separation']
         expandable_fields = {
             'images': ('galaxies.GalaxyImageSerializer', {'many': True}),
         }
 
+    def validate(self, attrs):
+        position = [
+            attrs.get(field, getattr(self.instance, field, None)) for field in ('ra', 'dec')
+        ]
+
+        if position.count(None) == 1:
+            raise serializers.ValidationError('Either both ra and dec or neither are set.')
+
+        return attrs
 
 class GalaxyImageSerializer(FlexFieldsModelSerializer):
-    image = VersatileImageFieldSerializer(sizes='image_headshot')
+    image = IndexedRenditionsField(sizes='image_headshot')
 
     class Meta:
         model = GalaxyImage
-        fields = ['pk', 'galaxy', 'image']
+        fields = ['pk', 'galaxy', 'image', 'renditions_ready', 'width', 'height',
+                  'byte_size', 'sha256', 'blurhash']
 
 
 class PostSerializer(FlexFieldsModelSerializer):
+    # Only present in full-text search results.
+    search_rank = serializers.FloatField(read_only=True)
+    search_headline = serializers.CharField(read_only=True)
+
     class Meta:
         model = Post
-        fields = ['pk', 'title', 'content', 'created', 'updated', 'owner']
+        fields = ['pk', 'title', 'content', 'created', 'updated', 'owner',
+                  'comment_count', 'image_count', 'search_rank', 'search_headline']
         expandable_fields = {
             'images': ('galaxies.PostImageSerializer', {'many': True}),
             'comments': ('galaxies.CommentSerializer', {'many': True}),
@@ -52,14 +257,51 @@ class PostSerializer(FlexFieldsModelSerializer):
 
 
 class PostImageSerializer(FlexFieldsModelSerializer):
-    image = VersatileImageFieldSerializer(sizes='image_headshot')
+    image = IndexedRenditionsField(sizes='image_headshot')
 
     class Meta:
         model = PostImage
-        fields = ['pk', 'post', 'image']
+        fields = ['pk', 'post', 'image', 'renditions_ready', 'width', 'height',
+                  'byte_size', 'sha256', 'blurhash']
 
 
 class CommentSerializer(FlexFieldsModelSerializer):
+    # Only present in full-text search results.
+    search_rank = serializers.FloatField(read_only=True)
+    search_headline = serializers.CharField(read_only=True)
+
     class Meta:
         model = Comment
-        fields = ['pk', 'content', 'created', 'updated', 'post', 'owner']
+        fields = ['pk', 'content', 'created', 'updated', 'post', 'owner',
+                  'search_rank', 'search_headline']
+
+
+class UploadSessionSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = UploadSession
+        fields = ['id', 'galaxy', 'post', 'filename', 'size', 'received', 'created',
+                  'expires']
+
+    def validate_filename(self, value):
+        return os.path.basename(value)
+
+    def validate_size(self, value):
+        max_size = get_uploads_settings()['MAX_SIZE']
+
+        if not 0 < value <= max_size:
+            raise serializers.ValidationError(
+                f'Ensure the size is between 1 and {max_size} bytes.'
+            )
+
+        return value
+
+    def validate(self, attrs):
+        targets = [attrs[name] for name in ('galaxy', 'post') if attrs.get(name) is not None]
+
+        if len(targets) != 1:
+            raise serializers.ValidationError('Specify either a galaxy or a post.')
+
+        if targets[0].owner_id != self.context['request'].user.pk:
+            raise PermissionDenied()
+
+        return attrs
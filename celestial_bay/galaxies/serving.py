@@ -0,0 +1,240 @@
+import mimetypes
+import os
+import posixpath
+import re
+from hashlib import sha256
+
+from django.conf import settings
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, parse_http_date_safe
+from django.views.decorators.http import require_safe
+
+from .cache import get_shared_cache
+from .formats import IMAGE_FORMATS
+from .media import FINGERPRINT_REGEX, is_referenced
+
+
+RANGE_REGEX = re.compile(r'^bytes=(?P<start>\d*)-(?P<end>\d*)$')
+
+# The size of the pieces a range is streamed in.
+STREAM_BLOCK_SIZE = 64 * 1024
+
+VISIBLE_KEY_PREFIX = 'galaxies:media:visible:'
+
+
+def get_serving_settings():
+    return {
+        # Hands the body off to the web server in front: 'x-accel-redirect'
+        # (nginx), 'x-sendfile' (Apache, lighttpd), or None to stream it.
+        'OFFLOAD': None,
+        # The internal location nginx serves MEDIA_ROOT from.
+        'ACCEL_REDIRECT_PREFIX': '/protected-media/',
+        # Seconds the files that can change under the same name are cached.
+        'MAX_AGE': 60 * 60,
+        # Seconds the fingerprinted files, which never change, are cached.
+        'IMMUTABLE_MAX_AGE': 365 * 24 * 60 * 60,
+        # Seconds a file found to be visible is served without looking it
+        # up again.
+        'VISIBLE_TIMEOUT': 5 * 60,
+        **getattr(settings, 'GALAXIES_MEDIA_SERVING', {}),
+    }
+
+
+def normalize_media_path(path):
+    """
+    Returns the storage name of a media path, or None for paths outside of
+    MEDIA_ROOT or in hidden directories, such as the incomplete uploads.
+    """
+
+    name = posixpath.normpath(path).lstrip('/')
+
+    if any(part.startswith('.') for part in name.split('/')):
+        return None
+
+    return name
+
+
+def is_visible(name):
+    """
+    Whether a stored file is an image, or a rendition or variant of one, of
+    a row the API exposes. Everything it reads is public, but nothing else in
+    MEDIA_ROOT is: not the incomplete uploads, nor the files of deleted rows.
+
+    The visible names are cached for VISIBLE_TIMEOUT. The files of deleted
+    rows are deleted too, unless another row refers to them, so they can't
+    be served from a stale entry.
+    """
+
+    key = f'{VISIBLE_KEY_PREFIX}{sha256(name.encode("utf-8")).hexdigest()}'
+    shared_cache = get_shared_cache()
+
+    if shared_cache.get(key):
+        return True
+
+    visible = is_referenced(name)
+
+    if visible:
+        shared_cache.set(key, True, timeout=get_serving_settings()['VISIBLE_TIMEOUT'])
+
+    return visible
+
+
+def get_content_type(name):
+    extension = os.path.splitext(name)[1].lstrip('.').lower()
+
+    for format_name, _, media_type in IMAGE_FORMATS:
+        if extension == format_name:
+            return media_type
+
+    return mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+
+def parse_range(header, size):
+    """
+    Returns the (start, end) of the single byte range of a Range header, e.g.
+    'bytes=0-1023' or 'bytes=-500', None when the whole file should be sent
+    instead, or False when the range can't be satisfied.
+    """
+
+    match = RANGE_REGEX.match(header or '')
+
+    if match is None:
+        # Multiple ranges are not supported, the whole file is sent.
+        return None
+
+    start, end = match.group('start'), match.group('end')
+
+    if not start:
+        if not end or int(end) == 0:
+            return False
+
+        return max(size - int(end), 0), size - 1
+
+    start, end = int(start), min(int(end), size - 1) if end else size - 1
+
+    if start > end or start >= size:
+        return False
+
+    return start, end
+
+
+def is_range_fresh(request, etag, last_modified):
+    """
+    Whether the If-Range precondition of a request, if any, still holds.
+    """
+
+    if_range = request.META.get('HTTP_IF_RANGE')
+
+    if not if_range:
+        return True
+
+    if if_range.startswith('"'):
+        return if_range == etag
+
+    return parse_http_date_safe(if_range) == last_modified
+
+
+def stream_range(path, start, length):
+    with open(path, 'rb') as file:
+        file.seek(start)
+
+        while length > 0:
+            block = file.read(min(STREAM_BLOCK_SIZE, length))
+
+            if not block:
+                break
+
+            length -= len(block)
+            yield block
+
+
+def offload(path, name, offload_type):
+    response = HttpResponse()
+
+    if offload_type == 'x-accel-redirect':
+        prefix = get_serving_settings()['ACCEL_REDIRECT_PREFIX']
+        response['X-Accel-Redirect'] = prefix.rstrip('/') + '/' + name
+    else:
+        response['X-Sendfile'] = path
+
+    return response
+
+
+@require_safe
+def serve_media(request, path):
+    """
+    Serves the images under MEDIA_URL, in production too.
+
+        e.g.  https://api.example.org/media/images/ab/cd/abcd...ef.png
+
+    Only the files of the image rows the API exposes are served. Responses
+    have an ETag and Last-Modified to revalidate them with, and support
+    single byte ranges. Fingerprinted files are cached for a year as
+    immutable, since a new content gets a new name.
+
+    The body is handed off to the web server with X-Accel-Redirect or
+    X-Sendfile when set up with the OFFLOAD setting, after the checks are
+    made, and is streamed by the WSGI server's file wrapper otherwise.
+    """
+
+    name = normalize_media_path(path)
+
+    if name is None or not is_visible(name):
+        raise Http404('No such media file.')
+
+    serving_settings = get_serving_settings()
+    full_path = os.path.join(settings.MEDIA_ROOT, name)
+
+    try:
+        stat = os.stat(full_path)
+    except OSError:
+        raise Http404('No such media file.')
+
+    etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+    last_modified = int(stat.st_mtime)
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+
+    if response is None:
+        byte_range = None
+
+        if is_range_fresh(request, etag, last_modified):
+            byte_range = parse_range(request.META.get('HTTP_RANGE'), stat.st_size)
+
+        if byte_range is False:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{stat.st_size}'
+
+            return response
+
+        if serving_settings['OFFLOAD']:
+            # The web server answers the ranges itself.
+            response = offload(full_path, name, serving_settings['OFFLOAD'])
+        elif byte_range is not None:
+            start, end = byte_range
+            response = StreamingHttpResponse(
+                () if request.method == 'HEAD' else
+                stream_range(full_path, start, end - start + 1),
+                status=206
+            )
+            response['Content-Range'] = f'bytes {start}-{end}/{stat.st_size}'
+            response['Content-Length'] = end - start + 1
+        elif request.method == 'HEAD':
+            response = HttpResponse()
+            response['Content-Length'] = stat.st_size
+        else:
+            response = FileResponse(open(full_path, 'rb'))
+
+        response['Content-Type'] = get_content_type(name)
+        response['Accept-Ranges'] = 'bytes'
+
+    if FINGERPRINT_REGEX.search(name):
+        cache_control = f'public, max-age={serving_settings["IMMUTABLE_MAX_AGE"]}, immutable'
+    else:
+        cache_control = f'public, max-age={serving_settings["MAX_AGE"]}'
+
+    response['Cache-Control'] = cache_control
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+
+    return response
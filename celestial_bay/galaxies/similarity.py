@@ -0,0 +1,355 @@
+import time
+from threading import Lock
+
+import numpy as np
+from django.conf import settings
+from django.db import connections, router, transaction
+
+from .cache import get_shared_cache
+from .models import Galaxy
+
+
+# The models whose writes are journaled for the feature matrix.
+SIMILARITY_OBJECTS = (Galaxy,)
+
+# The numeric features of a galaxy, besides its type and constellation.
+NUMERIC_FEATURES = ('distance', 'apparent_magnitude', 'size')
+
+# The counter of the changes journal, whose entries are the pks of the
+# galaxies written by a transaction, under the key of their position.
+JOURNAL_KEY = 'galaxies:similarity:journal'
+
+_matrix = None
+_matrix_lock = Lock()
+
+# The first missing journal entry a read stopped at, and when it was found
+# missing.
+_missing_entry = None
+
+
+def get_similarity_settings():
+    return {
+        # The weights of the features in the difference between galaxies.
+        # The numeric features are standardized, and a different galaxy
+        # type or constellation counts as much as a standard deviation of
+        # difference in a numeric feature of the same weight.
+        'WEIGHTS': {
+            'distance': 1.0,
+            'apparent_magnitude': 1.0,
+            'size': 1.0,
+            'galaxy_type': 1.0,
+            'constellation': 0.5,
+        },
+        # The most journal entries the matrix is refreshed from, beyond which
+        # it is reloaded, and the seconds the entries are kept.
+        'MAX_JOURNAL_ENTRIES': 1000,
+        'JOURNAL_TIMEOUT': 24 * 60 * 60,
+        # Seconds a missing entry is waited for, as still being written,
+        # before it is taken as lost and the matrix is reloaded.
+        'JOURNAL_GRACE': 5,
+        **getattr(settings, 'GALAXIES_SIMILARITY', {}),
+    }
+
+
+def get_numeric_features(distance, apparent_magnitude, size):
+    """
+    The numeric features of galaxies, as a matrix of a row per galaxy, from
+    arrays of their fields. Distances and sizes span orders of magnitude, so
+    they are compared on a log scale, like magnitudes are.
+    """
+
+    return np.column_stack((
+        np.log1p(np.maximum(distance, 0)),
+        apparent_magnitude,
+        np.log1p(np.maximum(size, 0)),
+    )).astype(np.float64)
+
+
+class FeatureMatrix:
+    """
+    The features of all the galaxies in memory, sorted by pk: the numeric
+    ones standardized, as float32 rows of a feature each, so that a search
+    streams through contiguous memory, and the galaxy type and
+    constellation pks.
+
+    The scales the numeric features are standardized with are those of the
+    catalog when the matrix was loaded, and are kept as it is refreshed.
+    """
+
+    def __init__(self, pks, features, types, constellations, scales, position=None):
+        order = np.argsort(pks, kind='stable')
+
+        self.pks, self.features = pks[order], np.ascontiguousarray(features[:, order])
+        self.types, self.constellations = types[order], constellations[order]
+        self.scales = scales
+        self.position = position
+
+    def __len__(self):
+        return len(self.pks)
+
+    @staticmethod
+    def get_columns(rows):
+        """
+        Converts (pk, features...) rows to arrays, the numeric features not
+        yet standardized.
+        """
+
+        columns = list(zip(*rows)) or [()] * 6
+        numeric = (np.array(column, dtype=np.float64) for column in columns[1:4])
+
+        return (
+            np.array(columns[0], dtype=np.int64),
+            get_numeric_features(*numeric),
+            # Galaxies without a type differ from all the others.
+            np.array([-1 if pk is None else pk for pk in columns[4]], dtype=np.int32),
+            np.array(columns[5], dtype=np.int32),
+        )
+
+    @staticmethod
+    def standardize(numeric, scales):
+        return (numeric / scales).T.astype(np.float32)
+
+    @classmethod
+    def from_rows(cls, rows, position=None):
+        pks, numeric, types, constellations = cls.get_columns(rows)
+        scales = np.std(numeric, axis=0) if len(numeric) else np.ones(numeric.shape[1])
+        scales[scales == 0] = 1
+
+        return cls(
+            pks, cls.standardize(numeric, scales), types, constellations, scales,
+            position=position,
+        )
+
+    def refreshed(self, pks, rows, position):
+        """
+        Returns a copy of the matrix with the rows of the galaxies of pks
+        replaced by the (pk, features...) rows read from the database, those
+        missing from them having been deleted.
+        """
+
+        new_pks, numeric, types, constellations = self.get_columns(rows)
+        keep = ~np.isin(self.pks, np.array(list(pks), dtype=np.int64))
+
+        return FeatureMatrix(
+            np.concatenate((self.pks[keep], new_pks)),
+            np.concatenate(
+                (self.features[:, keep], self.standardize(numeric, self.scales)), axis=1
+            ),
+            np.concatenate((self.types[keep], types)),
+            np.concatenate((self.constellations[keep], constellations)),
+            self.scales,
+            position=position,
+        )
+
+    def get_squared_differences(self, numeric, galaxy_type, constellation):
+        """
+        The squares of the weighted differences between a galaxy, given its
+        numeric features, type and constellation, and all the galaxies of the
+        matrix, computed in place feature by feature.
+        """
+
+        weights = get_similarity_settings()['WEIGHTS']
+        query = numeric / self.scales
+        squares = np.zeros(len(self), dtype=np.float32)
+
+        for features, name, value in zip(self.features, NUMERIC_FEATURES, query):
+            offsets = features - np.float32(value)
+            offsets *= np.float32(weights[name])
+            offsets *= offsets
+            squares += offsets
+
+        np.add(
+            squares, np.float32(weights['galaxy_type'] ** 2), out=squares,
+            where=self.types != (-1 if galaxy_type is None else galaxy_type)
+        )
+        np.add(
+            squares, np.float32(weights['constellation'] ** 2), out=squares,
+            where=self.constellations != constellation
+        )
+
+        return squares
+
+    def nearest(self, numeric, galaxy_type, constellation, limit, exclude=None):
+        """
+        Returns the pks of the limit galaxies nearest to the features, the
+        nearest first, and their differences. The galaxy of pk exclude, the
+        one the features are of, is left out.
+        """
+
+        squares = self.get_squared_differences(numeric, galaxy_type, constellation)
+
+        if exclude is not None:
+            index = np.searchsorted(self.pks, exclude)
+
+            if index < len(self) and self.pks[index] == exclude:
+                squares[index] = np.inf
+                limit = min(limit, len(self) - 1)
+
+        limit = min(limit, len(self))
+
+        if limit <= 0:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+
+        # Brute-force top-k: the limit smallest in linear time, then sorted.
+        nearest = np.argpartition(squares, limit - 1)[:limit]
+        nearest = nearest[np.lexsort((self.pks[nearest], squares[nearest]))]
+
+        return self.pks[nearest], np.sqrt(squares[nearest].astype(np.float64))
+
+
+def load_feature_rows(pks=None):
+    """
+    Reads the (pk, features...) rows of all the galaxies, or of those of pks,
+    with a single query.
+    """
+
+    connection = connections[router.db_for_read(Galaxy)]
+    table = connection.ops.quote_name(Galaxy._meta.db_table)
+    query = (
+        f'SELECT id, distance, apparent_magnitude, size, galaxy_type_id, constellation_id '
+        f'FROM {table}'
+    )
+
+    with connection.cursor() as cursor:
+        if pks is None:
+            cursor.execute(query)
+        else:
+            cursor.execute(f'{query} WHERE id = ANY(%s)', [list(pks)])
+
+        return cursor.fetchall()
+
+
+def record_changes(pks):
+    """
+    Appends the pks of written galaxies to the changes journal once the
+    transaction commits, for the feature matrices of every process to
+    refresh those rows.
+    """
+
+    pks = list(pks)
+    transaction.on_commit(lambda: _append_to_journal(pks))
+
+
+def _append_to_journal(pks):
+    shared_cache = get_shared_cache()
+
+    try:
+        position = shared_cache.incr(JOURNAL_KEY)
+    except ValueError:
+        # The journal restarts from a new origin, which makes every matrix
+        # reload, this change included.
+        shared_cache.add(JOURNAL_KEY, time.time_ns(), timeout=None)
+        return
+
+    shared_cache.set(
+        f'{JOURNAL_KEY}:{position}', pks,
+        timeout=get_similarity_settings()['JOURNAL_TIMEOUT']
+    )
+
+
+def record_change_on_write(sender, instance, raw=False, **kwargs):
+    """
+    post_save/post_delete receiver that journals the written galaxy.
+    """
+
+    if not raw:
+        record_changes([instance.pk])
+
+
+def read_journal(since):
+    """
+    Returns the position of the journal and the pks of the galaxies written
+    after the position since, or None as the pks when they can't be read and
+    the matrix has to be reloaded.
+
+    Entries still being written end the read, which stops at the last entry
+    before them, so that they are read by the next one. Entries missing for
+    longer than JOURNAL_GRACE, evicted or never written by a process that
+    died, can't be read any more.
+
+    Called under the lock of the matrix.
+    """
+
+    shared_cache = get_shared_cache()
+    position = shared_cache.get(JOURNAL_KEY)
+
+    if position is None:
+        # The time, so that the journal never restarts from a position a
+        # matrix has already been refreshed to, as with the cache versions.
+        shared_cache.add(JOURNAL_KEY, time.time_ns(), timeout=None)
+        return shared_cache.get(JOURNAL_KEY), None
+
+    max_entries = get_similarity_settings()['MAX_JOURNAL_ENTRIES']
+
+    if since is None or position < since or position - since > max_entries:
+        return position, None
+
+    entries = shared_cache.get_many([
+        f'{JOURNAL_KEY}:{entry}' for entry in range(since + 1, position + 1)
+    ])
+    pks = set()
+
+    for entry in range(since + 1, position + 1):
+        key = f'{JOURNAL_KEY}:{entry}'
+
+        if key not in entries:
+            return (position, None) if is_lost(entry) else (entry - 1, pks)
+
+        pks.update(entries[key])
+
+    return position, pks
+
+
+def is_lost(entry):
+    """
+    Whether a missing journal entry has been missing for JOURNAL_GRACE since
+    a read first stopped at it.
+    """
+
+    global _missing_entry
+
+    now = time.monotonic()
+
+    if _missing_entry is None or _missing_entry[0] != entry:
+        _missing_entry = (entry, now)
+
+    return now - _missing_entry[1] > get_similarity_settings()['JOURNAL_GRACE']
+
+
+def get_feature_matrix():
+    """
+    The feature matrix of the galaxies, kept in memory, and refreshed with the
+    rows of the galaxies written since, read from the changes journal, or
+    reloaded when they can't be.
+    """
+
+    global _matrix
+
+    with _matrix_lock:
+        position, pks = read_journal(_matrix.position if _matrix is not None else None)
+
+        if pks is None:
+            # The position is read first, so the changes made while loading
+            # are applied again by the next refresh.
+            _matrix = FeatureMatrix.from_rows(load_feature_rows(), position=position)
+        elif position != _matrix.position:
+            _matrix = _matrix.refreshed(pks, load_feature_rows(pks) if pks else [], position)
+
+        return _matrix
+
+
+def find_similar(galaxy, limit=10):
+    """
+    Returns the (pk, difference) of the limit galaxies most similar to a
+    galaxy, the most similar first.
+    """
+
+    matrix = get_feature_matrix()
+    numeric = get_numeric_features(
+        *(np.array([getattr(galaxy, name)], dtype=np.float64) for name in NUMERIC_FEATURES)
+    )[0]
+    pks, differences = matrix.nearest(
+        numeric, galaxy.galaxy_type_id, galaxy.constellation_id, limit, exclude=galaxy.pk
+    )
+
+    return list(zip(pks.tolist(), differences.tolist()))
@@ -0,0 +1,163 @@
+from math import atan, ceil, cos, degrees, floor, radians, sin, sqrt
+
+import numpy as np
+from django.conf import settings
+from django.db.models import F, Q, Value
+from django.db.models.functions import Floor, Least
+
+from .models import Galaxy
+
+
+# The models with a position on the sky and a sky index key.
+SKY_OBJECTS = (Galaxy,)
+
+
+def get_sky_settings():
+    return {
+        # The height in degrees of the declination zones the sky index is
+        # made of. Run rebuild_sky_index after changing it.
+        'ZONE_HEIGHT': 0.5,
+        # The largest radius in degrees of a cone search.
+        'MAX_CONE_RADIUS': 10,
+        # The default and largest match radius in degrees of a cross-match,
+        # and the most positions it takes at once.
+        'CROSS_MATCH_RADIUS': 5 / 3600,
+        'MAX_CROSS_MATCH_RADIUS': 0.1,
+        'MAX_CROSS_MATCH_ROWS': 200000,
+        # The number of resolutions of the sky map tiles, the cells of each
+        # being a quarter of those of the previous one, the number of times
+        # a map tile is split into cells per side, and the seconds the tiles
+        # are cached by clients.
+        'TILE_LEVELS': 9,
+        'TILE_DETAIL': 4,
+        'TILE_MAX_AGE': 24 * 60 * 60,
+        **getattr(settings, 'GALAXIES_SKY', {}),
+    }
+
+
+def get_zone_count():
+    return ceil(180 / get_sky_settings()['ZONE_HEIGHT'])
+
+
+def get_zone(dec):
+    """
+    The declination zone of the sky index a declination falls in, from 0 at
+    the south pole.
+    """
+
+    return min(floor((dec + 90) / get_sky_settings()['ZONE_HEIGHT']), get_zone_count() - 1)
+
+
+def get_zone_expression():
+    """
+    get_zone() as a database expression, for set-based updates.
+    """
+
+    return Least(
+        Floor((F('dec') + Value(90.0)) / Value(float(get_sky_settings()['ZONE_HEIGHT']))),
+        Value(get_zone_count() - 1),
+    )
+
+
+def update_sky_zone(instance):
+    if instance.ra is None or instance.dec is None:
+        instance.sky_zone = None
+    else:
+        instance.ra %= 360
+        instance.sky_zone = get_zone(instance.dec)
+
+
+def update_sky_zone_on_save(sender, instance, raw=False, **kwargs):
+    """
+    pre_save receiver that keeps the sky index key of a galaxy in step with
+    its position.
+    """
+
+    if not raw:
+        update_sky_zone(instance)
+
+
+def update_sky_index(queryset):
+    """
+    Recomputes the sky index key of the rows in the queryset in the database,
+    with a single UPDATE.
+    """
+
+    return queryset.update(sky_zone=get_zone_expression())
+
+
+def get_ra_half_width(dec, radius):
+    """
+    The largest right ascension offset, in degrees, of the points of a cone,
+    or 180 when the cone contains a pole.
+    """
+
+    if abs(dec) + radius > 89.9:
+        return 180
+
+    return degrees(atan(
+        sin(radians(radius))
+        / sqrt(abs(cos(radians(dec - radius)) * cos(radians(dec + radius))))
+    ))
+
+
+def get_cone_lookup(ra, dec, radius):
+    """
+    A lookup of the galaxies in the box around a cone, backed by the index on
+    (sky_zone, ra): the zones the cone overlaps, and its right ascension
+    range, in two parts when it wraps around 0h.
+    """
+
+    zones = range(get_zone(max(dec - radius, -90)), get_zone(min(dec + radius, 90)) + 1)
+    lookup = Q(sky_zone__in=list(zones))
+    half_width = get_ra_half_width(dec, radius)
+
+    if half_width >= 180:
+        return lookup
+
+    low, high = ra - half_width, ra + half_width
+
+    if low < 0:
+        return lookup & (Q(ra__gte=low + 360) | Q(ra__lte=high))
+
+    if high >= 360:
+        return lookup & (Q(ra__gte=low) | Q(ra__lte=high - 360))
+
+    return lookup & Q(ra__range=(low, high))
+
+
+def angular_separation(ra, dec, other_ra, other_dec):
+    """
+    The great-circle distances in degrees between positions in degrees, with
+    the haversine formula, which is accurate at small separations. Takes and
+    returns NumPy arrays.
+    """
+
+    ra, dec, other_ra, other_dec = (
+        np.radians(value) for value in (ra, dec, other_ra, other_dec)
+    )
+    haversine = (
+        np.sin((other_dec - dec) / 2) ** 2
+        + np.cos(dec) * np.cos(other_dec) * np.sin((other_ra - ra) / 2) ** 2
+    )
+
+    return np.degrees(2 * np.arcsin(np.sqrt(np.clip(haversine, 0, 1))))
+
+
+def cone_search(queryset, ra, dec, radius, limit=None):
+    """
+    Returns the (pk, separation in degrees) of the galaxies of the queryset
+    within radius degrees of a position, nearest first.
+
+    The candidates in the box around the cone are read from the sky index,
+    and their exact separations computed at once with NumPy.
+    """
+
+    rows = queryset.filter(get_cone_lookup(ra, dec, radius)).values_list('pk', 'ra', 'dec')
+    candidates = np.array(list(rows), dtype=np.float64).reshape(-1, 3)
+
+    separations = angular_separation(ra, dec, candidates[:, 1], candidates[:, 2])
+    inside = np.flatnonzero(separations <= radius)
+    nearest = inside[np.argsort(separations[inside], kind='stable')][:limit]
+
+    return [(int(candidates[i, 0]), float(separations[i])) for i in nearest]
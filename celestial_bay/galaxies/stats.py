@@ -0,0 +1,187 @@
+from django.conf import settings
+from django.contrib.postgres.fields import ArrayField
+from django.db.models import Aggregate, Avg, Count, F, FloatField, Func, IntegerField, Max,\
+    Min, Value
+from django.db.models.functions import Least
+
+from .classification import get_type_names
+
+
+# The numeric fields of the galaxies the statistics are computed for, and
+# the fields they can be grouped by.
+STATS_FIELDS = ('distance', 'apparent_magnitude', 'size')
+GROUP_BY_FIELDS = ('galaxy_type', 'constellation')
+
+
+def get_stats_settings():
+    return {
+        # The percentiles of the distributions, as fractions.
+        'PERCENTILES': (0.05, 0.25, 0.5, 0.75, 0.95),
+        # The default and largest number of bins of the histograms.
+        'BINS': 10,
+        'MAX_BINS': 100,
+        **getattr(settings, 'GALAXIES_STATS', {}),
+    }
+
+
+class PercentileCont(Aggregate):
+    """
+    The continuous percentiles of an expression, as an array, with the
+    percentile_cont() ordered-set aggregate of PostgreSQL.
+    """
+
+    function = 'percentile_cont'
+    template = '%(function)s(%(percentiles)s) WITHIN GROUP (ORDER BY %(expressions)s)'
+    output_field = ArrayField(FloatField())
+
+    def __init__(self, expression, percentiles, **extra):
+        # Validated numbers, so they can be inlined.
+        percentiles = 'ARRAY[%s]::double precision[]' % ', '.join(
+            repr(float(percentile)) for percentile in percentiles
+        )
+        super().__init__(expression, percentiles=percentiles, **extra)
+
+
+class WidthBucket(Func):
+    """
+    The bin, from 1 to bins, an expression falls in among bins equal bins
+    between low and high, with width_bucket(). The values beyond the bounds
+    fall in the bins 0 and bins + 1.
+    """
+
+    function = 'width_bucket'
+    output_field = IntegerField()
+
+    def __init__(self, expression, low, high, bins, **extra):
+        super().__init__(expression, Value(float(low)), Value(float(high)), Value(int(bins)),
+                         **extra)
+
+
+def get_percentile_key(percentile):
+    return f'{percentile * 100:g}'
+
+
+def get_summaries(queryset, group_by=None):
+    """
+    Returns the count of the rows of the queryset and the min, max, mean and
+    percentiles of every field of STATS_FIELDS, per value of the group_by
+    field, or of the whole queryset, with a single GROUP BY query.
+    """
+
+    percentiles = get_stats_settings()['PERCENTILES']
+    aggregates = {'count': Count('pk')}
+
+    for field in STATS_FIELDS:
+        aggregates.update({
+            f'{field}__min': Min(field),
+            f'{field}__max': Max(field),
+            f'{field}__mean': Avg(field),
+            f'{field}__percentiles': PercentileCont(field, percentiles),
+        })
+
+    queryset = queryset.order_by()
+
+    if group_by is None:
+        rows = [queryset.aggregate(**aggregates)]
+    else:
+        rows = queryset.values(group_by).annotate(**aggregates).order_by(group_by)
+
+    summaries = []
+
+    for row in rows:
+        summary = {'count': row['count']}
+
+        if group_by is not None:
+            summary[group_by] = row[group_by]
+
+        for field in STATS_FIELDS:
+            values = row[f'{field}__percentiles'] or [None] * len(percentiles)
+            summary[field] = {
+                'min': row[f'{field}__min'],
+                'max': row[f'{field}__max'],
+                'mean': row[f'{field}__mean'],
+                'percentiles': {
+                    get_percentile_key(percentile): value
+                    for percentile, value in zip(percentiles, values)
+                },
+            }
+
+        summaries.append(summary)
+
+    return summaries
+
+
+def get_histograms(queryset, field, low, high, bins, group_by=None):
+    """
+    Returns the counts of the values of a field in bins equal bins between
+    low and high, by value of the group_by field, or under None, with a
+    single GROUP BY query. The high bound falls in the last bin.
+    """
+
+    bucket = Least(WidthBucket(F(field), low, high, bins), Value(bins))
+    rows = (
+        queryset.order_by()
+        .filter(**{f'{field}__isnull': False})
+        .values(*([group_by] if group_by else []), bucket=bucket)
+        .annotate(count=Count('pk'))
+    )
+    histograms = {}
+
+    for row in rows:
+        counts = histograms.setdefault(row.get(group_by), [0] * bins)
+        counts[row['bucket'] - 1] = row['count']
+
+    return histograms
+
+
+def get_stats(queryset, group_by=None, bins=None):
+    """
+    Computes the distributions of STATS_FIELDS over the galaxies of the
+    queryset, per group if group_by is given, all of it in the database.
+
+    The histograms of a field share the same bins in all the groups, evenly
+    spread between the smallest and the largest value of the queryset, so
+    that they can be compared.
+    """
+
+    bins = bins or get_stats_settings()['BINS']
+    summaries = get_summaries(queryset, group_by)
+    fields = {}
+
+    for field in STATS_FIELDS:
+        # Groups without values have None bounds.
+        bounds = [
+            (summary[field]['min'], summary[field]['max']) for summary in summaries
+            if summary[field]['min'] is not None
+        ]
+        histograms, bin_edges = {}, []
+
+        if bounds:
+            low, high = min(low for low, _ in bounds), max(high for _, high in bounds)
+
+            if high <= low:
+                # width_bucket() needs a range, all the values fall in the
+                # first bin.
+                high = low + 1
+
+            histograms = get_histograms(queryset, field, low, high, bins, group_by)
+            bin_edges = [low + (high - low) * i / bins for i in range(bins + 1)]
+
+        fields[field] = {'bin_edges': bin_edges}
+
+        for summary in summaries:
+            summary[field]['histogram'] = histograms.get(summary.get(group_by), [0] * bins)
+
+    if group_by == 'galaxy_type':
+        # Grouped by code, and named like the galaxies name their type.
+        names = get_type_names()
+
+        for summary in summaries:
+            summary['galaxy_type'] = names.get(summary['galaxy_type'])
+
+    return {
+        'group_by': group_by,
+        'bins': bins,
+        'fields': fields,
+        'groups': summaries,
+    }
@@ -0,0 +1,152 @@
+import os
+import re
+import tempfile
+from hashlib import sha256
+
+from django.conf import settings
+from django.core.files.storage import FileSystemStorage
+from django.db import DEFAULT_DB_ALIAS, connections, router, transaction
+from django.utils.deconstruct import deconstructible
+
+
+def get_storage_settings():
+    return {
+        # The upload directories whose files are content addressed.
+        'UPLOAD_DIRS': ('images',),
+        # The number of nested prefix directories and their name length.
+        'SHARD_DEPTH': 2,
+        'SHARD_WIDTH': 2,
+        **getattr(settings, 'GALAXIES_MEDIA_STORAGE', {}),
+    }
+
+
+def get_content_name(directory, digest, extension):
+    """
+    The name of a blob, e.g. images/ab/cd/abcd...ef.png for a digest starting
+    with abcd.
+    """
+
+    storage_settings = get_storage_settings()
+    width = storage_settings['SHARD_WIDTH']
+    shards = [
+        digest[i * width:(i + 1) * width] for i in range(storage_settings['SHARD_DEPTH'])
+    ]
+
+    return '/'.join([directory, *shards, digest + extension.lower()])
+
+
+CONTENT_NAME_REGEX = re.compile(r'(?:^|/)(?P<digest>[0-9a-f]{64})(?:\.\w+)?$')
+
+
+def get_content_digest(name):
+    """
+    Returns the SHA-256 digest a content addressed name is made of, or None
+    for other names.
+    """
+
+    match = CONTENT_NAME_REGEX.search(name or '')
+
+    return match.group('digest') if match else None
+
+
+def lock_content(digest, using=DEFAULT_DB_ALIAS):
+    """
+    Takes the advisory lock of a content digest until the end of the
+    transaction. Storing a blob for a new row and deleting it once no row
+    refers to it (see galaxies.media) both hold it, so a blob can't be
+    deleted between being linked to a row and the row being committed.
+    """
+
+    with connections[using].cursor() as cursor:
+        # The first 60 bits of the digest, as a bigint key.
+        cursor.execute('SELECT pg_advisory_xact_lock(%s)', [int(digest[:15], 16)])
+
+
+class ContentAddressedModelMixin:
+    """
+    For models with a file field in a ContentAddressedStorage.
+
+    Saves in a transaction, so that the lock of the content the storage
+    takes when the file is stored is held until the row that refers to it
+    is committed.
+    """
+
+    def save(self, *args, **kwargs):
+        using = kwargs.get('using') or router.db_for_write(type(self), instance=self)
+
+        with transaction.atomic(using=using):
+            super().save(*args, **kwargs)
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    A file system storage that names the files uploaded to the UPLOAD_DIRS
+    by the SHA-256 of their content, in nested prefix directories, e.g.
+
+        images/galaxy.png  ->  images/ab/cd/abcd...ef.png
+
+    so that no directory grows past a few thousand entries and identical
+    uploads are stored once. Blobs are shared by every row that uploads the
+    same content, and are only deleted once no row refers to them (see
+    galaxies.media), under the lock of their digest (see lock_content()).
+
+    Every other file, e.g. the renditions, which are named after their
+    original and so are sharded along with it, is stored as usual.
+    """
+
+    def is_content_addressed(self, name):
+        return os.path.dirname(name).strip('/') in get_storage_settings()['UPLOAD_DIRS']
+
+    def get_available_name(self, name, max_length=None):
+        if self.is_content_addressed(name):
+            # The final name is only known once the content is hashed.
+            return name
+
+        return super().get_available_name(name, max_length=max_length)
+
+    def _save(self, name, content):
+        if not self.is_content_addressed(name):
+            return super()._save(name, content)
+
+        incoming = self.path('.incoming')
+        os.makedirs(incoming, exist_ok=True)
+        digest = sha256()
+        fd, temporary_path = tempfile.mkstemp(dir=incoming)
+
+        try:
+            # Hashes the content while streaming it to a temporary file, in
+            # a single pass, and then links it under its final name.
+            with os.fdopen(fd, 'wb') as file:
+                for chunk in content.chunks():
+                    digest.update(chunk)
+                    file.write(chunk)
+
+            if self.file_permissions_mode is not None:
+                os.chmod(temporary_path, self.file_permissions_mode)
+
+            directory, filename = os.path.split(name)
+            name = get_content_name(
+                directory, digest.hexdigest(), os.path.splitext(filename)[1]
+            )
+            path = self.path(name)
+            os.makedirs(
+                os.path.dirname(path),
+                mode=self.directory_permissions_mode or 0o777,
+                exist_ok=True
+            )
+
+            # Until the row is committed, see ContentAddressedModelMixin.
+            with transaction.atomic():
+                lock_content(digest.hexdigest())
+
+                try:
+                    os.link(temporary_path, path)
+                except FileExistsError:
+                    # The same content is stored already. It is touched, so
+                    # that the garbage collector sees it as recently stored.
+                    os.utime(path)
+        finally:
+            os.unlink(temporary_path)
+
+        return name
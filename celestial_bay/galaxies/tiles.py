@@ -0,0 +1,309 @@
+from collections import defaultdict
+
+import numpy as np
+from django.db import connections, router, transaction
+
+from .cache import bump_versions, get_version_key
+from .models import Galaxy, SkyTile
+from .sky import get_sky_settings
+
+
+# The fields of a galaxy its contribution to the tiles depends on.
+TILE_FIELDS = ('ra', 'dec', 'apparent_magnitude')
+
+
+def get_levels():
+    """
+    The levels the tiles are read from (see get_tile()), the only ones that
+    are stored. The coarser ones, of a few cells each, would otherwise be
+    locked by the writes of galaxies anywhere in the sky until they commit.
+    """
+
+    sky_settings = get_sky_settings()
+    max_level = sky_settings['TILE_LEVELS'] - 1
+
+    return range(min(sky_settings['TILE_DETAIL'], max_level), max_level + 1)
+
+
+def get_grid(level):
+    """
+    The (rows, columns) of the cells of a level: 2**level rows of declination
+    from the north pole down, by twice as many columns of right ascension
+    from 0h, so that the cells of a level split in four at the next one.
+    """
+
+    return 2 ** level, 2 ** (level + 1)
+
+
+def get_cells(ra, dec, level):
+    """
+    The cells of a level that positions, as arrays of degrees, fall in.
+    """
+
+    rows, columns = get_grid(level)
+    row = np.clip(np.floor((90 - dec) / (180 / rows)), 0, rows - 1).astype(np.int64)
+    column = np.clip(np.floor(ra / (360 / columns)), 0, columns - 1).astype(np.int64)
+
+    return row * columns + column
+
+
+def apply_tile_changes(removed, added):
+    """
+    Takes the (ra, dec, apparent magnitude) of galaxies out of the tiles of
+    every stored level and adds others, with a single upsert of the changed
+    cells.
+    """
+
+    deltas = defaultdict(lambda: [0, 0.0])
+
+    for contributions, sign in ((removed, -1), (added, 1)):
+        contributions = [values for values in contributions if None not in values[:2]]
+
+        if not contributions:
+            continue
+
+        ra, dec, magnitude = np.array(contributions, dtype=np.float64).reshape(-1, 3).T
+        magnitude = np.nan_to_num(magnitude)
+
+        for level in get_levels():
+            for cell, value in zip(get_cells(ra, dec, level).tolist(), magnitude.tolist()):
+                delta = deltas[level, cell]
+                delta[0] += sign
+                delta[1] += sign * value
+
+    deltas = sorted(
+        (key, delta) for key, delta in deltas.items() if delta[0] or delta[1]
+    )
+    decrements = [(key, delta) for key, delta in deltas if delta[0] < 0]
+    increments = [(key, delta) for key, delta in deltas if delta[0] >= 0]
+
+    connection = connections[router.db_for_write(SkyTile)]
+    table = connection.ops.quote_name(SkyTile._meta.db_table)
+
+    # The cells are changed in place, so concurrent writes to the same cell
+    # add up. All the existing cells are locked first, in order, so that
+    # concurrent writes, e.g. moving galaxies between two cells both ways,
+    # can't lock them in opposite orders; the missing ones are inserted in
+    # order too.
+    with connection.cursor() as cursor:
+        if deltas:
+            cursor.execute(
+                f'SELECT 1 FROM {table} '
+                f'WHERE (level, cell) IN ('
+                f'VALUES {", ".join(["(%s::smallint, %s::integer)"] * len(deltas))}) '
+                f'ORDER BY level, cell FOR UPDATE',
+                [value for (level, cell), _ in deltas for value in (level, cell)]
+            )
+
+        if decrements:
+            cursor.execute(
+                f'UPDATE {table} AS tile '
+                f'SET count = GREATEST(tile.count + deltas.count, 0), '
+                f'magnitude_sum = tile.magnitude_sum + deltas.magnitude_sum '
+                f'FROM (VALUES {_placeholders(decrements)}) '
+                f'AS deltas (level, cell, count, magnitude_sum) '
+                f'WHERE tile.level = deltas.level AND tile.cell = deltas.cell',
+                _params(decrements)
+            )
+
+        if increments:
+            cursor.execute(
+                f'INSERT INTO {table} AS tile (level, cell, count, magnitude_sum) '
+                f'VALUES {_placeholders(increments)} '
+                f'ON CONFLICT (level, cell) DO UPDATE '
+                f'SET count = tile.count + EXCLUDED.count, '
+                f'magnitude_sum = tile.magnitude_sum + EXCLUDED.magnitude_sum',
+                _params(increments)
+            )
+
+    if deltas:
+        bump_versions([get_version_key(SkyTile)])
+
+
+def _placeholders(deltas):
+    return ', '.join(['(%s::smallint, %s::integer, %s::integer, %s::float)'] * len(deltas))
+
+
+def _params(deltas):
+    return [
+        value for (level, cell), (count, magnitude_sum) in deltas
+        for value in (level, cell, count, magnitude_sum)
+    ]
+
+
+def get_tile_contribution(instance):
+    return tuple(getattr(instance, field) for field in TILE_FIELDS)
+
+
+def remember_tile_contribution(sender, instance, raw=False, update_fields=None, **kwargs):
+    """
+    pre_save receiver that remembers the position and magnitude of a galaxy
+    before an update, to take it out of the tiles it was counted in.
+    """
+
+    instance._tile_contribution = None
+
+    if raw or instance._state.adding:
+        return
+
+    if update_fields is not None and not set(TILE_FIELDS).intersection(update_fields):
+        return
+
+    instance._tile_contribution = sender._default_manager.filter(
+        pk=instance.pk
+    ).values_list(*TILE_FIELDS).first()
+
+
+def update_tiles_on_save(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+
+    previous = getattr(instance, '_tile_contribution', None)
+    current = get_tile_contribution(instance)
+
+    if created:
+        apply_tile_changes([], [current])
+    elif previous is not None and previous != current:
+        apply_tile_changes([previous], [current])
+
+
+def update_tiles_on_delete(sender, instance, **kwargs):
+    apply_tile_changes([get_tile_contribution(instance)], [])
+
+
+def update_tiles_in_bulk(instances, previous=None):
+    """
+    Updates the tiles after a bulk_create, or after a bulk_update given the
+    previous field values of the instances by pk, as bulk writes send no
+    signals.
+    """
+
+    removed, added = [], []
+
+    for instance in instances:
+        current = get_tile_contribution(instance)
+
+        if previous is None:
+            added.append(current)
+            continue
+
+        before = tuple(previous[instance.pk][field] for field in TILE_FIELDS)
+
+        if before != current:
+            removed.append(before)
+            added.append(current)
+
+    apply_tile_changes(removed, added)
+
+
+def load_tile_contributions():
+    """
+    Reads the position and magnitude of all the positioned galaxies with a
+    single query.
+    """
+
+    connection = connections[router.db_for_read(Galaxy)]
+    table = connection.ops.quote_name(Galaxy._meta.db_table)
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'SELECT ra, dec, apparent_magnitude FROM {table} '
+            f'WHERE ra IS NOT NULL AND dec IS NOT NULL'
+        )
+
+        return np.array(cursor.fetchall(), dtype=np.float64).reshape(-1, 3)
+
+
+def rebuild_tiles(batch_size=5000):
+    """
+    Recomputes all the tiles from the galaxies, binning them at every level
+    at once with NumPy, and returns the number of tiles. Galaxies can't be
+    written to in the meantime.
+    """
+
+    connection = connections[router.db_for_write(SkyTile)]
+
+    with transaction.atomic(using=connection.alias):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'LOCK TABLE {connection.ops.quote_name(Galaxy._meta.db_table)} IN SHARE MODE'
+            )
+
+        ra, dec, magnitude = load_tile_contributions().T
+        magnitude = np.nan_to_num(magnitude)
+        tiles = []
+
+        for level in get_levels():
+            rows, columns = get_grid(level)
+            cells = get_cells(ra, dec, level)
+            counts = np.bincount(cells, minlength=rows * columns)
+            sums = np.bincount(cells, weights=magnitude, minlength=rows * columns)
+            occupied = np.flatnonzero(counts)
+
+            tiles.extend(
+                SkyTile(level=level, cell=cell, count=count, magnitude_sum=magnitude_sum)
+                for cell, count, magnitude_sum in zip(
+                    occupied.tolist(), counts[occupied].tolist(), sums[occupied].tolist()
+                )
+            )
+
+        SkyTile.objects.all().delete()
+        SkyTile.objects.bulk_create(tiles, batch_size=batch_size)
+
+    bump_versions([get_version_key(SkyTile)])
+
+    return len(tiles)
+
+
+def get_tile(zoom, x, y):
+    """
+    Returns the counts and mean magnitudes of the cells of a map tile, as
+    dense arrays of rows from north to south, or None if there is no such
+    tile.
+
+    The tiles of a zoom level are laid out like the cells of the level of the
+    same number, and are made of 2**TILE_DETAIL cells per side of a finer
+    level, or of as many cells as the finest level has.
+    """
+
+    sky_settings = get_sky_settings()
+    max_level = sky_settings['TILE_LEVELS'] - 1
+    tile_rows, tile_columns = get_grid(zoom)
+
+    if not (0 <= zoom <= max_level and 0 <= x < tile_columns and 0 <= y < tile_rows):
+        return None
+
+    level = min(zoom + sky_settings['TILE_DETAIL'], max_level)
+    size = 2 ** (level - zoom)
+    _, columns = get_grid(level)
+    row_range = np.arange(y * size, (y + 1) * size)
+    column_range = np.arange(x * size, (x + 1) * size)
+    cells = (row_range[:, None] * columns + column_range[None, :]).ravel()
+
+    counts = np.zeros(len(cells), dtype=np.int64)
+    sums = np.zeros(len(cells))
+    positions = {cell: index for index, cell in enumerate(cells.tolist())}
+
+    for cell, count, magnitude_sum in SkyTile.objects.filter(
+            level=level, cell__in=list(positions)).values_list('cell', 'count', 'magnitude_sum'):
+        counts[positions[cell]] = count
+        sums[positions[cell]] = magnitude_sum
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.where(counts > 0, sums / counts, np.nan)
+
+    ra_span, dec_span = 360 / tile_columns, 180 / tile_rows
+
+    return {
+        'zoom': zoom,
+        'x': x,
+        'y': y,
+        'level': level,
+        'ra': [x * ra_span, (x + 1) * ra_span],
+        'dec': [90 - (y + 1) * dec_span, 90 - y * dec_span],
+        'counts': counts.reshape(size, size).tolist(),
+        'mean_magnitudes': [
+            [None if np.isnan(value) else round(value, 3) for value in row]
+            for row in means.reshape(size, size).tolist()
+        ],
+    }
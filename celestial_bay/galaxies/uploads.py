@@ -0,0 +1,231 @@
+import os
+import re
+import shutil
+from datetime import timedelta
+from tempfile import SpooledTemporaryFile
+
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction
+from django.utils import timezone
+
+from .models import GalaxyImage, PostImage, UploadSession
+
+
+# The signatures of the image formats an upload may start with.
+IMAGE_SIGNATURES = (
+    (0, b'\x89PNG\r\n\x1a\n'),
+    (0, b'\xff\xd8\xff'),
+    (0, b'GIF87a'),
+    (0, b'GIF89a'),
+    (8, b'WEBP'),
+    (0, b'II*\x00'),
+    (0, b'MM\x00*'),
+    (4, b'ftypavif'),
+)
+# Enough bytes of a file to recognize any of the signatures.
+HEADER_SIZE = 16
+
+CONTENT_RANGE_REGEX = re.compile(r'^bytes (?P<start>\d+)-(?P<end>\d+)/(?P<total>\d+)$')
+
+# The size of the pieces a chunk is streamed to disk in.
+STREAM_BLOCK_SIZE = 64 * 1024
+
+
+class UploadError(Exception):
+    """
+    A chunk can't be accepted. Has the HTTP status to answer with.
+    """
+
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+
+def get_uploads_settings():
+    return {
+        # Where the incomplete uploads are kept, MEDIA_ROOT/.uploads when None.
+        'DIR': None,
+        'MAX_SIZE': 100 * 1024 * 1024,
+        'MAX_CHUNK_SIZE': 8 * 1024 * 1024,
+        # Seconds an upload session stays open after its last chunk.
+        'EXPIRES': 24 * 60 * 60,
+        **getattr(settings, 'GALAXIES_UPLOADS', {}),
+    }
+
+
+def get_upload_path(session):
+    directory = get_uploads_settings()['DIR'] or os.path.join(settings.MEDIA_ROOT, '.uploads')
+
+    return os.path.join(directory, f'{session.pk}.part')
+
+
+def get_expiry():
+    return timezone.now() + timedelta(seconds=get_uploads_settings()['EXPIRES'])
+
+
+def is_image_header(header):
+    return any(
+        header[offset:offset + len(signature)] == signature
+        for offset, signature in IMAGE_SIGNATURES
+    )
+
+
+def parse_content_range(header, size):
+    """
+    Returns the (start, length) of the chunk described by a Content-Range
+    header, e.g. 'bytes 0-1048575/5242880'.
+    """
+
+    match = CONTENT_RANGE_REGEX.match(header or '')
+
+    if match is None:
+        raise UploadError('Expected a Content-Range of the form "bytes start-end/total".', 400)
+
+    start, end, total = (int(match.group(name)) for name in ('start', 'end', 'total'))
+
+    if total != size or start > end or end >= size:
+        raise UploadError('The Content-Range does not fit the upload.', 416)
+
+    return start, end - start + 1
+
+
+def read_chunk(session, stream, content_range, content_length):
+    """
+    Reads a chunk of the request body to a temporary file, spooled in memory
+    up to FILE_UPLOAD_MAX_MEMORY_SIZE, and returns its start and the file,
+    for write_chunk(). This is done before the session is locked, so that a
+    slow client holds neither the lock nor a transaction for the transfer.
+
+    Chunks must start at or before the number of bytes received so far, so
+    the received bytes are always contiguous and a client can resume from
+    them after a dropped connection. This is checked again under the lock.
+    """
+
+    start, length = parse_content_range(content_range, session.size)
+
+    if content_length != length:
+        raise UploadError('The Content-Length does not match the Content-Range.', 400)
+
+    if length > get_uploads_settings()['MAX_CHUNK_SIZE']:
+        raise UploadError('The chunk is too large.', 413)
+
+    check_chunk_start(session, start)
+
+    chunk = SpooledTemporaryFile(
+        max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE, dir=settings.FILE_UPLOAD_TEMP_DIR
+    )
+    read = 0
+
+    try:
+        while read < length:
+            block = stream.read(min(STREAM_BLOCK_SIZE, length - read))
+
+            if not block:
+                break
+
+            # The header is checked as soon as it arrives, instead of after
+            # the whole file has been uploaded.
+            if start + read == 0 and not is_image_header(block[:HEADER_SIZE]):
+                raise UploadError('The file is not a supported image.', 415)
+
+            chunk.write(block)
+            read += len(block)
+    except BaseException:
+        chunk.close()
+        raise
+
+    chunk.seek(0)
+
+    return start, chunk
+
+
+def check_chunk_start(session, start):
+    if start > session.received:
+        raise UploadError(f'Expected a chunk starting at or before {session.received}.', 416)
+
+
+def write_chunk(session, start, chunk):
+    """
+    Writes a chunk read by read_chunk() to the upload file, at its offset.
+    A chunk cut short by a dropped connection still counts up to where it
+    got.
+
+    The session must be locked by the caller.
+    """
+
+    check_chunk_start(session, start)
+
+    path = get_upload_path(session)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with open(path, 'r+b' if os.path.exists(path) else 'wb') as file:
+        file.seek(start)
+        shutil.copyfileobj(chunk, file, STREAM_BLOCK_SIZE)
+        end = file.tell()
+
+    session.received = max(session.received, end)
+    session.expires = get_expiry()
+    session.save(update_fields=['received', 'expires'])
+
+    return session
+
+
+def finalize(session):
+    """
+    Creates the galaxy or post image from a complete upload and ends the
+    session.
+    """
+
+    if session.received < session.size:
+        raise UploadError(
+            f'The upload is incomplete, {session.received} of {session.size} bytes received.',
+            409
+        )
+
+    path = get_upload_path(session)
+
+    with open(path, 'rb') as file:
+        if not is_image_header(file.read(HEADER_SIZE)):
+            raise UploadError('The file is not a supported image.', 415)
+
+        file.seek(0)
+        content = File(file, name=session.filename)
+
+        with transaction.atomic():
+            if session.galaxy_id is not None:
+                image = GalaxyImage.objects.create(galaxy_id=session.galaxy_id, image=content)
+            else:
+                image = PostImage.objects.create(post_id=session.post_id, image=content)
+
+            session.delete()
+
+    return image
+
+
+def delete_upload_file(sender, instance, **kwargs):
+    """
+    post_delete receiver that removes the file of an ended or expired upload
+    session once the transaction commits.
+    """
+
+    path = get_upload_path(instance)
+
+    def remove():
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    transaction.on_commit(remove)
+
+
+def delete_expired_sessions():
+    """
+    Deletes the upload sessions that have expired, with their files, and
+    returns their number.
+    """
+
+    deleted, _ = UploadSession.objects.filter(expires__lt=timezone.now()).delete()
+
+    return deleted
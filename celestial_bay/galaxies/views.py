@@ -1,16 +1,48 @@
-from rest_framework.mixins import RetrieveModelMixin
-from rest_framework.permissions import IsAuthenticatedOrReadOnly, BasePermission
+from functools import partial
+
+from django.db import transaction
+from django.http import StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django_filters.rest_framework import DjangoFilterBackend
+from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.parsers import JSONParser
+from rest_framework import status
+from rest_framework.mixins import CreateModelMixin, DestroyModelMixin, ListModelMixin,\
+    RetrieveModelMixin
+from rest_framework.permissions import IsAuthenticatedOrReadOnly, BasePermission,\
+    IsAdminUser, IsAuthenticated
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.views import APIView
 from rest_framework.viewsets import ReadOnlyModelViewSet, GenericViewSet
-from rest_framework.pagination import LimitOffsetPagination
 
-from rest_flex_fields import is_expanded
 from rest_flex_fields.views import FlexFieldsMixin, FlexFieldsModelViewSet
 
 from .serializers import ConstellationSerializer, ConstellationImageSerializer, \
     GalaxySerializer, GalaxyImageSerializer, PostSerializer, PostImageSerializer,\
-    CommentSerializer
+    CommentSerializer, TrigramLookupQuerySerializer, UploadSessionSerializer,\
+    ConeSearchQuerySerializer, CrossMatchQuerySerializer, GalaxyStatsQuerySerializer,\
+    SimilarGalaxiesQuerySerializer
+from . import cache
+from .bulk import BulkModelMixin
+from .crossmatch import CSVTextParser, cross_match, iter_csv_results, iter_json_results,\
+    parse_positions, read_csv_positions
+from .derived import annotate_derived_fields
+from .cache import CachedResponseMixin, ConditionalRequestMixin
+from .filters import GalaxyFilter, PostFilter, CommentFilter, FullTextSearchFilter,\
+    StableOrderingFilter, annotate_search_results
 from .models import Constellation, ConstellationImage, Galaxy, GalaxyImage,\
-    Post, PostImage, Comment
+    Post, PostImage, Comment, SkyTile, UploadSession
+from .pagination import CustomLimitOffsetPagination
+from .prefetch import ExpandPrefetchMixin
+from .search import trigram_lookup
+from .similarity import find_similar
+from .sky import cone_search, get_sky_settings
+from .stats import get_stats
+from .tiles import get_tile
+from .uploads import UploadError, finalize, get_expiry, read_chunk, write_chunk
 
 
 class IsOwnerOfObjectOrReadOnly(BasePermission):
@@ -27,21 +59,74 @@ class IsOwnerOfObjectOrReadOnly(BasePermission):
         return obj.owner == request.user
 
 
-class CustomLimitOffsetPagination(LimitOffsetPagination):
+class StableOrderingMixin:
     """
-    Sets the default page size to 10 and the maximum to 50.
+    Orders list querysets by the view's default ordering, unless they are
+    already ordered, so that pages don't shift between requests. Requested
+    orderings get the primary key as a tie breaker from StableOrderingFilter.
+
+    The primary key should be the last key of the ordering, which makes it
+    usable as a keyset for the cursor pagination mode.
     """
 
-    # A numeric value indicating the limit to use if one is not provided by the
-    # client in a query parameter.
-    default_limit = 10
+    ordering = ('pk',)
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
 
-    # A value indicating the maximum allowable limit that may be requested by
-    # the client.
-    max_limit = 50
+        if not queryset.ordered:
+            queryset = queryset.order_by(*self.ordering)
+
+        return queryset
 
 
-class AbstractCustomViewSet(FlexFieldsModelViewSet):
+class FullTextSearchMixin:
+    """
+    Sets the search_rank and search_headline of the rows of a page of
+    FullTextSearchFilter results, for that page only.
+    """
+
+    search_headline_field = 'content'
+    search_query = None
+
+    def paginate_queryset(self, queryset):
+        page = super().paginate_queryset(queryset)
+
+        if page is not None and self.search_query is not None:
+            annotate_search_results(page, self.search_query, self.search_headline_field)
+
+        return page
+
+
+class TrigramLookupMixin:
+    """
+    Adds a typo tolerant lookup by the view's trigram_fields, returning the
+    top matches ordered by similarity.
+
+        e.g.  https://api.example.org/galaxies/lookup/?q=Andromda&threshold=0.3&limit=5
+    """
+
+    trigram_fields = ('name',)
+
+    @action(detail=False, pagination_class=None, filter_backends=())
+    def lookup(self, request, *args, **kwargs):
+        query_serializer = TrigramLookupQuerySerializer(data=request.query_params)
+        query_serializer.is_valid(raise_exception=True)
+
+        results = trigram_lookup(
+            self.get_queryset(),
+            self.trigram_fields,
+            query_serializer.validated_data['q'],
+            threshold=query_serializer.validated_data['threshold'],
+            limit=query_serializer.validated_data['limit'],
+        )
+        serializer = self.get_serializer(results, many=True)
+
+        return Response(serializer.data)
+
+
+class AbstractCustomViewSet(ConditionalRequestMixin, CachedResponseMixin, StableOrderingMixin,
+                            ExpandPrefetchMixin, FlexFieldsModelViewSet):
     """
     It provides full functionality for the authenticated owner of the object,
     and read-only options for all other users - authenticated or not.
@@ -81,10 +166,34 @@ class AbstractCustomViewSet(FlexFieldsModelViewSet):
     complete set of unpaginated items.
 
         e.g.  https://api.example.org/galaxies/?limit=40&offset=400
+
+    Deep offsets get slower the further the page is, so clients walking a
+    whole collection should use the keyset (cursor) mode instead. It is
+    enabled by the "cursor" query parameter, empty for the first page, and
+    returns "next" and "previous" links without a total count.
+
+        e.g.  https://api.example.org/galaxies/?cursor=&limit=40
+
+
+    Results can be ordered by the keys listed in ordering_fields, which are
+    the indexed ones.
+
+        e.g.  https://api.example.org/galaxies/?ordering=-distance
+
+
+    List and retrieve responses are cached until one of the models they are
+    built from is written to (see galaxies.cache).
+
+    They also carry an ETag and Last-Modified, so clients can revalidate them
+    with If-None-Match/If-Modified-Since and get a 304 Not Modified. Updates
+    sent with If-Match (the ETag of a plain GET of the object) fail with
+    412 Precondition Failed if the object has been changed in the meantime.
     """
 
     permission_classes = (IsAuthenticatedOrReadOnly, IsOwnerOfObjectOrReadOnly,)
     pagination_class = CustomLimitOffsetPagination
+    filter_backends = (DjangoFilterBackend, StableOrderingFilter)
+    ordering_fields = ('pk',)
 
     def perform_create(self, serializer):
         """
@@ -93,31 +202,30 @@ class AbstractCustomViewSet(FlexFieldsModelViewSet):
         serializer.save(owner=self.request.user)
 
 
-class ConstellationViewSet(FlexFieldsMixin, ReadOnlyModelViewSet):
+class ConstellationViewSet(ConditionalRequestMixin, CachedResponseMixin, StableOrderingMixin,
+                           ExpandPrefetchMixin, TrigramLookupMixin, FlexFieldsMixin,
+                           ReadOnlyModelViewSet):
     """
     A viewset that provides read only functionality for the Constellation model.
 
     All other actions(create, update, destroy, etc.) are going to be available
     to superusers only through the admin panel.
+
+    Supports a fuzzy lookup by name or abbreviation.
+
+        e.g.  https://api.example.org/constellations/lookup/?q=Andromda
     """
 
     serializer_class = ConstellationSerializer
-    permit_list_expands = ['galaxies', 'images']
+    queryset = Constellation.objects.all()
+    permit_list_expands = ['galaxies', 'galaxies.images', 'images']
     pagination_class = CustomLimitOffsetPagination
-
-    def get_queryset(self):
-        queryset = Constellation.objects.all()
-
-        if is_expanded(self.request, 'galaxies'):
-            queryset = queryset.prefetch_related('galaxies')
-
-        if is_expanded(self.request, 'images'):
-            queryset = queryset.prefetch_related('images')
-
-        return queryset
+    trigram_fields = ('name', 'abbreviation')
 
 
-class ConstellationImageViewSet(FlexFieldsMixin, RetrieveModelMixin, GenericViewSet):
+class ConstellationImageViewSet(ConditionalRequestMixin, CachedResponseMixin, ExpandPrefetchMixin,
+                                FlexFieldsMixin, ListModelMixin, RetrieveModelMixin,
+                                GenericViewSet):
     """
     A viewset that provides read only functionality for the ConstellationImage model.
 
@@ -128,59 +236,215 @@ class ConstellationImageViewSet(FlexFieldsMixin, RetrieveModelMixin, GenericView
     serializer_class = ConstellationImageSerializer
     queryset = ConstellationImage.objects.all()
     pagination_class = CustomLimitOffsetPagination
+    # ConditionalRequestMixin has an update, which isn't routed to.
+    http_method_names = ['get', 'head', 'options']
 
 
-class GalaxyViewSet(AbstractCustomViewSet):
+class GalaxyViewSet(BulkModelMixin, TrigramLookupMixin, AbstractCustomViewSet):
     """
     A viewset for the Galaxy model.
 
     Has 'images' as an expandable field.
+
+    Has the absolute magnitude and the physical size, in thousands of
+    light-years, derived from the other fields by the database. They can be
+    filtered and ordered by like the stored ones.
+
+        e.g.  https://api.example.org/galaxies/?absolute_magnitude__lte=-20&ordering=physical_size
+
+    Supports a fuzzy lookup by name.
+
+        e.g.  https://api.example.org/galaxies/lookup/?q=Andromda
+
+    Supports bulk create, update and delete (see BulkModelMixin).
+
+        e.g.  https://api.example.org/galaxies/bulk/
+
+    Supports a cone search, of the galaxies within a radius of a position,
+    nearest first, with their separation. All values are in degrees.
+
+        e.g.  https://api.example.org/galaxies/cone/?ra=10.68&dec=41.27&radius=2
+
+    Supports a cross-match of a batch of positions, POSTed as a JSON array of
+    [ra, dec] pairs or of objects with ra and dec, or as a CSV with ra and dec
+    columns, with the nearest galaxy within a radius, 5 arcsec by default.
+    The results are streamed back in the same order, as CSV if the positions
+    were, or if the Accept header asks for text/csv, and as JSON otherwise.
+
+        e.g.  POST https://api.example.org/galaxies/crossmatch/?radius=0.002
+
+    Supports statistics of the distance, apparent magnitude and size of the
+    galaxies the list filters select: their count, min, max, mean,
+    percentiles and histograms, overall or per galaxy_type or constellation.
+    They are computed in the database, and cached like the list responses.
+
+        e.g.  https://api.example.org/galaxies/stats/?group_by=galaxy_type&bins=20
+
+    Supports finding the galaxies most similar to one, by distance, apparent
+    magnitude, size, type and constellation, most similar first, with their
+    similarity from 0 to 1.
+
+        e.g.  https://api.example.org/galaxies/1/similar/?limit=10
     """
     __doc__ += AbstractCustomViewSet.__doc__
 
     serializer_class = GalaxySerializer
+    queryset = annotate_derived_fields(Galaxy.objects.all())
     permit_list_expands = ['images']
+    filterset_class = GalaxyFilter
+    ordering_fields = ('pk', 'name', 'distance', 'apparent_magnitude', 'absolute_magnitude',
+                       'physical_size')
 
-    def get_queryset(self):
-        queryset = Galaxy.objects.all()
-
-        if is_expanded(self.request, 'images'):
-            queryset = queryset.prefetch_related('images')
-
-        return queryset
-
+    def perform_create(self, serializer):
+        super().perform_create(serializer)
+        # The derived fields are annotations of the queryset.
+        serializer.instance = self.get_queryset().get(pk=serializer.instance.pk)
+
+    def perform_update(self, serializer):
+        super().perform_update(serializer)
+        serializer.instance = self.get_queryset().get(pk=serializer.instance.pk)
+
+    @action(detail=False, pagination_class=None, filter_backends=())
+    def cone(self, request, *args, **kwargs):
+        query_serializer = ConeSearchQuerySerializer(data=request.query_params)
+        query_serializer.is_valid(raise_exception=True)
+        query = query_serializer.validated_data
+
+        matches = cone_search(
+            self.get_queryset(), query['ra'], query['dec'], query['radius'],
+            limit=query['limit'],
+        )
+        galaxies = self.get_queryset().in_bulk([pk for pk, _ in matches])
+        results = []
+
+        for pk, separation in matches:
+            galaxies[pk].separation = separation
+            results.append(galaxies[pk])
+
+        serializer = self.get_serializer(results, many=True)
+
+        return Response(serializer.data)
+
+    @action(detail=False, methods=['post'], pagination_class=None, filter_backends=(),
+            parser_classes=(JSONParser, CSVTextParser))
+    def crossmatch(self, request, *args, **kwargs):
+        query_serializer = CrossMatchQuerySerializer(data=request.query_params)
+        query_serializer.is_valid(raise_exception=True)
+        sky_settings = get_sky_settings()
+        radius = query_serializer.validated_data.get(
+            'radius', sky_settings['CROSS_MATCH_RADIUS']
+        )
+        is_csv = isinstance(request.data, str)
+
+        try:
+            rows = read_csv_positions(request.data) if is_csv else request.data
+
+            if not isinstance(rows, list):
+                raise ValueError('Expected a list of positions.')
+
+            if len(rows) > sky_settings['MAX_CROSS_MATCH_ROWS']:
+                raise ValueError(
+                    f'Ensure there are no more than {sky_settings["MAX_CROSS_MATCH_ROWS"]} '
+                    f'positions.'
+                )
+
+            ra, dec = parse_positions(rows)
+        except (ValueError, KeyError, TypeError, IndexError) as error:
+            raise ValidationError({api_settings.NON_FIELD_ERRORS_KEY: [str(error)]})
+
+        pks, separations = cross_match(ra, dec, radius)
+
+        if is_csv or 'text/csv' in request.META.get('HTTP_ACCEPT', ''):
+            return StreamingHttpResponse(
+                iter_csv_results(ra, dec, pks, separations), content_type='text/csv'
+            )
+
+        return StreamingHttpResponse(
+            iter_json_results(ra, dec, pks, separations), content_type='application/json'
+        )
+
+    @action(detail=True, pagination_class=None, filter_backends=())
+    def similar(self, request, *args, **kwargs):
+        query_serializer = SimilarGalaxiesQuerySerializer(data=request.query_params)
+        query_serializer.is_valid(raise_exception=True)
+
+        matches = find_similar(self.get_object(), query_serializer.validated_data['limit'])
+        galaxies = self.get_queryset().in_bulk([pk for pk, _ in matches])
+        results = []
+
+        for pk, difference in matches:
+            # Deleted since the feature matrix was refreshed.
+            if pk not in galaxies:
+                continue
+
+            galaxies[pk].similarity = 1 / (1 + difference)
+            results.append(galaxies[pk])
+
+        serializer = self.get_serializer(results, many=True)
+
+        return Response(serializer.data)
+
+    @action(detail=False, pagination_class=None, filter_backends=(DjangoFilterBackend,))
+    def stats(self, request, *args, **kwargs):
+        return self.conditional_response(
+            partial(self.cached_response, self.get_stats), request, *args, **kwargs
+        )
+
+    def get_stats(self, request, *args, **kwargs):
+        query_serializer = GalaxyStatsQuerySerializer(data=request.query_params)
+        query_serializer.is_valid(raise_exception=True)
+
+        return Response(get_stats(
+            self.filter_queryset(self.get_queryset()),
+            group_by=query_serializer.validated_data.get('group_by'),
+            bins=query_serializer.validated_data.get('bins'),
+        ))
 
-class PostViewSet(AbstractCustomViewSet):
+
+class PostViewSet(BulkModelMixin, FullTextSearchMixin, AbstractCustomViewSet):
     """
     A viewset for the Post model.
 
     Has 'images' and 'comments' as expandable fields.
+
+    Supports full-text search over title and content, ranked and with
+    highlighted snippets of the content.
+
+        e.g.  https://api.example.org/posts/?search=andromeda
+
+    Supports bulk create, update and delete (see BulkModelMixin).
+
+        e.g.  https://api.example.org/posts/bulk/
     """
     __doc__ += AbstractCustomViewSet.__doc__
 
     serializer_class = PostSerializer
+    queryset = Post.objects.defer('search_vector')
     permit_list_expands = ['images', 'comments']
+    filter_backends = (DjangoFilterBackend, StableOrderingFilter, FullTextSearchFilter)
+    filterset_class = PostFilter
+    ordering_fields = ('pk', 'created', 'updated')
 
-    def get_queryset(self):
-        queryset = Post.objects.all()
 
-        if is_expanded(self.request, 'images'):
-            queryset = queryset.prefetch_related('images')
+class CommentViewSet(BulkModelMixin, FullTextSearchMixin, AbstractCustomViewSet):
+    """
+    A viewset for the Comment model.
 
-        if is_expanded(self.request, 'comments'):
-            queryset = queryset.prefetch_related('comments')
+    Supports ranked full-text search over the content.
 
-        return queryset
+        e.g.  https://api.example.org/comments/?search=andromeda
 
+    Supports bulk create, update and delete (see BulkModelMixin).
 
-class CommentViewSet(AbstractCustomViewSet):
-    """
-    A viewset for the Comment model.
+        e.g.  https://api.example.org/comments/bulk/
     """
     __doc__ += AbstractCustomViewSet.__doc__
 
     serializer_class = CommentSerializer
-    queryset = Comment.objects.all()
+    queryset = Comment.objects.defer('search_vector')
+    filter_backends = (DjangoFilterBackend, StableOrderingFilter, FullTextSearchFilter)
+    filterset_class = CommentFilter
+    ordering_fields = ('pk', 'created')
 
 
 class GalaxyImageViewSet(AbstractCustomViewSet):
@@ -201,3 +465,148 @@ class PostImageViewSet(AbstractCustomViewSet):
 
     serializer_class = PostImageSerializer
     queryset = PostImage.objects.all()
+
+
+class UploadSessionViewSet(CreateModelMixin, RetrieveModelMixin, DestroyModelMixin,
+                          GenericViewSet):
+    """
+    Resumable chunked uploads of galaxy and post images, for large files and
+    unreliable connections.
+
+    Create an upload session for a galaxy or a post of the user, with the
+    name and size of the file
+
+        e.g.  POST https://api.example.org/uploads/
+              {"galaxy": 1, "filename": "m31.tif", "size": 52428800}
+
+    then PUT the raw bytes in chunks of up to 8 MiB, each with a Content-Range
+
+        e.g.  PUT https://api.example.org/uploads/<id>/
+              Content-Range: bytes 0-8388607/52428800
+
+    The response, like a GET of the session, tells how many bytes have been
+    received, which is where an interrupted upload resumes from. The first
+    chunk is rejected with 415 Unsupported Media Type unless the file starts
+    like a supported image.
+
+    Finally, create the image from the complete upload
+
+        e.g.  POST https://api.example.org/uploads/<id>/finalize/
+
+    Sessions expire a day after their last chunk (see the
+    clean_upload_sessions command), and can be aborted with a DELETE.
+    """
+
+    serializer_class = UploadSessionSerializer
+    permission_classes = (IsAuthenticated,)
+
+    def get_queryset(self):
+        return UploadSession.objects.filter(owner=self.request.user)
+
+    def perform_create(self, serializer):
+        serializer.save(owner=self.request.user, expires=get_expiry())
+
+    def get_locked_session(self):
+        return get_object_or_404(
+            self.get_queryset().select_for_update(), pk=self.kwargs['pk']
+        )
+
+    def upload_error_response(self, error, session):
+        if error.status == status.HTTP_415_UNSUPPORTED_MEDIA_TYPE:
+            session.delete()
+
+        return Response({'detail': str(error)}, status=error.status)
+
+    def update(self, request, *args, **kwargs):
+        session = self.get_object()
+
+        try:
+            start, chunk = read_chunk(
+                session,
+                request.stream,
+                request.META.get('HTTP_CONTENT_RANGE'),
+                int(request.META.get('CONTENT_LENGTH') or 0),
+            )
+        except UploadError as error:
+            return self.upload_error_response(error, session)
+
+        # Concurrent chunks of a session are written one at a time, once
+        # received, so that the lock is only held to copy them.
+        with chunk, transaction.atomic():
+            session = self.get_locked_session()
+
+            try:
+                write_chunk(session, start, chunk)
+            except UploadError as error:
+                return self.upload_error_response(error, session)
+
+        return Response(self.get_serializer(session).data)
+
+    @action(detail=True, methods=['post'])
+    def finalize(self, request, *args, **kwargs):
+        with transaction.atomic():
+            session = self.get_locked_session()
+
+            try:
+                image = finalize(session)
+            except UploadError as error:
+                return self.upload_error_response(error, session)
+
+        serializer_class = GalaxyImageSerializer if isinstance(image, GalaxyImage) \
+            else PostImageSerializer
+        serializer = serializer_class(image, context=self.get_serializer_context())
+
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+
+class SkyTileView(APIView):
+    """
+    A read-only tile of the sky density map: the galaxy counts and mean
+    apparent magnitudes of the cells of the tile, rows from north to south
+    and columns from 0h eastwards (see galaxies.tiles).
+
+        e.g.  https://api.example.org/sky_tiles/2/5/1/
+
+    Zoom level z has 2**z rows by 2**(z+1) columns of tiles. Tiles are kept
+    up to date as galaxies are written, and are cached by clients for a day
+    and revalidated with their ETag.
+    """
+
+    def get(self, request, zoom, x, y):
+        key = cache.get_version_key(SkyTile)
+        version = cache.get_versions([key])[key]
+        etag = f'"{zoom}-{x}-{y}-{version}"'
+        response = get_conditional_response(request._request, etag=etag)
+
+        if response is None:
+            cache_key = f'galaxies:sky_tile:{zoom}:{x}:{y}:{version}'
+            data = cache.get_shared_cache().get(cache_key)
+
+            if data is None:
+                data = get_tile(zoom, x, y)
+
+                if data is None:
+                    raise NotFound('No such tile.')
+
+                cache.get_shared_cache().set(cache_key, data)
+
+            response = Response(data)
+
+        response['ETag'] = etag
+        patch_cache_control(
+            response, public=True, max_age=get_sky_settings()['TILE_MAX_AGE']
+        )
+
+        return response
+
+
+class ResponseCacheStatsView(APIView):
+    """
+    Reports the hit and miss counters of the response cache of the process
+    serving the request. Available to staff users only.
+    """
+
+    permission_classes = (IsAdminUser,)
+
+    def get(self, request):
+        return Response(cache.get_stats())
@@ -0,0 +1,28 @@
+"""
+Entry points of the worker processes (see galaxies.renditions and
+galaxies.purge).
+
+Spawned workers import this module before Django is set up, so it must not
+import any models at module level.
+"""
+
+import os
+
+import django
+
+
+def init_worker(settings_module):
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', settings_module)
+    django.setup()
+
+
+def generate_renditions(label, pk):
+    from .renditions import generate_renditions
+
+    return generate_renditions(label, pk)
+
+
+def purge_user(pk):
+    from .purge import purge_user
+
+    return purge_user(pk)
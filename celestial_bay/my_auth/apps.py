@@ -1,6 +1,22 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_delete, post_save
 
 
 class AuthConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'my_auth'
+
+    def ready(self):
+        from galaxies.cache import invalidate_on_write
+
+        for model in self.get_models():
+            post_save.connect(
+                invalidate_on_write,
+                sender=model,
+                dispatch_uid=f'invalidate_cache_{model._meta.label_lower}'
+            )
+            post_delete.connect(
+                invalidate_on_write,
+                sender=model,
+                dispatch_uid=f'invalidate_cache_on_delete_{model._meta.label_lower}'
+            )
@@ -4,6 +4,8 @@ from django.db import models
 from django.contrib.auth.models import AbstractUser, BaseUserManager
 from django.utils.translation import gettext_lazy as _
 
+from galaxies.counters import CounterFieldsMixin
+
 
 class UserManager(BaseUserManager):
     """
@@ -55,7 +57,7 @@ class UserManager(BaseUserManager):
         return self._create_user(email, password, **extra_fields)
 
 
-class User(AbstractUser):
+class User(CounterFieldsMixin, AbstractUser):
     """
     Custom user model using email for authentication instead of username and
     uuid primary key.
@@ -64,6 +66,16 @@ class User(AbstractUser):
     id = models.UUIDField(primary_key=True, default=uuid4, editable=False)
     username = None
     email = models.EmailField(_('email address'), unique=True)
+    # Denormalized counters, maintained by galaxies.counters.
+    galaxy_count = models.PositiveIntegerField(default=0, editable=False)
+    post_count = models.PositiveIntegerField(default=0, editable=False)
+    # When the user asked for their account to be deleted, which happens in
+    # the background (see galaxies.purge).
+    deletion_requested = models.DateTimeField(
+        null=True, blank=True, db_index=True, editable=False
+    )
+
+    counter_fields = ('galaxy_count', 'post_count')
 
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = []
@@ -186,13 +186,15 @@ class UserSerializer(FlexFieldsModelSerializer):
 
     It inherits from the DRF-FlexFields' FlexFieldsModelSerializer
 
-    fields: pk, first_name, last_name, date_joined, last_login
+    fields: pk, first_name, last_name, date_joined, last_login, galaxy_count,
+    post_count
     expandable fields: galaxies
     """
 
     class Meta:
         model = User
-        fields = ['pk', 'first_name', 'last_name', 'date_joined', 'last_login']
+        fields = ['pk', 'first_name', 'last_name', 'date_joined', 'last_login',
+                  'galaxy_count', 'post_count']
         expandable_fields = {
             'galaxies': ('galaxies.GalaxySerializer', {'many': True})
         }
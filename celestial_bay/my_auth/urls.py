@@ -3,7 +3,7 @@ from django.urls import path
 from rest_framework_simplejwt.views import TokenObtainPairView, TokenRefreshView
 
 from .views import RegisterView, UpdateUserView, ChangePasswordView, LogoutView,\
-    UserView, LoginView
+    UserView, LoginView, DeleteUserView
 
 
 urlpatterns = [
@@ -14,5 +14,6 @@ urlpatterns = [
     path('change_password/<uuid:pk>/', ChangePasswordView.as_view(),
          name='auth_change_password'),
     path('update_user/<uuid:pk>/', UpdateUserView.as_view(), name='auth_update_user'),
+    path('delete_user/<uuid:pk>/', DeleteUserView.as_view(), name='auth_delete_user'),
     path('users/<uuid:pk>/', UserView.as_view(), name='auth_users'),
 ]
@@ -6,6 +6,10 @@ from rest_framework.permissions import IsAuthenticated, BasePermission
 from rest_framework_simplejwt.tokens import RefreshToken
 from rest_framework_simplejwt.views import TokenObtainPairView
 
+from galaxies.cache import ConditionalRequestMixin
+from galaxies.prefetch import ExpandPrefetchMixin
+from galaxies.purge import mark_for_deletion
+
 from .models import User
 from .serializers import RegisterSerializer, ChangePasswordSerializer, \
     UpdateUserSerializer, UserSerializer, CustomTokenObtainPairSerializer
@@ -71,6 +75,24 @@ class UpdateUserView(generics.UpdateAPIView):
     http_method_names = ['put']
 
 
+class DeleteUserView(generics.DestroyAPIView):
+    """
+    For deleting the account of a user.
+    It requires user to be authenticated.
+
+    The user is deactivated at once, and their galaxies and images are
+    deleted in the background, in small batches (see galaxies.purge), so the
+    response is 202 Accepted.
+    """
+    queryset = User.objects.all()
+    permission_classes = (IsAuthenticated, IsOwnerOfObject)
+
+    def destroy(self, request, *args, **kwargs):
+        mark_for_deletion(self.get_object())
+
+        return Response(status=status.HTTP_202_ACCEPTED)
+
+
 class LogoutView(APIView):
     """
     For logging out a user.
@@ -96,12 +118,16 @@ class LogoutView(APIView):
             return Response(status=status.HTTP_400_BAD_REQUEST)
 
 
-class UserView(generics.RetrieveAPIView):
+class UserView(ConditionalRequestMixin, ExpandPrefetchMixin, generics.RetrieveAPIView):
     """
     For getting a user's info.
 
     It inherits from generics.RetrieveAPIView and supports GET queries only for
     single user by user id.
+
+    Expanded relations (e.g. ?expand=galaxies.images) are prefetched.
+
+    Responses carry an ETag and Last-Modified for conditional requests.
     """
 
     queryset = User.objects.all()
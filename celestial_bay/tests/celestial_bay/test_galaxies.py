@@ -1,8 +1,32 @@
+import hashlib
+import json
+import os
+import time
+from io import BytesIO
+from types import SimpleNamespace
+
 import pytest
+from PIL import Image
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils.http import http_date
 
 from my_auth.models import User
-from galaxies.models import Constellation, ConstellationImage, Galaxy
+from galaxies.models import Constellation, ConstellationImage, Galaxy, GalaxyImage, GalaxyType,\
+    Post, PostImage, Comment, SkyTile
+from galaxies import cache as response_cache
+from galaxies import serializers as serializers_module
+from galaxies.cache import get_shared_cache
+from galaxies.checks import check_shared_cache
+from galaxies.classification import get_types, resolve_galaxy_type
+from galaxies.media import delete_orphaned_file, find_orphaned_files
+from galaxies.purge import mark_for_deletion
+from galaxies.renditions import generate_renditions
+from galaxies.similarity import JOURNAL_KEY, read_journal
 
 
 url_constellations = '/constellations/'
@@ -12,6 +36,7 @@ url_galaxy_images = '/galaxy_images/'
 url_posts = '/posts/'
 url_post_images = '/post_images/'
 url_comments = '/comments/'
+url_uploads = '/uploads/'
 
 constellation_data = {
     'name': 'name1',
@@ -32,13 +57,30 @@ galaxy_data = {
     "name": "name1",
     "name_origin": "origin1",
     "notes": "note1",
-    "galaxy_type": "type1",
+    "galaxy_type": "Sb",
     "distance": 11,
     "apparent_magnitude": 11,
     "size": 11,
 }
 
 
+def create_galaxy(**fields):
+    """
+    Creates a galaxy with its type given by name, as the API takes it.
+    """
+
+    return Galaxy.objects.create(
+        **{**fields, 'galaxy_type': resolve_galaxy_type(fields['galaxy_type'])}
+    )
+
+
+def get_image_file(name='galaxy.png', size=(64, 48), color=(10, 20, 30)):
+    buffer = BytesIO()
+    Image.new('RGB', size, color).save(buffer, format='PNG')
+
+    return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/png')
+
+
 @pytest.mark.django_db
 def test_get_all_constellations_success(client):
     constellations = (
@@ -184,7 +226,7 @@ def test_list_galaxy_success(client):
     galaxy1_data['owner'], galaxy1_data['constellation'] = user, constellation
     galaxy2_data['name'], galaxy2_data['owner'], galaxy2_data['constellation'] =\
         'galaxy2', user, constellation
-    galaxies = [Galaxy.objects.create(**galaxy1_data), Galaxy.objects.create(**galaxy2_data)]
+    galaxies = [create_galaxy(**galaxy1_data), create_galaxy(**galaxy2_data)]
     request = client.get(url_galaxies)
     data = request.data
 
@@ -213,7 +255,7 @@ def test_list_galaxy_success(client):
         assert results[i]['name'] == galaxies[i].name
         assert results[i]['name_origin'] == galaxies[i].name_origin
         assert results[i]['notes'] == galaxies[i].notes
-        assert results[i]['galaxy_type'] == galaxies[i].galaxy_type
+        assert results[i]['galaxy_type'] == galaxies[i].galaxy_type.name
         assert results[i]['distance'] == galaxies[i].distance
         assert results[i]['apparent_magnitude'] == galaxies[i].apparent_magnitude
         assert results[i]['size'] == galaxies[i].size
@@ -232,9 +274,9 @@ def test_retrieve_galaxy_success(client):
         'galaxy2', user, constellation
     galaxy3_data['name'], galaxy3_data['owner'], galaxy3_data['constellation'] =\
         'galaxy3', user, constellation
-    Galaxy.objects.create(**galaxy1_data)
-    galaxy2 = Galaxy.objects.create(**galaxy2_data)
-    Galaxy.objects.create(**galaxy3_data)
+    create_galaxy(**galaxy1_data)
+    galaxy2 = create_galaxy(**galaxy2_data)
+    create_galaxy(**galaxy3_data)
 
     request = client.get(url_galaxies + str(galaxy2.pk) + '/')
     data = request.data
@@ -271,7 +313,7 @@ def test_update_galaxy_success(client):
     this_galaxy_data = galaxy_data.copy()
     this_galaxy_data['owner'] = user
     this_galaxy_data['constellation'] = constellation
-    galaxy = Galaxy.objects.create(**this_galaxy_data)
+    galaxy = create_galaxy(**this_galaxy_data)
     update_data = this_galaxy_data.copy()
     update_data['name_origin'] = 'new_origin'
     update_data['notes'] = 'new_notes'
@@ -313,7 +355,7 @@ def test_partial_update_galaxy_success(client):
     this_galaxy_data['owner'] = user
     this_galaxy_data['constellation'] = constellation
     update_data = {'name': 'new_name', 'size': 303}
-    galaxy = Galaxy.objects.create(**this_galaxy_data)
+    galaxy = create_galaxy(**this_galaxy_data)
     url = url_galaxies + str(galaxy.pk) + '/'
     request = client.patch(url, update_data)
     data = request.data
@@ -333,7 +375,7 @@ def test_partial_update_galaxy_success(client):
     assert data['name'] == update_data['name']
     assert data['name_origin'] == galaxy.name_origin
     assert data['notes'] == galaxy.notes
-    assert data['galaxy_type'] == galaxy.galaxy_type
+    assert data['galaxy_type'] == galaxy.galaxy_type.name
     assert data['distance'] == galaxy.distance
     assert data['apparent_magnitude'] == galaxy.apparent_magnitude
     assert data['size'] == update_data['size']
@@ -349,7 +391,7 @@ def test_delete_galaxy_success(client):
     this_galaxy_data = galaxy_data.copy()
     this_galaxy_data['owner'] = user
     this_galaxy_data['constellation'] = constellation
-    galaxy = Galaxy.objects.create(**this_galaxy_data)
+    galaxy = create_galaxy(**this_galaxy_data)
     url = url_galaxies + str(galaxy.pk) + '/'
     request = client.delete(url)
 
@@ -398,7 +440,7 @@ def test_not_able_to_update_galaxy_when_unauthenticated(client):
     this_galaxy_data['owner'] = user
     this_galaxy_data['constellation'] = constellation
     update_data = {'name': 'new_name', 'size': 303}
-    galaxy = Galaxy.objects.create(**this_galaxy_data)
+    galaxy = create_galaxy(**this_galaxy_data)
     url = url_galaxies + str(galaxy.pk) + '/'
     request = client.patch(url, update_data)
     data = request.data
@@ -416,7 +458,7 @@ def test_not_able_to_delete_galaxy_when_unauthenticated(client):
     this_galaxy_data = galaxy_data.copy()
     this_galaxy_data['owner'] = user
     this_galaxy_data['constellation'] = constellation
-    galaxy = Galaxy.objects.create(**this_galaxy_data)
+    galaxy = create_galaxy(**this_galaxy_data)
     url = url_galaxies + str(galaxy.pk) + '/'
     request = client.delete(url)
     data = request.data
@@ -439,7 +481,7 @@ def test_not_able_to_update_galaxy_when_not_owner(client):
     this_galaxy_data['owner'] = user
     this_galaxy_data['constellation'] = constellation
     update_data = {'name': 'new_name', 'size': 303}
-    galaxy = Galaxy.objects.create(**this_galaxy_data)
+    galaxy = create_galaxy(**this_galaxy_data)
     url = url_galaxies + str(galaxy.pk) + '/'
     request = client.patch(url, update_data)
     data = request.data
@@ -461,7 +503,7 @@ def test_not_able_to_delete_galaxy_when_not_owner(client):
     this_galaxy_data = galaxy_data.copy()
     this_galaxy_data['owner'] = user
     this_galaxy_data['constellation'] = constellation
-    galaxy = Galaxy.objects.create(**this_galaxy_data)
+    galaxy = create_galaxy(**this_galaxy_data)
     url = url_galaxies + str(galaxy.pk) + '/'
     request = client.delete(url)
     data = request.data
@@ -472,6 +514,1448 @@ def test_not_able_to_delete_galaxy_when_not_owner(client):
     assert error == 'You do not have permission to perform this action.'
 
 
+@pytest.mark.django_db
+def test_list_galaxy_keyset_pagination_success(client):
+    constellation, user =\
+        Constellation.objects.create(**constellation_data), User.objects.create(**user_data)
+    galaxies = []
+    for i in range(5):
+        this_galaxy_data = galaxy_data.copy()
+        this_galaxy_data['name'] = f'galaxy{i}'
+        this_galaxy_data['owner'], this_galaxy_data['constellation'] = user, constellation
+        galaxies.append(create_galaxy(**this_galaxy_data))
+
+    request = client.get(url_galaxies, {'cursor': '', 'limit': 2})
+    data = request.data
+
+    assert request.status_code == 200
+    assert 'count' not in data
+    assert data['previous'] is None
+    assert [result['pk'] for result in data['results']] ==\
+        [galaxy.pk for galaxy in galaxies[:2]]
+
+    request = client.get(data['next'])
+    data = request.data
+
+    assert request.status_code == 200
+    assert data['previous'] is not None
+    assert [result['pk'] for result in data['results']] ==\
+        [galaxy.pk for galaxy in galaxies[2:4]]
+
+    last_page = client.get(data['next']).data
+
+    assert last_page['next'] is None
+    assert [result['pk'] for result in last_page['results']] == [galaxies[4].pk]
+
+    request = client.get(last_page['previous'])
+    data = request.data
+
+    assert request.status_code == 200
+    assert [result['pk'] for result in data['results']] ==\
+        [galaxy.pk for galaxy in galaxies[2:4]]
+
+
+@pytest.mark.django_db
+def test_list_galaxy_keyset_pagination_invalid_cursor(client):
+    request = client.get(url_galaxies, {'cursor': 'not-a-cursor'})
+    data = request.data
+
+    assert request.status_code == 404
+    assert str(data['detail']) == 'Invalid cursor'
+
+
+@pytest.mark.django_db
+def test_list_constellations_nested_expand_query_count(client, django_assert_num_queries):
+    user = User.objects.create(**user_data)
+
+    for i in range(3):
+        constellation = Constellation.objects.create(
+            name=f'name{i}', abbreviation=f'ab{i}', area_in_sq_deg=111
+        )
+        for j in range(3):
+            this_galaxy_data = galaxy_data.copy()
+            this_galaxy_data['name'] = f'galaxy{i}{j}'
+            this_galaxy_data['owner'], this_galaxy_data['constellation'] =\
+                user, constellation
+            galaxy = create_galaxy(**this_galaxy_data)
+            GalaxyImage.objects.create(galaxy=galaxy)
+
+    # The galaxy types are kept in memory.
+    get_types()
+
+    # count, constellations, galaxies, galaxy images
+    with django_assert_num_queries(4):
+        request = client.get(url_constellations, {'expand': 'galaxies.images'})
+
+    assert request.status_code == 200
+    results = request.data['results']
+    assert len(results) == 3
+    for result in results:
+        assert len(result['galaxies']) == 3
+        for galaxy in result['galaxies']:
+            assert len(galaxy['images']) == 1
+
+
+@pytest.mark.django_db
+def test_list_galaxy_sparse_fields_are_not_loaded(client):
+    constellation, user =\
+        Constellation.objects.create(**constellation_data), User.objects.create(**user_data)
+    this_galaxy_data = galaxy_data.copy()
+    this_galaxy_data['owner'], this_galaxy_data['constellation'] = user, constellation
+    galaxy = create_galaxy(**this_galaxy_data)
+    GalaxyImage.objects.create(galaxy=galaxy)
+
+    with CaptureQueriesContext(connection) as queries:
+        request = client.get(url_galaxies, {'fields': 'pk,name,images', 'expand': 'images'})
+
+    assert request.status_code == 200
+    result = request.data['results'][0]
+    assert set(result) == {'pk', 'name', 'images'}
+    assert len(result['images']) == 1
+    galaxy_query = next(
+        query['sql'] for query in queries.captured_queries
+        if query['sql'].startswith('SELECT "galaxies_galaxy"."id"')
+    )
+    assert '"name_origin"' not in galaxy_query
+    assert '"notes"' not in galaxy_query
+
+
+@pytest.mark.django_db
+def test_list_galaxy_filter_and_ordering_success(client):
+    constellation, user =\
+        Constellation.objects.create(**constellation_data), User.objects.create(**user_data)
+    for i, distance in enumerate((10, 20, 30, 40)):
+        this_galaxy_data = galaxy_data.copy()
+        this_galaxy_data['name'], this_galaxy_data['distance'] = f'galaxy{i}', distance
+        this_galaxy_data['owner'], this_galaxy_data['constellation'] = user, constellation
+        create_galaxy(**this_galaxy_data)
+
+    request = client.get(
+        url_galaxies,
+        {'distance__gte': 20, 'distance__lte': 30, 'ordering': '-distance'}
+    )
+    data = request.data
+
+    assert request.status_code == 200
+    assert data['count'] == 2
+    assert [result['distance'] for result in data['results']] == [30, 20]
+
+
+@pytest.mark.django_db
+def test_list_galaxy_ordering_by_not_indexed_field_is_ignored(client):
+    constellation, user =\
+        Constellation.objects.create(**constellation_data), User.objects.create(**user_data)
+    galaxies = []
+    for i, notes in enumerate(('b', 'a')):
+        this_galaxy_data = galaxy_data.copy()
+        this_galaxy_data['name'], this_galaxy_data['notes'] = f'galaxy{i}', notes
+        this_galaxy_data['owner'], this_galaxy_data['constellation'] = user, constellation
+        galaxies.append(create_galaxy(**this_galaxy_data))
+
+    request = client.get(url_galaxies, {'ordering': 'notes'})
+
+    assert request.status_code == 200
+    assert [result['pk'] for result in request.data['results']] ==\
+        [galaxy.pk for galaxy in galaxies]
+
+
+@pytest.mark.django_db
+def test_search_posts_success(client):
+    user = User.objects.create(**user_data)
+    Post.objects.create(
+        title='Andromeda', content='The galaxies are colliding.', owner=user
+    )
+    post = Post.objects.create(
+        title='Collision course', content='Andromeda and the Milky Way.', owner=user
+    )
+    Post.objects.create(title='Whirlpool', content='A spiral galaxy.', owner=user)
+
+    request = client.get(url_posts, {'search': 'andromeda'})
+    data = request.data
+
+    assert request.status_code == 200
+    assert data['count'] == 2
+    results = data['results']
+    # A match in the title ranks higher than one in the content.
+    assert results[0]['title'] == 'Andromeda'
+    assert results[0]['search_rank'] > results[1]['search_rank']
+    assert results[1]['pk'] == post.pk
+    assert '<mark>Andromeda</mark>' in results[1]['search_headline']
+
+
+@pytest.mark.django_db
+def test_search_comments_after_update(client):
+    user = User.objects.create(**user_data)
+    post = Post.objects.create(title='title', content='content', owner=user)
+    comment = Comment.objects.create(content='Nice picture', post=post, owner=user)
+    comment.content = 'Nice picture of the Triangulum galaxy'
+    comment.save()
+
+    request = client.get(url_comments, {'search': 'triangulum'})
+    data = request.data
+
+    assert request.status_code == 200
+    assert [result['pk'] for result in data['results']] == [comment.pk]
+    assert 'search_rank' in data['results'][0]
+
+    request = client.get(url_comments)
+
+    assert 'search_rank' not in request.data['results'][0]
+
+
+@pytest.mark.django_db
+def test_lookup_galaxy_with_typo_success(client):
+    constellation, user =\
+        Constellation.objects.create(**constellation_data), User.objects.create(**user_data)
+    for name in ('Andromeda', 'Andromeda II', 'Triangulum'):
+        this_galaxy_data = galaxy_data.copy()
+        this_galaxy_data['name'] = name
+        this_galaxy_data['owner'], this_galaxy_data['constellation'] = user, constellation
+        create_galaxy(**this_galaxy_data)
+
+    request = client.get(url_galaxies + 'lookup/', {'q': 'Andromda'})
+    data = request.data
+
+    assert request.status_code == 200
+    assert [result['name'] for result in data] == ['Andromeda', 'Andromeda II']
+    assert data[0]['similarity'] > data[1]['similarity']
+
+    request = client.get(url_galaxies + 'lookup/', {'q': 'Andromda', 'limit': 1})
+
+    assert [result['name'] for result in request.data] == ['Andromeda']
+
+
+@pytest.mark.django_db
+def test_lookup_constellation_by_abbreviation_success(client):
+    Constellation.objects.create(name='Andromeda', abbreviation='And', area_in_sq_deg=722)
+    Constellation.objects.create(name='Orion', abbreviation='Ori', area_in_sq_deg=594)
+
+    request = client.get(url_constellations + 'lookup/', {'q': 'and'})
+
+    assert request.status_code == 200
+    assert [result['name'] for result in request.data] == ['Andromeda']
+
+
+@pytest.mark.django_db
+def test_lookup_galaxy_invalid_threshold(client):
+    request = client.get(url_galaxies + 'lookup/', {'q': 'Andromeda', 'threshold': 2})
+
+    assert request.status_code == 400
+    assert 'threshold' in request.data
+
+
+@pytest.mark.django_db
+def test_list_galaxy_response_cache_invalidation(client, django_assert_num_queries):
+    constellation, user =\
+        Constellation.objects.create(**constellation_data), User.objects.create(**user_data)
+    this_galaxy_data = galaxy_data.copy()
+    this_galaxy_data['owner'], this_galaxy_data['constellation'] = user, constellation
+    galaxy = create_galaxy(**this_galaxy_data)
+
+    request = client.get(url_galaxies, {'expand': 'images'})
+
+    assert request['X-Cache'] == 'MISS'
+
+    with django_assert_num_queries(0):
+        request = client.get(url_galaxies, {'expand': 'images'})
+
+    assert request['X-Cache'] == 'HIT'
+    assert request.data['results'][0]['images'] == []
+
+    # A new image of the galaxy invalidates the expanded listing.
+    GalaxyImage.objects.create(galaxy=galaxy)
+    request = client.get(url_galaxies, {'expand': 'images'})
+
+    assert request['X-Cache'] == 'MISS'
+    assert len(request.data['results'][0]['images']) == 1
+
+    # An update through the API invalidates the listing.
+    client.force_authenticate(user=user)
+    client.patch(url_galaxies + str(galaxy.pk) + '/', {'notes': 'new_notes'})
+    request = client.get(url_galaxies, {'expand': 'images'})
+
+    assert request['X-Cache'] == 'MISS'
+    assert request.data['results'][0]['notes'] == 'new_notes'
+
+
+@pytest.mark.django_db
+def test_retrieve_galaxy_conditional_get(client, django_assert_num_queries):
+    constellation, user =\
+        Constellation.objects.create(**constellation_data), User.objects.create(**user_data)
+    this_galaxy_data = galaxy_data.copy()
+    this_galaxy_data['owner'], this_galaxy_data['constellation'] = user, constellation
+    galaxy = create_galaxy(**this_galaxy_data)
+    url = url_galaxies + str(galaxy.pk) + '/'
+
+    request = client.get(url)
+    etag = request['ETag']
+
+    assert request.status_code == 200
+
+    with django_assert_num_queries(0):
+        request = client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+    assert request.status_code == 304
+
+    galaxy.notes = 'new_notes'
+    galaxy.save()
+    request = client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+    assert request.status_code == 200
+    assert request['ETag'] != etag
+
+
+@pytest.mark.django_db
+def test_update_galaxy_if_match(client):
+    constellation, user =\
+        Constellation.objects.create(**constellation_data), User.objects.create(**user_data)
+    client.force_authenticate(user=user)
+    this_galaxy_data = galaxy_data.copy()
+    this_galaxy_data['owner'], this_galaxy_data['constellation'] = user, constellation
+    galaxy = create_galaxy(**this_galaxy_data)
+    url = url_galaxies + str(galaxy.pk) + '/'
+    etag = client.get(url)['ETag']
+
+    request = client.patch(url, {'notes': 'first'}, HTTP_IF_MATCH=etag)
+
+    assert request.status_code == 200
+    assert request['ETag'] != etag
+
+    request = client.patch(url, {'notes': 'second'}, HTTP_IF_MATCH=etag)
+
+    assert request.status_code == 412
+    galaxy.refresh_from_db()
+    assert galaxy.notes == 'first'
+
+
+@pytest.mark.django_db
+def test_post_comment_count_is_maintained(client):
+    user = User.objects.create(**user_data)
+    post = Post.objects.create(title='title', content='content', owner=user)
+    comments = [
+        Comment.objects.create(content=f'comment{i}', post=post, owner=user)
+        for i in range(3)
+    ]
+    comments[0].delete()
+
+    request = client.get(f'{url_posts}{post.pk}/')
+
+    assert request.status_code == 200
+    assert request.data['comment_count'] == 2
+
+    # Saving a stale instance doesn't overwrite the counter.
+    post.title = 'new title'
+    post.save()
+    post.refresh_from_db()
+
+    assert post.comment_count == 2
+    assert User.objects.get(pk=user.pk).post_count == 1
+
+
+@pytest.mark.django_db
+def test_reconcile_counters_fixes_drift():
+    user = User.objects.create(**user_data)
+    constellation = Constellation.objects.create(**constellation_data)
+    create_galaxy(**galaxy_data, constellation=constellation, owner=user)
+    Constellation.objects.update(galaxy_count=5)
+    User.objects.update(galaxy_count=0)
+
+    call_command('reconcile_counters', batch_size=1)
+
+    assert Constellation.objects.get(pk=constellation.pk).galaxy_count == 1
+    assert User.objects.get(pk=user.pk).galaxy_count == 1
+
+
+@pytest.mark.django_db
+def test_bulk_create_galaxies_success(client):
+    constellation, user =\
+        Constellation.objects.create(**constellation_data), User.objects.create(**user_data)
+    other_user = User.objects.create(email='other@mail.com', password='12345678+')
+    client.force_authenticate(user=user)
+    items = [
+        {**galaxy_data, 'name': f'name{i}', 'constellation': constellation.pk,
+         'owner': other_user.pk}
+        for i in range(3)
+    ]
+
+    request = client.post(url_galaxies + 'bulk/', items, format='json')
+
+    assert request.status_code == 201
+    assert [item['name'] for item in request.data] == ['name0', 'name1', 'name2']
+    assert Galaxy.objects.filter(owner=user).count() == 3
+    assert Constellation.objects.get(pk=constellation.pk).galaxy_count == 3
+
+
+@pytest.mark.django_db
+def test_bulk_create_galaxies_per_item_errors(client):
+    constellation, user =\
+        Constellation.objects.create(**constellation_data), User.objects.create(**user_data)
+    client.force_authenticate(user=user)
+    items = [
+        {**galaxy_data, 'constellation': constellation.pk},
+        {**galaxy_data, 'name': 'name2', 'constellation': constellation.pk, 'distance': 'far'},
+    ]
+
+    request = client.post(url_galaxies + 'bulk/', items, format='json')
+
+    assert request.status_code == 400
+    assert request.data[0] == {}
+    assert 'distance' in request.data[1]
+    assert not Galaxy.objects.exists()
+
+    request = client.post(url_galaxies + 'bulk/', items[:1] * 501, format='json')
+
+    assert request.status_code == 400
+
+
+@pytest.mark.django_db
+def test_bulk_update_and_delete_comments(client):
+    user = User.objects.create(**user_data)
+    other_user = User.objects.create(email='other@mail.com', password='12345678+')
+    post = Post.objects.create(title='title', content='content', owner=user)
+    comments = [
+        Comment.objects.create(content=f'comment{i}', post=post, owner=user)
+        for i in range(2)
+    ]
+    others_comment = Comment.objects.create(content='other', post=post, owner=other_user)
+    client.force_authenticate(user=user)
+
+    request = client.patch(url_comments + 'bulk/', [
+        {'pk': comments[0].pk, 'content': 'about Andromeda'},
+        {'pk': comments[1].pk, 'content': 'about Triangulum'},
+    ], format='json')
+
+    assert request.status_code == 200
+    assert [item['content'] for item in request.data] ==\
+        ['about Andromeda', 'about Triangulum']
+    assert client.get(url_comments, {'search': 'andromeda'}).data['count'] == 1
+
+    request = client.delete(
+        url_comments + 'bulk/', [comments[0].pk, others_comment.pk], format='json'
+    )
+
+    assert request.status_code == 403
+    assert Comment.objects.count() == 3
+
+    request = client.delete(
+        url_comments + 'bulk/', [comment.pk for comment in comments], format='json'
+    )
+
+    assert request.status_code == 204
+    assert list(Comment.objects.all()) == [others_comment]
+    assert Post.objects.get(pk=post.pk).comment_count == 1
+
+
+@pytest.mark.django_db
+def test_galaxy_image_renditions_generated_on_upload(settings, tmp_path,
+                                                     django_capture_on_commit_callbacks):
+    settings.MEDIA_ROOT = str(tmp_path)
+    settings.GALAXIES_RENDITIONS = {'ASYNC': False}
+    constellation, user =\
+        Constellation.objects.create(**constellation_data), User.objects.create(**user_data)
+    this_galaxy_data = galaxy_data.copy()
+    this_galaxy_data['owner'], this_galaxy_data['constellation'] = user, constellation
+    galaxy = create_galaxy(**this_galaxy_data)
+
+    with django_capture_on_commit_callbacks(execute=True):
+        image = GalaxyImage.objects.create(galaxy=galaxy, image=get_image_file())
+
+    image.refresh_from_db()
+
+    assert image.renditions_ready
+    assert len(list((tmp_path / '__sized__').rglob('*.png'))) == 3
+
+
+@pytest.mark.django_db
+def test_list_galaxy_images_urls_from_rendition_index(client, settings, tmp_path,
+                                                      django_capture_on_commit_callbacks):
+    settings.MEDIA_ROOT = str(tmp_path)
+    settings.GALAXIES_RENDITIONS = {
+        'ASYNC': False, 'PLACEHOLDER_URL': '/static/placeholder.png'
+    }
+    constellation, user =\
+        Constellation.objects.create(**constellation_data), User.objects.create(**user_data)
+    this_galaxy_data = galaxy_data.copy()
+    this_galaxy_data['owner'], this_galaxy_data['constellation'] = user, constellation
+    galaxy = create_galaxy(**this_galaxy_data)
+    galaxy_image = GalaxyImage.objects.create(galaxy=galaxy, image=get_image_file())
+    name = galaxy_image.image.name
+
+    with django_capture_on_commit_callbacks() as callbacks:
+        request = client.get(url_galaxy_images)
+
+    image = request.data['results'][0]['image']
+    assert image['full_size'] == f'http://testserver/media/{name}'
+    assert image['thumbnail'] == 'http://testserver/static/placeholder.png'
+    # Nothing is resized in the request, nor after it without the worker
+    # pool: the renditions are left to warm_renditions.
+    assert not (tmp_path / '__sized__').exists()
+    assert callbacks == []
+
+    # With the worker pool, a job is enqueued once the request commits.
+    settings.GALAXIES_RENDITIONS = {**settings.GALAXIES_RENDITIONS, 'ASYNC': True}
+    get_shared_cache().clear()
+
+    with django_capture_on_commit_callbacks() as callbacks:
+        client.get(url_galaxy_images, {'limit': 1})
+
+    assert len(callbacks) == 1
+
+    generate_renditions(GalaxyImage._meta.label, galaxy_image.pk)
+    request = client.get(url_galaxy_images)
+
+    image = request.data['results'][0]['image']
+    assert image['thumbnail'] ==\
+        f'http://testserver/media/__sized__/{name[:-4]}-thumbnail-100x100.png'
+
+
+@pytest.mark.django_db
+def test_list_galaxy_images_webp_negotiation(client, settings, tmp_path,
+                                             django_capture_on_commit_callbacks):
+    settings.MEDIA_ROOT = str(tmp_path)
+    settings.GALAXIES_RENDITIONS = {'ASYNC': False, 'FORMATS': {'webp': {'quality': 80}}}
+    constellation, user =\
+        Constellation.objects.create(**constellation_data), User.objects.create(**user_data)
+    this_galaxy_data = galaxy_data.copy()
+    this_galaxy_data['owner'], this_galaxy_data['constellation'] = user, constellation
+    galaxy = create_galaxy(**this_galaxy_data)
+
+    with django_capture_on_commit_callbacks(execute=True):
+        name = GalaxyImage.objects.create(galaxy=galaxy, image=get_image_file()).image.name
+
+    request = client.get(url_galaxy_images, HTTP_ACCEPT='application/json, image/webp')
+
+    image = request.data['results'][0]['image']
+    assert image['full_size'] == f'http://testserver/media/{name}.webp'
+    assert image['thumbnail'] ==\
+        f'http://testserver/media/__sized__/{name[:-4]}-thumbnail-100x100.png.webp'
+    assert 'Accept' in request['Vary']
+
+    request = client.get(url_galaxy_images, HTTP_ACCEPT='application/json, image/*')
+
+    assert request['X-Cache'] == 'MISS'
+    assert request.data['results'][0]['image']['full_size'] ==\
+        f'http://testserver/media/{name}'
+
+
+@pytest.mark.django_db
+def test_create_post_image_metadata_extracted(client, settings, tmp_path):
+    settings.MEDIA_ROOT = str(tmp_path)
+    user = User.objects.create(**user_data)
+    post = Post.objects.create(title='title', content='content', owner=user)
+    image_file = get_image_file(size=(64, 48))
+    image = PostImage.objects.create(post=post, image=image_file)
+
+    request = client.get(url_post_images + str(image.pk) + '/')
+    data = request.data
+
+    assert request.status_code == 200
+    assert (data['width'], data['height']) == (64, 48)
+    image_file.seek(0)
+    content = image_file.read()
+    assert data['byte_size'] == len(content)
+    assert data['sha256'] == hashlib.sha256(content).hexdigest()
+    assert len(data['blurhash']) == 28
+
+
+@pytest.mark.django_db
+def test_galaxy_images_content_addressed_and_deduplicated(settings, tmp_path,
+                                                          django_capture_on_commit_callbacks):
+    settings.MEDIA_ROOT = str(tmp_path)
+    constellation, user =\
+        Constellation.objects.create(**constellation_data), User.objects.create(**user_data)
+    this_galaxy_data = galaxy_data.copy()
+    this_galaxy_data['owner'], this_galaxy_data['constellation'] = user, constellation
+    galaxy = create_galaxy(**this_galaxy_data)
+
+    first = GalaxyImage.objects.create(galaxy=galaxy, image=get_image_file('first.png'))
+    second = GalaxyImage.objects.create(galaxy=galaxy, image=get_image_file('second.png'))
+
+    digest = first.sha256
+    assert first.image.name == f'images/{digest[:2]}/{digest[2:4]}/{digest}.png'
+    assert second.image.name == first.image.name
+    assert len(list((tmp_path / 'images').rglob('*.png'))) == 1
+
+    # The blob is shared, so it is only deleted with the last image.
+    with django_capture_on_commit_callbacks(execute=True):
+        first.delete()
+
+    assert (tmp_path / second.image.name).exists()
+
+    with django_capture_on_commit_callbacks(execute=True):
+        second.delete()
+
+    assert not (tmp_path / second.image.name).exists()
+
+
+@pytest.mark.django_db
+def test_resumable_upload_galaxy_image_success(client, settings, tmp_path,
+                                               django_capture_on_commit_callbacks):
+    settings.MEDIA_ROOT = str(tmp_path)
+    constellation, user =\
+        Constellation.objects.create(**constellation_data), User.objects.create(**user_data)
+    this_galaxy_data = galaxy_data.copy()
+    this_galaxy_data['owner'], this_galaxy_data['constellation'] = user, constellation
+    galaxy = create_galaxy(**this_galaxy_data)
+    client.force_authenticate(user=user)
+    content = get_image_file(size=(128, 96)).read()
+    size, middle = len(content), len(content) // 2
+
+    request = client.post(
+        url_uploads, {'galaxy': galaxy.pk, 'filename': '../m31.png', 'size': size}
+    )
+
+    assert request.status_code == 201
+    assert request.data['filename'] == 'm31.png'
+    assert request.data['received'] == 0
+    url_upload = url_uploads + request.data['id'] + '/'
+
+    request = client.put(url_upload, data=content[:middle],
+                         content_type='application/octet-stream',
+                         HTTP_CONTENT_RANGE=f'bytes 0-{middle - 1}/{size}')
+
+    assert request.status_code == 200
+    assert request.data['received'] == middle
+
+    # Not complete yet.
+    request = client.post(url_upload + 'finalize/')
+
+    assert request.status_code == 409
+
+    # Resumes from the offset the server reports.
+    offset = client.get(url_upload).data['received']
+    request = client.put(url_upload, data=content[offset:],
+                         content_type='application/octet-stream',
+                         HTTP_CONTENT_RANGE=f'bytes {offset}-{size - 1}/{size}')
+
+    assert request.data['received'] == size
+
+    with django_capture_on_commit_callbacks(execute=True):
+        request = client.post(url_upload + 'finalize/')
+
+    assert request.status_code == 201
+    image = GalaxyImage.objects.get(pk=request.data['pk'])
+    assert image.galaxy == galaxy
+    assert image.sha256 == hashlib.sha256(content).hexdigest()
+    assert (image.width, image.height) == (128, 96)
+    assert client.get(url_upload).status_code == 404
+    assert not list((tmp_path / '.uploads').iterdir())
+
+
+@pytest.mark.django_db
+def test_resumable_upload_rejected(client, settings, tmp_path):
+    settings.MEDIA_ROOT = str(tmp_path)
+    constellation, user, other_user =\
+        Constellation.objects.create(**constellation_data), User.objects.create(**user_data),\
+        User.objects.create(email='other@mail.com', password='12345678+')
+    this_galaxy_data = galaxy_data.copy()
+    this_galaxy_data['owner'], this_galaxy_data['constellation'] = user, constellation
+    galaxy = create_galaxy(**this_galaxy_data)
+
+    client.force_authenticate(user=other_user)
+    request = client.post(url_uploads, {'galaxy': galaxy.pk, 'filename': 'a.png', 'size': 10})
+
+    assert request.status_code == 403
+
+    client.force_authenticate(user=user)
+    request = client.post(url_uploads, {'galaxy': galaxy.pk, 'filename': 'a.png', 'size': 10})
+    url_upload = url_uploads + request.data['id'] + '/'
+
+    request = client.put(url_upload, data=b'0123456789',
+                         content_type='application/octet-stream',
+                         HTTP_CONTENT_RANGE='bytes 4-13/10')
+
+    assert request.status_code == 416
+
+    request = client.put(url_upload, data=b'#!/bin/sh\n',
+                         content_type='application/octet-stream',
+                         HTTP_CONTENT_RANGE='bytes 0-9/10')
+
+    assert request.status_code == 415
+    # The session is discarded.
+    assert client.get(url_upload).status_code == 404
+
+
+@pytest.mark.django_db
+def test_serve_media_success(client, settings, tmp_path,
+                             django_capture_on_commit_callbacks):
+    settings.MEDIA_ROOT = str(tmp_path)
+    settings.GALAXIES_RENDITIONS = {'ASYNC': False, 'FORMATS': {}}
+    constellation, user =\
+        Constellation.objects.create(**constellation_data), User.objects.create(**user_data)
+    this_galaxy_data = galaxy_data.copy()
+    this_galaxy_data['owner'], this_galaxy_data['constellation'] = user, constellation
+    galaxy = create_galaxy(**this_galaxy_data)
+
+    with django_capture_on_commit_callbacks(execute=True):
+        image = GalaxyImage.objects.create(galaxy=galaxy, image=get_image_file())
+
+    content = (tmp_path / image.image.name).read_bytes()
+    request = client.get('/media/' + image.image.name)
+
+    assert request.status_code == 200
+    assert b''.join(request.streaming_content) == content
+    assert request['Content-Type'] == 'image/png'
+    assert request['Accept-Ranges'] == 'bytes'
+    assert request['Cache-Control'] == 'public, max-age=31536000, immutable'
+
+    request = client.get('/media/' + image.image.name, HTTP_IF_NONE_MATCH=request['ETag'])
+
+    assert request.status_code == 304
+
+    request = client.get('/media/' + image.image.name, HTTP_RANGE='bytes=10-19')
+
+    assert request.status_code == 206
+    assert request['Content-Range'] == f'bytes 10-19/{len(content)}'
+    assert b''.join(request.streaming_content) == content[10:20]
+
+    request = client.get('/media/' + image.image.name, HTTP_RANGE=f'bytes={len(content)}-')
+
+    assert request.status_code == 416
+
+    image.refresh_from_db()
+    request = client.get('/media/' + image.renditions['thumbnail__100x100'])
+
+    assert request.status_code == 200
+
+    settings.GALAXIES_MEDIA_SERVING = {'OFFLOAD': 'x-accel-redirect'}
+    request = client.get('/media/' + image.image.name)
+
+    assert request['X-Accel-Redirect'] == '/protected-media/' + image.image.name
+    assert request.content == b''
+
+
+@pytest.mark.django_db
+def test_serve_media_not_visible(client, settings, tmp_path,
+                                 django_capture_on_commit_callbacks, django_assert_num_queries):
+    settings.MEDIA_ROOT = str(tmp_path)
+    constellation, user =\
+        Constellation.objects.create(**constellation_data), User.objects.create(**user_data)
+    this_galaxy_data = galaxy_data.copy()
+    this_galaxy_data['owner'], this_galaxy_data['constellation'] = user, constellation
+    galaxy = create_galaxy(**this_galaxy_data)
+    image = GalaxyImage.objects.create(galaxy=galaxy, image=get_image_file())
+    (tmp_path / '.uploads').mkdir()
+    (tmp_path / '.uploads' / 'upload.part').write_bytes(b'secret')
+    (tmp_path / 'images' / 'stray.png').write_bytes(b'stray')
+
+    assert client.get('/media/.uploads/upload.part').status_code == 404
+    assert client.get('/media/images/stray.png').status_code == 404
+    assert client.get('/media/images/../settings.py').status_code == 404
+
+    name = image.image.name
+
+    assert client.get('/media/' + name).status_code == 200
+
+    # The visible names are cached.
+    with django_assert_num_queries(0):
+        assert client.get('/media/' + name).status_code == 200
+
+    with django_capture_on_commit_callbacks(execute=True):
+        image.delete()
+
+    assert client.get('/media/' + name).status_code == 404
+
+
+@pytest.mark.django_db
+def test_purge_user_in_batches(settings, tmp_path, django_capture_on_commit_callbacks):
+    settings.MEDIA_ROOT = str(tmp_path)
+    settings.GALAXIES_PURGE = {'ASYNC': False, 'BATCH_SIZE': 2}
+    constellation, user =\
+        Constellation.objects.create(**constellation_data), User.objects.create(**user_data)
+    galaxies = [
+        create_galaxy(**{
+            **galaxy_data, 'name': f'name{i}', 'owner': user, 'constellation': constellation
+        })
+        for i in range(3)
+    ]
+    image = GalaxyImage.objects.create(galaxy=galaxies[0], image=get_image_file())
+    post = Post.objects.create(title='title', content='content', owner=user)
+    comment = Comment.objects.create(post=post, content='content', owner=user)
+
+    with django_capture_on_commit_callbacks(execute=True):
+        mark_for_deletion(user)
+
+    assert not User.objects.filter(pk=user.pk).exists()
+    assert not Galaxy.objects.exists()
+    assert not (tmp_path / image.image.name).exists()
+    # Posts and comments outlive their owner.
+    post.refresh_from_db()
+    comment.refresh_from_db()
+    assert post.owner is None
+    assert comment.owner is None
+
+
+@pytest.mark.django_db
+def test_collect_media_garbage(settings, tmp_path, capsys):
+    settings.MEDIA_ROOT = str(tmp_path)
+    constellation, user =\
+        Constellation.objects.create(**constellation_data), User.objects.create(**user_data)
+    this_galaxy_data = galaxy_data.copy()
+    this_galaxy_data['owner'], this_galaxy_data['constellation'] = user, constellation
+    galaxy = create_galaxy(**this_galaxy_data)
+    image = GalaxyImage.objects.create(galaxy=galaxy, image=get_image_file())
+    orphans = [
+        tmp_path / 'images' / 'ab' / 'cd' / ('abcd' + '0' * 60 + '.png'),
+        tmp_path / '__sized__' / 'images' / 'stray-thumbnail-100x100.png',
+    ]
+    recent = tmp_path / 'images' / 'recent.png'
+
+    for path in orphans + [recent]:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b'orphan')
+
+    for path in orphans + [tmp_path / image.image.name]:
+        os.utime(path, (0, 0))
+
+    call_command('collect_media_garbage', '--dry-run')
+    output = capsys.readouterr().out
+
+    assert '2 orphaned files, 12 bytes would be freed' in output
+    assert all(path.exists() for path in orphans)
+
+    call_command('collect_media_garbage')
+
+    assert not any(path.exists() for path in orphans)
+    assert recent.exists()
+    assert (tmp_path / image.image.name).exists()
+
+
+@pytest.mark.django_db
+def test_cone_search_galaxies_success(client):
+    constellation, user =\
+        Constellation.objects.create(**constellation_data), User.objects.create(**user_data)
+    positions = {
+        'M31': (10.6847, 41.2690),
+        'M32': (10.6743, 40.8652),
+        'M110': (10.0920, 41.6853),
+        'M33': (23.4621, 30.6602),
+        'wrapped': (0.3, -0.2),
+        'no_position': (None, None),
+    }
+    for name, (ra, dec) in positions.items():
+        create_galaxy(**{
+            **galaxy_data, 'name': name, 'ra': ra, 'dec': dec,
+            'owner': user, 'constellation': constellation,
+        })
+
+    request = client.get(url_galaxies + 'cone/', {'ra': 10.6847, 'dec': 41.2690, 'radius': 1})
+    data = request.data
+
+    assert request.status_code == 200
+    assert [galaxy['name'] for galaxy in data] == ['M31', 'M32', 'M110']
+    assert data[0]['separation'] == 0
+    assert data[1]['separation'] == pytest.approx(0.4038, abs=1e-3)
+
+    # Around 0h, the right ascension range wraps around.
+    request = client.get(url_galaxies + 'cone/', {'ra': 359.8, 'dec': 0, 'radius': 1})
+
+    assert [galaxy['name'] for galaxy in request.data] == ['wrapped']
+
+    request = client.get(url_galaxies + 'cone/', {'ra': 10, 'dec': 41, 'radius': 45})
+
+    assert request.status_code == 400
+    assert 'radius' in request.data
+
+
+@pytest.mark.django_db
+def test_cross_match_galaxies_success(client):
+    constellation, user =\
+        Constellation.objects.create(**constellation_data), User.objects.create(**user_data)
+    galaxies = {
+        name: create_galaxy(**{
+            **galaxy_data, 'name': name, 'ra': ra, 'dec': dec,
+            'owner': user, 'constellation': constellation,
+        })
+        for name, ra, dec in (('M31', 10.6847, 41.2690), ('M32', 10.6743, 40.8652),
+                              ('wrapped', 359.9995, 0))
+    }
+    client.force_authenticate(user=user)
+
+    request = client.post(
+        url_galaxies + 'crossmatch/',
+        [[10.6850, 41.2691], {'ra': 0.0004, 'dec': 0.0002}, [200, -45]],
+        format='json'
+    )
+    results = json.loads(b''.join(request.streaming_content))
+
+    assert request.status_code == 200
+    assert [result['galaxy'] for result in results] ==\
+        [galaxies['M31'].pk, galaxies['wrapped'].pk, None]
+    assert results[0]['separation'] == pytest.approx(0.000243, abs=1e-5)
+    assert results[2]['separation'] is None
+
+    request = client.post(
+        url_galaxies + 'crossmatch/?radius=0.1',
+        data='id,dec,ra\n1,40.9,10.67\n',
+        content_type='text/csv'
+    )
+    lines = b''.join(request.streaming_content).decode().splitlines()
+
+    assert request['Content-Type'] == 'text/csv'
+    assert lines[0] == 'row,ra,dec,galaxy,separation'
+    assert lines[1].split(',')[3] == str(galaxies['M32'].pk)
+
+    request = client.post(url_galaxies + 'crossmatch/', [[400, 0]], format='json')
+
+    assert request.status_code == 400
+
+
+@pytest.mark.django_db
+def test_sky_tiles_updated_incrementally(client, settings):
+    settings.GALAXIES_SKY = {'TILE_LEVELS': 3, 'TILE_DETAIL': 1}
+    constellation, user =\
+        Constellation.objects.create(**constellation_data), User.objects.create(**user_data)
+    m31 = create_galaxy(**{
+        **galaxy_data, 'name': 'M31', 'ra': 10.68, 'dec': 41.27, 'apparent_magnitude': 3.4,
+        'owner': user, 'constellation': constellation,
+    })
+    create_galaxy(**{
+        **galaxy_data, 'name': 'M33', 'ra': 23.46, 'dec': 30.66, 'apparent_magnitude': 5.7,
+        'owner': user, 'constellation': constellation,
+    })
+
+    request = client.get('/sky_tiles/0/0/0/')
+    data = request.data
+
+    assert request.status_code == 200
+    assert 'max-age=86400' in request['Cache-Control']
+    # The northern half of the 0h-12h quarter holds both galaxies.
+    assert data['level'] == 1
+    assert data['counts'] == [[2, 0], [0, 0]]
+    assert data['mean_magnitudes'][0][0] == pytest.approx(4.55)
+    assert data['mean_magnitudes'][1][1] is None
+
+    assert client.get('/sky_tiles/0/0/0/', HTTP_IF_NONE_MATCH=request['ETag']).status_code == 304
+
+    m31.dec = -41.27
+    m31.save()
+
+    assert client.get('/sky_tiles/0/0/0/').data['counts'] == [[1, 0], [1, 0]]
+
+    m31.delete()
+    counts = client.get('/sky_tiles/1/0/0/').data['counts']
+
+    assert sum(map(sum, counts)) == 1
+    assert client.get('/sky_tiles/0/2/0/').status_code == 404
+
+    # The level 0 cells, which no tile is made of, are not stored.
+    assert not SkyTile.objects.filter(level=0).exists()
+
+    incremental = set(SkyTile.objects.filter(count__gt=0).values_list('level', 'cell', 'count'))
+    call_command('rebuild_sky_tiles')
+
+    assert set(SkyTile.objects.values_list('level', 'cell', 'count')) == incremental
+
+
+@pytest.mark.django_db
+def test_galaxy_stats_success(client):
+    constellation, user =\
+        Constellation.objects.create(**constellation_data), User.objects.create(**user_data)
+
+    for i, (galaxy_type, distance) in enumerate(
+            [('spiral', 100), ('spiral', 300), ('spiral', 500), ('elliptical', 1000)]):
+        create_galaxy(**{
+            **galaxy_data, 'name': f'G{i}', 'galaxy_type': galaxy_type, 'distance': distance,
+            'owner': user, 'constellation': constellation,
+        })
+
+    request = client.get('/galaxies/stats/', {'group_by': 'galaxy_type', 'bins': 9})
+    data = request.data
+    spiral = next(group for group in data['groups'] if group['galaxy_type'] == 'spiral')
+
+    assert request.status_code == 200
+    assert request['X-Cache'] == 'MISS'
+    assert data['fields']['distance']['bin_edges'][::3] == [100, 400, 700, 1000]
+    assert spiral['count'] == 3
+    assert spiral['distance']['min'] == 100
+    assert spiral['distance']['mean'] == 300
+    assert spiral['distance']['percentiles']['50'] == 300
+    assert spiral['distance']['histogram'] == [1, 0, 1, 0, 1, 0, 0, 0, 0]
+    assert sum(data['groups'][0]['distance']['histogram']) == 1
+
+    filtered = client.get('/galaxies/stats/', {'distance__lte': 300}).data
+
+    assert filtered['groups'][0]['count'] == 2
+    assert filtered['groups'][0]['distance']['max'] == 300
+
+    assert client.get(
+        '/galaxies/stats/', {'group_by': 'galaxy_type', 'bins': 9}
+    )['X-Cache'] == 'HIT'
+
+    Galaxy.objects.filter(name='G0').get().delete()
+
+    assert client.get(
+        '/galaxies/stats/', {'group_by': 'galaxy_type', 'bins': 9}
+    ).data['groups'][1]['count'] == 2
+    assert client.get('/galaxies/stats/', {'bins': 1000}).status_code == 400
+
+
+@pytest.mark.django_db
+def test_similar_galaxies_success(client, django_capture_on_commit_callbacks):
+    constellation, user =\
+        Constellation.objects.create(**constellation_data), User.objects.create(**user_data)
+    other_constellation = Constellation.objects.create(**{
+        **constellation_data, 'name': 'Cassiopeia', 'abbreviation': 'Cas'
+    })
+    galaxies = {}
+
+    with django_capture_on_commit_callbacks(execute=True):
+        for name, galaxy_type, distance, magnitude, galaxy_constellation in [
+                ('M31', 'spiral', 2500, 3.4, constellation),
+                ('M33', 'spiral', 2700, 5.7, constellation),
+                ('M110', 'elliptical', 2600, 8.5, constellation),
+                ('NGC 185', 'elliptical', 2000, 9.2, other_constellation)]:
+            galaxies[name] = create_galaxy(**{
+                **galaxy_data, 'name': name, 'galaxy_type': galaxy_type, 'distance': distance,
+                'apparent_magnitude': magnitude, 'owner': user,
+                'constellation': galaxy_constellation,
+            })
+
+    request = client.get(f'/galaxies/{galaxies["M31"].pk}/similar/', {'limit': 2})
+
+    assert request.status_code == 200
+    assert [galaxy['name'] for galaxy in request.data] == ['M33', 'M110']
+    assert 0 < request.data[1]['similarity'] < request.data[0]['similarity'] <= 1
+
+    # The matrix is refreshed from the changes journal.
+    with django_capture_on_commit_callbacks(execute=True):
+        galaxies['M33'].delete()
+        galaxies['NGC 185'].apparent_magnitude = 3.5
+        galaxies['NGC 185'].galaxy_type = resolve_galaxy_type('spiral')
+        galaxies['NGC 185'].constellation = constellation
+        galaxies['NGC 185'].save()
+
+    request = client.get(f'/galaxies/{galaxies["M31"].pk}/similar/', {'limit': 5})
+
+    assert [galaxy['name'] for galaxy in request.data] == ['NGC 185', 'M110']
+    assert client.get('/galaxies/0/similar/').status_code == 404
+
+
+@pytest.mark.django_db
+def test_galaxy_derived_fields_success(client):
+    constellation, user =\
+        Constellation.objects.create(**constellation_data), User.objects.create(**user_data)
+
+    for name, distance, magnitude, size in [
+            ('M31', 2500, 3.4, 178), ('M33', 2730, 5.7, 73), ('M110', 2690, 8.5, 22)]:
+        create_galaxy(**{
+            **galaxy_data, 'name': name, 'distance': distance, 'apparent_magnitude': magnitude,
+            'size': size, 'owner': user, 'constellation': constellation,
+        })
+
+    # The brightest first.
+    m31 = client.get('/galaxies/', {'ordering': 'absolute_magnitude'}).data['results'][0]
+
+    assert m31['absolute_magnitude'] == pytest.approx(-21.02, abs=0.01)
+    assert m31['physical_size'] == pytest.approx(129.4, abs=0.1)
+
+    request = client.get(
+        '/galaxies/', {'absolute_magnitude__gte': -20, 'ordering': '-physical_size'}
+    )
+
+    assert [galaxy['name'] for galaxy in request.data['results']] == ['M33', 'M110']
+
+
+@pytest.mark.django_db
+def test_galaxy_types_success(client):
+    constellation, user =\
+        Constellation.objects.create(**constellation_data), User.objects.create(**user_data)
+
+    for name, galaxy_type in [('M31', 'SBb'), ('M33', ' Sc '), ('M87', 'E0')]:
+        create_galaxy(**{
+            **galaxy_data, 'name': name, 'galaxy_type': galaxy_type, 'owner': user,
+            'constellation': constellation,
+        })
+
+    # Legacy rows, with only the free-text type.
+    for name, galaxy_type in [('M110', 'sbB'), ('NGC 185', 'dwarf  spheroidal')]:
+        Galaxy.objects.create(**{
+            **galaxy_data, 'name': name, 'galaxy_type': None, 'legacy_galaxy_type': galaxy_type,
+            'owner': user, 'constellation': constellation,
+        })
+
+    call_command('normalize_galaxy_types', batch_size=1)
+
+    assert Galaxy.objects.get(name='M110').galaxy_type.name == 'SBb'
+    assert Galaxy.objects.get(name='NGC 185').galaxy_type.name == 'dwarf spheroidal'
+
+    request = client.get('/galaxies/', {'galaxy_type': 'sbb', 'ordering': 'name'})
+
+    assert [galaxy['name'] for galaxy in request.data['results']] == ['M110', 'M31']
+    assert request.data['results'][0]['galaxy_type'] == 'SBb'
+
+    request = client.get('/galaxies/', {'galaxy_type_family': 'spiral', 'ordering': 'name'})
+
+    assert [galaxy['name'] for galaxy in request.data['results']] == ['M110', 'M31', 'M33']
+
+    request = client.get('/galaxies/', {'galaxy_type': 'unknown'})
+
+    assert request.data['results'] == []
+
+
+@pytest.mark.django_db
+def test_list_galaxy_ordering_ties_are_broken_by_pk(client):
+    constellation, user =\
+        Constellation.objects.create(**constellation_data), User.objects.create(**user_data)
+    pks = [
+        create_galaxy(**{
+            **galaxy_data, 'name': f'galaxy{i}', 'owner': user, 'constellation': constellation,
+        }).pk
+        for i in range(5)
+    ]
+
+    for ordering, expected in [('distance', pks), ('-distance', pks[::-1])]:
+        pages = [
+            client.get(url_galaxies, {'ordering': ordering, 'limit': 2, 'offset': offset})
+            for offset in (0, 2, 4)
+        ]
+
+        assert [
+            result['pk'] for page in pages for result in page.data['results']
+        ] == expected
+
+
+@pytest.mark.django_db
+def test_search_ranks_and_highlights_the_returned_page_only(client):
+    user = User.objects.create(**user_data)
+    post = Post.objects.create(title='title', content='content', owner=user)
+    for i in range(3):
+        Comment.objects.create(content=f'Andromeda {"galaxy " * i}', post=post, owner=user)
+
+    with CaptureQueriesContext(connection) as context:
+        request = client.get(url_comments, {'search': 'andromeda', 'limit': 2})
+
+    assert request.data['count'] == 3
+    assert [bool(result['search_headline']) for result in request.data['results']] == [True] * 2
+    count_query = next(query['sql'] for query in context if 'COUNT(' in query['sql'])
+    assert 'ts_headline' not in count_query and 'ts_rank' not in count_query
+
+    # Cursors carry the rank.
+    request = client.get(url_comments, {'search': 'andromeda', 'limit': 2, 'cursor': ''})
+    pks = [result['pk'] for result in request.data['results']]
+    request = client.get(request.data['next'])
+    pks += [result['pk'] for result in request.data['results']]
+
+    assert sorted(pks) == sorted(Comment.objects.values_list('pk', flat=True))
+    assert request.data['results'][0]['search_rank'] > 0
+
+
+def test_worker_pools_need_a_shared_cache(settings):
+    settings.GALAXIES_RENDITIONS = {'ASYNC': True}
+
+    assert [error.id for error in check_shared_cache(None)] == ['galaxies.E001']
+
+    settings.CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': 'redis://127.0.0.1:6379',
+        },
+    }
+
+    assert check_shared_cache(None) == []
+
+
+@pytest.mark.django_db
+def test_cascaded_deletes_update_the_counters_once(client):
+    user = User.objects.create(**user_data)
+    posts = [
+        Post.objects.create(title=f'title{i}', content='content', owner=user) for i in range(2)
+    ]
+    comments = [
+        Comment.objects.create(content=f'comment{i}', post=posts[0], owner=user)
+        for i in range(3)
+    ]
+    client.force_authenticate(user=user)
+
+    with CaptureQueriesContext(connection) as context:
+        request = client.delete(
+            url_comments + 'bulk/', [comment.pk for comment in comments[:2]], format='json'
+        )
+
+    assert request.status_code == 204
+    assert Post.objects.get(pk=posts[0].pk).comment_count == 1
+    assert len([
+        query for query in context if query['sql'].startswith('UPDATE "galaxies_post"')
+    ]) == 1
+
+    # The comments of a deleted post don't update its counter.
+    with CaptureQueriesContext(connection) as context:
+        Post.objects.get(pk=posts[0].pk).delete()
+
+    assert not [query for query in context if query['sql'].startswith('UPDATE "galaxies_post"')]
+    assert User.objects.get(pk=user.pk).post_count == 1
+
+
+@pytest.mark.django_db
+def test_collect_media_garbage_keeps_relinked_blobs(settings, tmp_path):
+    settings.MEDIA_ROOT = str(tmp_path)
+    constellation, user =\
+        Constellation.objects.create(**constellation_data), User.objects.create(**user_data)
+    this_galaxy_data = galaxy_data.copy()
+    this_galaxy_data['owner'], this_galaxy_data['constellation'] = user, constellation
+    galaxy = create_galaxy(**this_galaxy_data)
+    name = GalaxyImage.objects.create(galaxy=galaxy, image=get_image_file()).image.name
+    GalaxyImage.objects.all().delete()
+    os.utime(tmp_path / name, (0, 0))
+
+    # An upload of the same content, whose row isn't committed yet when
+    # the orphans are listed.
+    assert find_orphaned_files() == [(name, os.path.getsize(tmp_path / name))]
+    GalaxyImage.objects.create(galaxy=galaxy, image=get_image_file())
+
+    assert not delete_orphaned_file(default_storage, name)
+    assert (tmp_path / name).exists()
+
+
+def test_similarity_journal_gaps_are_waited_for_then_reloaded(settings):
+    settings.GALAXIES_SIMILARITY = {'JOURNAL_GRACE': 0}
+    position, _ = read_journal(None)
+    shared_cache = get_shared_cache()
+
+    # An entry never written, by a process that died after taking it, and
+    # one after it.
+    shared_cache.incr(JOURNAL_KEY)
+    shared_cache.set(f'{JOURNAL_KEY}:{shared_cache.incr(JOURNAL_KEY)}', [1])
+
+    assert read_journal(position) == (position, set())
+    time.sleep(0.01)
+    assert read_journal(position) == (position + 2, None)
+
+
+@pytest.mark.django_db
+def test_galaxy_type_is_resolved_after_validation(client):
+    constellation, user =\
+        Constellation.objects.create(**constellation_data), User.objects.create(**user_data)
+    client.force_authenticate(user=user)
+    item = {
+        **galaxy_data, 'galaxy_type': 'ring', 'constellation': constellation.pk, 'owner': user.pk,
+    }
+    types = GalaxyType.objects.count()
+
+    request = client.post(url_galaxies, item, format='json')
+
+    assert request.status_code == 400
+    assert 'Unknown galaxy type "ring"' in request.data['galaxy_type'][0]
+    assert 'SBb' in request.data['galaxy_type'][0]
+
+    request = client.post(url_galaxies + 'bulk/', [{**item, 'galaxy_type': 'Sb'}, item], format='json')
+
+    assert request.status_code == 400
+    assert GalaxyType.objects.count() == types
+    assert not Galaxy.objects.exists()
+
+    request = client.post(url_galaxies, {**item, 'galaxy_type': ' sbB '}, format='json')
+
+    assert request.status_code == 201
+    assert request.data['galaxy_type'] == 'SBb'
+    assert Galaxy.objects.get().galaxy_type.name == 'SBb'
+
+    # A type written without the signals, as by another process the types
+    # in memory have not been reloaded since.
+    get_types()
+    GalaxyType.objects.bulk_create([GalaxyType(name='polar ring')])
+
+    request = client.post(
+        url_galaxies, {**item, 'name': 'NGC 4650A', 'galaxy_type': 'Polar Ring'}, format='json'
+    )
+
+    assert request.status_code == 201
+    assert request.data['galaxy_type'] == 'polar ring'
+
+    request = client.get(f'{url_galaxies}{request.data["pk"]}/')
+
+    assert request.data['galaxy_type'] == 'polar ring'
+
+
+@pytest.mark.django_db
+def test_list_galaxies_reads_galaxy_types_once(client, monkeypatch):
+    constellation, user =\
+        Constellation.objects.create(**constellation_data), User.objects.create(**user_data)
+
+    for name in ['M31', 'M33', 'M110']:
+        create_galaxy(**{**galaxy_data, 'name': name, 'owner': user, 'constellation': constellation})
+
+    calls = []
+    monkeypatch.setattr(
+        serializers_module, 'get_types', lambda: calls.append(1) or get_types()
+    )
+
+    request = client.get(url_galaxies)
+
+    assert request.status_code == 200
+    assert [result['galaxy_type'] for result in request.data['results']] == ['Sb'] * 3
+    assert len(calls) == 1
+
+
+@pytest.mark.django_db
+def test_retrieve_constellation_image_response_cache(client):
+    constellation = Constellation.objects.create(**constellation_data)
+    image = ConstellationImage.objects.create(constellation=constellation)
+    url = f'{url_constellation_images}{image.pk}/'
+
+    assert client.get(url)['X-Cache'] == 'MISS'
+    assert client.get(url)['X-Cache'] == 'HIT'
+
+    image.save()
+
+    assert client.get(url)['X-Cache'] == 'MISS'
+
+    request = client.get(url_constellation_images)
+
+    assert request.status_code == 200
+    assert request['X-Cache'] == 'MISS'
+    assert [result['pk'] for result in request.data['results']] == [image.pk]
+    assert client.get(url_constellation_images)['X-Cache'] == 'HIT'
+
+    etag = client.get(url)['ETag']
+
+    assert client.get(url, HTTP_IF_NONE_MATCH=etag).status_code == 304
+    assert client.put(url, {}).status_code == 405
+
+
+@pytest.mark.django_db
+def test_retrieve_galaxy_last_modified_once_its_second_is_over(client, monkeypatch):
+    clock = {'now': 1_700_000_000.25}
+    monkeypatch.setattr(response_cache, 'time', SimpleNamespace(
+        time=lambda: clock['now'],
+        time_ns=lambda: int(clock['now'] * 10 ** 9),
+        monotonic=time.monotonic,
+    ))
+    constellation, user =\
+        Constellation.objects.create(**constellation_data), User.objects.create(**user_data)
+    galaxy = create_galaxy(**{**galaxy_data, 'owner': user, 'constellation': constellation})
+    url = f'{url_galaxies}{galaxy.pk}/'
+    written = http_date(1_700_000_000)
+
+    request = client.get(url)
+
+    assert 'Last-Modified' not in request
+    assert client.get(url, HTTP_IF_MODIFIED_SINCE=written).status_code == 200
+
+    clock['now'] += 1
+    request = client.get(url)
+
+    assert request['Last-Modified'] == written
+    assert client.get(url, HTTP_IF_MODIFIED_SINCE=written).status_code == 304
+
+    # Writes at the same time still change the version.
+    etag = request['ETag']
+    galaxy.save()
+    request = client.get(url)
+
+    assert request['ETag'] != etag
+    assert 'Last-Modified' not in request
+
+    galaxy.save()
+
+    assert client.get(url)['ETag'] != request['ETag']
+    assert client.get(url, HTTP_IF_MODIFIED_SINCE=written).status_code == 200
+
+
+@pytest.mark.django_db
+def test_bulk_write_galaxies_unique_errors_per_item(client):
+    constellation, user =\
+        Constellation.objects.create(**constellation_data), User.objects.create(**user_data)
+    client.force_authenticate(user=user)
+    galaxies = [
+        create_galaxy(**{
+            **galaxy_data, 'name': name, 'owner': user, 'constellation': constellation,
+        })
+        for name in ('M31', 'M33')
+    ]
+    items = [
+        {**galaxy_data, 'name': name, 'constellation': constellation.pk}
+        for name in ('M81', 'M82', 'M81')
+    ]
+
+    request = client.post(url_galaxies + 'bulk/', items, format='json')
+
+    assert request.status_code == 400
+    assert request.data[:2] == [{}, {}]
+    assert 'name' in request.data[2]
+    assert Galaxy.objects.count() == 2
+
+    request = client.patch(url_galaxies + 'bulk/', [
+        {'pk': galaxies[0].pk, 'name': 'M110'}, {'pk': galaxies[1].pk, 'name': 'M110'},
+    ], format='json')
+
+    assert request.status_code == 400
+    assert request.data[0] == {}
+    assert 'name' in request.data[1]
+
+
+@pytest.mark.django_db
+def test_list_galaxy_keyset_pages_past_null_sort_keys(client):
+    constellation, user =\
+        Constellation.objects.create(**constellation_data), User.objects.create(**user_data)
+    # The absolute magnitude is NULL without a distance, so the second page
+    # ends on a NULL.
+    pks = [
+        create_galaxy(**{
+            **galaxy_data, 'name': f'G{i}', 'distance': distance, 'owner': user,
+            'constellation': constellation,
+        }).pk
+        for i, distance in enumerate((0, 100, 0, 200, 300))
+    ]
+    nulls = [pks[0], pks[2]]
+
+    for ordering, expected in [
+        ('absolute_magnitude', [pks[4], pks[3], pks[1]] + nulls),
+        # The ties are broken by pk in the direction of the ordering.
+        ('-absolute_magnitude', [pks[1], pks[3], pks[4]] + nulls[::-1]),
+    ]:
+        request = client.get(url_galaxies, {'ordering': ordering, 'cursor': '', 'limit': 2})
+        pages = [request.data]
+
+        while pages[-1]['next']:
+            pages.append(client.get(pages[-1]['next']).data)
+
+        assert [result['pk'] for page in pages for result in page['results']] == expected
+
+        # And back from the last page.
+        previous = [client.get(pages[-1]['previous']).data]
+
+        while previous[-1]['previous']:
+            previous.append(client.get(previous[-1]['previous']).data)
+
+        assert [
+            result['pk'] for page in reversed(previous) for result in page['results']
+        ] == expected[:-1]
+
+
+@pytest.mark.django_db
+def test_write_galaxy_responses_have_the_derived_fields(client):
+    constellation, user =\
+        Constellation.objects.create(**constellation_data), User.objects.create(**user_data)
+    client.force_authenticate(user=user)
+    item = {
+        **galaxy_data, 'name': 'M31', 'apparent_magnitude': 3.4, 'size': 178, 'distance': 2500,
+        'constellation': constellation.pk, 'owner': user.pk,
+    }
+
+    request = client.post(url_galaxies, item, format='json')
+
+    assert request.data['absolute_magnitude'] == pytest.approx(-21.02, abs=0.01)
+    assert request.data['physical_size'] == pytest.approx(129.4, abs=0.1)
+
+    request = client.patch(
+        f'{url_galaxies}{request.data["pk"]}/', {'distance': 25000}, format='json'
+    )
+
+    assert request.data['absolute_magnitude'] == pytest.approx(-26.02, abs=0.01)
+
+    request = client.post(url_galaxies + 'bulk/', [{**item, 'name': 'M33'}], format='json')
+
+    assert request.data[0]['absolute_magnitude'] == pytest.approx(-21.02, abs=0.01)
+
+    request = client.patch(url_galaxies + 'bulk/', [
+        {'pk': request.data[0]['pk'], 'distance': 250},
+    ], format='json')
+
+    assert request.data[0]['absolute_magnitude'] == pytest.approx(-16.02, abs=0.01)
+
+
 @pytest.mark.django_db
 def test_create__success(client):
     pass
@@ -22,6 +22,7 @@ url_logout = reverse('auth_logout')
 url_change_pass = '/auth/change_password/'
 url_update_user = '/auth/update_user/'
 url_get_user = '/auth/users/'
+url_delete_user = '/auth/delete_user/'
 
 
 @pytest.mark.django_db
@@ -374,3 +375,47 @@ def test_should_only_be_able_to_get_single_user(client):
     response = client.get(url_get_user)
 
     assert response.status_code == 404
+
+
+@pytest.mark.django_db
+def test_get_user_info_not_modified(client):
+    client.post(url_register, user_data)
+    user = User.objects.get(email=user_data['email'])
+    url = url_get_user + str(user.pk) + '/'
+    response = client.get(url)
+    etag = response['ETag']
+
+    assert response.status_code == 200
+
+    response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+    assert response.status_code == 304
+
+    user.first_name = 'Petar'
+    user.save()
+    response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+    assert response.status_code == 200
+    assert response.data['first_name'] == 'Petar'
+
+
+@pytest.mark.django_db
+def test_delete_user_marks_for_deletion(client, settings):
+    settings.GALAXIES_PURGE = {'ASYNC': False}
+    client.post(url_register, user_data)
+    user = User.objects.get(email=user_data['email'])
+    other_user = User.objects.create(email='other@mail.com', password='12345678+')
+    url = url_delete_user + str(user.pk) + '/'
+
+    client.force_authenticate(user=other_user)
+    response = client.delete(url)
+
+    assert response.status_code == 403
+
+    client.force_authenticate(user=user)
+    response = client.delete(url)
+    user.refresh_from_db()
+
+    assert response.status_code == 202
+    assert not user.is_active
+    assert user.deletion_requested is not None
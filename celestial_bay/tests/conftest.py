@@ -1,8 +1,33 @@
 import pytest
 
+from django.core.cache import cache
 from rest_framework.test import APIClient
 
+from galaxies import cache as response_cache
+
 
 @pytest.fixture
 def client():
     return APIClient()
+
+
+@pytest.fixture(autouse=True)
+def synchronous_settings(settings):
+    # The worker pools are spawned processes, outside of the transaction of
+    # the test, so the tests generate the renditions and purge synchronously,
+    # which a per-process cache is enough for.
+    settings.CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'celestial_bay_tests',
+        },
+    }
+    settings.GALAXIES_RENDITIONS = {**settings.GALAXIES_RENDITIONS, 'ASYNC': False}
+    settings.GALAXIES_PURGE = {**settings.GALAXIES_PURGE, 'ASYNC': False}
+
+
+@pytest.fixture(autouse=True)
+def clear_caches(synchronous_settings):
+    # The database is rolled back after each test, the caches are not.
+    cache.clear()
+    response_cache.clear()